@@ -1,16 +1,28 @@
 from fastapi import FastAPI, Request, Form, HTTPException, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from typing import Dict, List
+from typing import Callable, Dict, List, Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
+import asyncio
 import uvicorn
 import uuid
 import json
+import mmap
+import base64
+import hashlib
 import os
+import math
 import re
 import random
+import time
 import httpx
+import aiofiles
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 from pathlib import Path
 
 # .env faylidan o'zgaruvchilarni yuklash (GOOGLE_CLIENT_SECRET va boshqalar)
@@ -106,6 +118,10 @@ feedbacks: List[Dict] = []
 # OPENAI: qo'llab-quvvatlanadi OPENAI_API_KEY va typo OPENAI_API_KE
 OPENAI_API_KEY = (os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_API_KE") or "").strip()
 ANTHROPIC_API_KEY = (os.getenv("ANTHROPIC_API_KEY") or "").strip()
+# Provider manzillari (lokal mock server yoki proxy uchun almashtirish mumkin – mock_ai_server.py)
+OPENAI_BASE_URL = (os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/")
+ANTHROPIC_BASE_URL = (os.getenv("ANTHROPIC_BASE_URL") or "https://api.anthropic.com/v1").rstrip("/")
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "120"))
 
 DATA_DIR = Path("data")
 ADMIN_PASSWORD = "osco2026"
@@ -133,6 +149,10 @@ def save_json(filename: str, data: dict):
     DATA_DIR.mkdir(exist_ok=True)
     with open(DATA_DIR / filename, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    if filename in ANSWER_KEY_FILES:
+        invalidate_answer_keys()
+    if filename in BANK_FILES:
+        _bank_current.pop(BANK_FILES[filename], None)
 
 # ============ USERS (AUTH) ============
 
@@ -392,112 +412,382 @@ def _validate_writing_tests(tests: list) -> tuple[list, list]:
     return cleaned, errors
 
 
+# ============ TEST BANKI VERSIYALARI (copy-on-write) ============
+
+# Har bir bo'lim fayli (reading_tests.json, ...) mazmuni o'zgarganda yangi o'zgarmas versiya yaratiladi:
+# data/bank_versions/<bo'lim>/<versiya>.json. Versiya ID — fayl mazmunining hash'i (bir xil saqlash yangi versiya
+# yaratmaydi). Sessiya test boshlanganda versiyani "pin" qiladi va shu bo'lim topshirilguncha shu versiya bilan
+# ko'rsatiladi va baholanadi. Hech bir tugallanmagan sessiya ishlatmaydigan eski versiyalar o'chiriladi.
+BANK_SECTIONS = ("reading", "listening", "writing")
+BANK_FILES = {f"{section}_tests.json": section for section in BANK_SECTIONS}
+BANK_VERSIONS_DIR = DATA_DIR / "bank_versions"
+BANK_RECHECK_S = 1.0
+
+
+class BankSnapshot:
+    """Bo'limning bitta o'zgarmas versiyasi. `parts` — (test_id, part_number, type) -> part, O(1) qidiruv.
+    Qaytariladigan test/part lug'atlari umumiy: o'zgartirish kerak bo'lsa nusxa oling."""
+
+    __slots__ = ("section", "version", "tests", "parts")
+
+    def __init__(self, section: str, version: str, tests: list):
+        self.section = section
+        self.version = version
+        self.tests = tests
+        self.parts: Dict[tuple, dict] = {}
+        for test in tests:
+            for part in test.get("parts") or ():
+                self.parts.setdefault((test.get("id", ""), part.get("part_number"), part.get("type")), part)
+
+    def part(self, test_id: str, part_number, ptype: str | None) -> dict | None:
+        return self.parts.get((test_id, part_number, ptype))
+
+
+_bank_snapshots: Dict[str, Dict[str, BankSnapshot]] = {section: {} for section in BANK_SECTIONS}
+_bank_current: Dict[str, tuple] = {}  # bo'lim -> (versiya, fayl stamp, oxirgi tekshiruv)
+
+
+def _validate_bank(section: str, tests: list) -> list:
+    validate = {"reading": _validate_reading_tests, "listening": _validate_listening_tests,
+                "writing": _validate_writing_tests}[section]
+    return validate(tests)[0]
+
+
+def _bank_version_path(section: str, version: str) -> Path:
+    return BANK_VERSIONS_DIR / section / f"{version}.json"
+
+
+def current_bank(section: str) -> BankSnapshot:
+    """Bo'limning joriy versiyasi. Fayl ko'pi bilan sekundiga bir marta tekshiriladi (save_json darhol yangilaydi);
+    mazmuni o'zgargan bo'lsa yangi versiya yoziladi."""
+    now = time.monotonic()
+    cached = _bank_current.get(section)
+    if cached and now - cached[2] < BANK_RECHECK_S:
+        return _bank_snapshots[section][cached[0]]
+    path = DATA_DIR / f"{section}_tests.json"
+    try:
+        st = path.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    if cached and cached[1] == stamp and cached[0] in _bank_snapshots[section]:
+        _bank_current[section] = (cached[0], stamp, now)
+        return _bank_snapshots[section][cached[0]]
+    raw = path.read_bytes() if stamp else b'{"tests": []}'
+    version = hashlib.sha1(raw).hexdigest()[:12]
+    snapshot = _bank_snapshots[section].get(version)
+    if snapshot is None:
+        tests = _validate_bank(section, (json.loads(raw) or {}).get("tests", []))
+        snapshot = _bank_snapshots[section][version] = BankSnapshot(section, version, tests)
+        vpath = _bank_version_path(section, version)
+        if not vpath.exists():
+            vpath.parent.mkdir(parents=True, exist_ok=True)
+            tmp = vpath.with_suffix(".tmp")
+            tmp.write_bytes(raw)
+            os.replace(tmp, vpath)
+            print(f"[Bank] {section}: yangi versiya {version} ({len(tests)} ta test)")
+    _bank_current[section] = (version, stamp, now)
+    return snapshot
+
+
+def bank_snapshot(section: str, version: str | None) -> BankSnapshot | None:
+    """(bo'lim, versiya) bo'yicha snapshot: xotirada bo'lmasa versiya faylidan o'qiladi."""
+    if not version:
+        return None
+    snapshot = _bank_snapshots[section].get(version)
+    if snapshot is None:
+        vpath = _bank_version_path(section, version)
+        if not vpath.exists():
+            return None
+        with open(vpath, "r", encoding="utf-8") as f:
+            tests = _validate_bank(section, (json.load(f) or {}).get("tests", []))
+        snapshot = _bank_snapshots[section][version] = BankSnapshot(section, version, tests)
+    return snapshot
+
+
+def pinned_bank_version(s: dict | None, section: str) -> str | None:
+    return ((s or {}).get("bank_versions") or {}).get(section)
+
+
+def pin_bank_version(s: dict, section: str, refresh: bool = False) -> BankSnapshot:
+    """Sessiya uchun bo'lim versiyasi: birinchi marta (yoki refresh=True) joriy versiya pin qilinadi."""
+    pins = s.setdefault("bank_versions", {})
+    snapshot = None if refresh else bank_snapshot(section, pins.get(section))
+    if snapshot is None:
+        snapshot = current_bank(section)
+        pins[section] = snapshot.version
+    return snapshot
+
+
+def gc_bank_versions() -> int:
+    """Joriy bo'lmagan va tugallanmagan sessiyalar pin qilmagan versiyalarni (xotira va disk) o'chiradi."""
+    referenced = {section: set() for section in BANK_SECTIONS}
+    for s in list(sessions.values()):
+        for section, version in (s.get("bank_versions") or {}).items():
+            if section in referenced and not (s.get(section) or {}).get("completed"):
+                referenced[section].add(version)
+    removed = 0
+    for section in BANK_SECTIONS:
+        keep = referenced[section] | {current_bank(section).version}
+        for version in list(_bank_snapshots[section]):
+            if version not in keep:
+                del _bank_snapshots[section][version]
+        vdir = BANK_VERSIONS_DIR / section
+        for vpath in vdir.glob("*.json") if vdir.exists() else ():
+            if vpath.stem not in keep:
+                vpath.unlink(missing_ok=True)
+                removed += 1
+    if removed:
+        print(f"[Bank] {removed} ta eski versiya o'chirildi")
+    return removed
+
+
+def publish_bank(section: str, tests: list):
+    """Admin saqlashi: fayl yoziladi, yangi versiya darhol yaratiladi, eski keraksiz versiyalar tozalanadi."""
+    save_json(f"{section}_tests.json", {"tests": tests})
+    current_bank(section)
+    gc_bank_versions()
+
+
 def get_reading_tests() -> list:
-    data = load_json("reading_tests.json")
-    tests = data.get("tests", [])
-    cleaned, _ = _validate_reading_tests(tests)
-    return cleaned
+    return current_bank("reading").tests
 
 
 def get_listening_tests() -> list:
-    data = load_json("listening_tests.json")
-    tests = data.get("tests", [])
-    cleaned, _ = _validate_listening_tests(tests)
-    return cleaned
+    return current_bank("listening").tests
 
 
 def get_writing_tests() -> list:
-    data = load_json("writing_tests.json")
-    tests = data.get("tests", [])
-    cleaned, _ = _validate_writing_tests(tests)
-    return cleaned
+    return current_bank("writing").tests
+
+
+# Reading: faqat admin paneldan – part turi bo'yicha filtrlash
+READING_SLOT_TYPES = {1: "open_cloze", 2: "matching_statements", 3: "matching_headings"}
+
+
+def _part_fits_slot(section: str, pnum: int, ptype: str | None) -> bool:
+    if section == "reading" and pnum in READING_SLOT_TYPES:
+        return ptype == READING_SLOT_TYPES[pnum]
+    return True
+
+
+# ============ PART TANLASH: EKSPOZITSIYA NAZORATI (Walker alias) ============
+
+# Har bir part necha marta ko'rsatilgani global hisoblanadi. Slotdagi part og'irligi ko'rsatilish soniga teskari:
+# ko'p ko'rsatilgan (sizib chiqish xavfi yuqori) partlar kamroq, yangilari ko'proq tanlanadi.
+# Har slot uchun Walker alias jadvali oldindan quriladi — bitta tanlov O(1). Jadval shu slotdagi ko'rsatishlar
+# EXPOSURE_REBUILD_DRIFT ulushiga yetganda (faqat o'sha slot) yoki test fayli o'zgarganda qayta quriladi.
+PART_EXPOSURE_FILE = "part_exposure.json"
+EXPOSURE_ALPHA = float(os.getenv("EXPOSURE_ALPHA", "1.0"))  # 0 = bir tekis tanlov
+EXPOSURE_WEIGHT_BOUNDS = (0.05, 20.0)
+EXPOSURE_REBUILD_DRIFT = 0.05
+EXPOSURE_REBUILD_MIN = 10
+EXPOSURE_FLUSH_EVERY = 20
+SEEN_REJECTION_TRIES = 16  # ko'rilgan part chiqsa qayta tortish; shundan keyin ko'rilmaganlar ichidan oddiy tanlov
+
+
+class AliasTable:
+    """Walker/Vose alias usuli: n ta og'irlikdan O(n) da quriladi, har tanlov O(1) (ikkita tasodifiy son)."""
+
+    __slots__ = ("prob", "alias")
+
+    def __init__(self, weights: list):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights] if total > 0 else [1.0] * n
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def draw(self, rng=random) -> int:
+        i = int(rng.random() * len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+_part_exposure: Dict[str, Dict[str, int]] | None = None
+_exposure_unsaved = 0
+
+
+def get_part_exposure() -> Dict[str, Dict[str, int]]:
+    global _part_exposure
+    if _part_exposure is None:
+        _part_exposure = load_json(PART_EXPOSURE_FILE)
+    return _part_exposure
+
+
+def flush_part_exposure():
+    global _exposure_unsaved
+    if _part_exposure is not None and _exposure_unsaved:
+        save_json(PART_EXPOSURE_FILE, _part_exposure)
+        _exposure_unsaved = 0
+
+
+def exposure_weight(count: int, mean: float) -> float:
+    lo, hi = EXPOSURE_WEIGHT_BOUNDS
+    return min(max(((mean + 1) / (count + 1)) ** EXPOSURE_ALPHA, lo), hi)
+
+
+class PartSampler:
+    """Bo'lim slotlari bo'yicha nomzod partlar va ularning alias jadvallari."""
+
+    def __init__(self, section: str, tests: list, version: str | None):
+        self.section = section
+        self.tests = tests
+        self.version = version
+        self.slots: Dict[int, dict] = {}
+        self.by_id: Dict[tuple, dict] = {}
+        for test in tests:
+            test_id = test.get("id", "")
+            for part in test.get("parts") or ():
+                pnum = part.get("part_number", 0)
+                if not isinstance(pnum, int) or not 1 <= pnum <= SECTION_SLOTS[section]:
+                    continue
+                if not _part_fits_slot(section, pnum, part.get("type")):
+                    continue
+                slot = self.slots.setdefault(pnum, {"candidates": [], "pids": []})
+                slot["candidates"].append((part, test_id))
+                slot["pids"].append(test_id + "_" + str(pnum))
+                self.by_id.setdefault((test_id, pnum, part.get("type")), part)
+        for pnum in self.slots:
+            self.rebuild(pnum)
+
+    def rebuild(self, pnum: int):
+        slot = self.slots[pnum]
+        counts = get_part_exposure().get(self.section, {})
+        served = [counts.get(pid, 0) for pid in slot["pids"]]
+        mean = sum(served) / len(served)
+        slot["weights"] = [exposure_weight(c, mean) for c in served]
+        slot["table"] = AliasTable(slot["weights"])
+        slot["served_at_build"] = sum(served)
+        slot["served_since"] = 0
+
+    def draw(self, pnum: int, seen_ids=(), rng=random) -> tuple | None:
+        slot = self.slots.get(pnum)
+        if not slot:
+            return None
+        table, pids = slot["table"], slot["pids"]
+        i = table.draw(rng)
+        if seen_ids and pids[i] in seen_ids:
+            # Avval ko'rilmaganlar: rad etib qayta tortish (ko'rilganlar kam bo'lsa kutilgan tortishlar soni ~1)
+            for _ in range(SEEN_REJECTION_TRIES):
+                i = table.draw(rng)
+                if pids[i] not in seen_ids:
+                    break
+            else:
+                unseen = [j for j, pid in enumerate(pids) if pid not in seen_ids]
+                if unseen:
+                    i = rng.choices(unseen, weights=[slot["weights"][j] for j in unseen])[0]
+        return slot["candidates"][i]
+
+    def served(self, pnum: int):
+        slot = self.slots.get(pnum)
+        if slot is None:
+            return
+        slot["served_since"] += 1
+        if slot["served_since"] >= max(EXPOSURE_REBUILD_MIN, EXPOSURE_REBUILD_DRIFT * slot["served_at_build"]):
+            self.rebuild(pnum)
+
+
+_part_samplers: Dict[str, PartSampler] = {}
+
+
+def get_part_sampler(section: str) -> PartSampler:
+    """Joriy bank versiyasi uchun sampler (yangi testlar doim joriy versiyadan yig'iladi)."""
+    bank = current_bank(section)
+    sampler = _part_samplers.get(section)
+    if sampler is None or sampler.version != bank.version:
+        sampler = _part_samplers[section] = PartSampler(section, bank.tests, bank.version)
+    return sampler
+
+
+def record_part_exposure(section: str, parts: list):
+    """Foydalanuvchiga ko'rsatilgan partlarni hisoblaydi (test sahifasi ochilganda bir marta)."""
+    global _exposure_unsaved
+    counts = get_part_exposure().setdefault(section, {})
+    sampler = get_part_sampler(section)
+    for part in parts:
+        pnum = part.get("part_number", 0)
+        pid = part.get("_source_test_id", "") + "_" + str(pnum)
+        counts[pid] = counts.get(pid, 0) + 1
+        sampler.served(pnum)
+        _exposure_unsaved += 1
+    if _exposure_unsaved >= EXPOSURE_FLUSH_EVERY:
+        flush_part_exposure()
+
+
+def pin_served_test(section: str, s: dict, test: dict):
+    """Ko'rsatilgan partlarni va ular olingan bank versiyasini sessiyaga yozadi, ekspozitsiyani hisoblaydi
+    (sahifa qayta ochilsa ham bir marta)."""
+    if test.get("bank_version"):
+        s.setdefault("bank_versions", {})[section] = test["bank_version"]
+    served = [[p.get("_source_test_id"), p.get("part_number"), p.get("type")] for p in test.get("parts", [])]
+    if s.get(f"{section}_served") != served:
+        s[f"{section}_served"] = served
+        record_part_exposure(section, test.get("parts", []))
+
+
+def served_test(section: str, s: dict) -> dict | None:
+    """Sahifada ko'rsatilgan partlar (sessiyada saqlangan) bilan testni pin qilingan bank versiyasidan qayta yig'adi —
+    admin keyin bankni o'zgartirgan bo'lsa ham topshirish ko'rsatilgan mazmun bo'yicha baholanadi."""
+    served = s.get(f"{section}_served")
+    if not served:
+        return None
+    bank = bank_snapshot(section, pinned_bank_version(s, section)) or current_bank(section)
+    parts = []
+    for test_id, pnum, ptype in served:
+        part = bank.part(test_id, pnum, ptype)
+        if part is None:
+            return None  # versiya topilmadi — eski usulda qayta tanlanadi
+        parts.append(dict(part, part_number=pnum, _source_test_id=test_id, _bank_version=bank.version))
+    return {"id": section + "_combined", "parts": parts, "bank_version": bank.version}
+
+
+def part_exposure_report(section: str) -> list:
+    sampler = get_part_sampler(section)
+    counts = get_part_exposure().get(section, {})
+    rows = []
+    for pnum, slot in sorted(sampler.slots.items()):
+        total = sum(slot["weights"])
+        for (part, test_id), pid, w in zip(slot["candidates"], slot["pids"], slot["weights"]):
+            rows.append({"slot": pnum, "part": pid, "type": part.get("type"), "served": counts.get(pid, 0),
+                         "probability": round(w / total, 4)})
+    return rows
+
 
 def _build_test_from_all_tests(section: str, user: dict) -> dict:
     """Barcha testlardan har bir part turi uchun bitta part tanlab, yangi test yaratadi."""
-    tests = get_reading_tests() if section == "reading" else (get_listening_tests() if section == "listening" else get_writing_tests())
+    if section not in SECTION_SLOTS:
+        return dict(DEFAULT_WRITING)  # writing testi bu yerda yig'ilmaydi (writing_test o'z tanlovini qiladi)
+    sampler = get_part_sampler(section)
+    tests = sampler.tests
     if not tests:
-        return dict(DEFAULT_READING if section == "reading" else (DEFAULT_LISTENING if section == "listening" else DEFAULT_WRITING))
-    
-    # Har bir part_number uchun (1-5 yoki 1-6) barcha testlardan shu part_number ga ega bo'lgan partlarni yig'ish
-    # Format: parts_by_number[pnum] = [(part, test_id), ...]
-    parts_by_number = {}
-    
-    for test in tests:
-        if not test.get("parts"):
-            continue
-        test_id = test.get("id", "")
-        for part in test["parts"]:
-            pnum = part.get("part_number", 0)
-            if pnum > 0:
-                if pnum not in parts_by_number:
-                    parts_by_number[pnum] = []
-                parts_by_number[pnum].append((dict(part), test_id))  # Copy part va test_id ni birga saqlash
+        return dict(DEFAULT_READING if section == "reading" else DEFAULT_LISTENING)
     
-    # Har bir part_number uchun random bitta part tanlash
+    # Har bir slot (part_number) uchun bitta part: ekspozitsiya og'irligi bilan, avval ko'rilmaganlar
     selected_parts = []
-    max_parts = 5 if section == "reading" else (6 if section == "listening" else 2)
-    seen_ids = list(user.get("seen_reading_parts" if section == "reading" else "seen_listening_parts", []) or [])
+    max_parts = SECTION_SLOTS[section]
+    seen_ids = set(user.get("seen_reading_parts" if section == "reading" else "seen_listening_parts", []) or [])
     
     for pnum in range(1, max_parts + 1):
-        if pnum in parts_by_number and parts_by_number[pnum]:
-            candidates = parts_by_number[pnum]  # [(part_dict, test_id), ...]
-            
-            # Reading: faqat admin paneldan – part turi bo'yicha filtrlash
-            if section == "reading" and pnum == 1:
-                candidates = [(p, tid) for p, tid in candidates if p.get("type") == "open_cloze"]
-            if section == "reading" and pnum == 2:
-                candidates = [(p, tid) for p, tid in candidates if p.get("type") == "matching_statements"]
-            if section == "reading" and pnum == 3:
-                candidates = [(p, tid) for p, tid in candidates if p.get("type") == "matching_headings"]
-            
-            if not candidates:
-                continue
-            
-            # Avval ko'rilmaganlarni, keyin ko'rilganlarni tanlash
-            unseen = []
-            seen = []
-            for part_dict, test_id in candidates:
-                pid = test_id + "_" + str(pnum)
-                if pid in seen_ids:
-                    seen.append((part_dict, test_id))
-                else:
-                    unseen.append((part_dict, test_id))
-            
-            if unseen:
-                selected, test_id = random.choice(unseen)
-            elif seen:
-                selected, test_id = random.choice(seen)
-            else:
-                selected, test_id = random.choice(candidates)
+        picked = sampler.draw(pnum, seen_ids)
+        if picked is not None:
+            selected, test_id = picked
             
             # Partni copy qilish va part_number ni to'g'ri qo'yish
             part_copy = dict(selected)
             part_copy["part_number"] = pnum
             part_copy["_source_test_id"] = test_id  # Original test ID ni saqlash
+            part_copy["_bank_version"] = sampler.version
             selected_parts.append(part_copy)
     
     # Reading va Listening: faqat admin paneldan – default bilan to'ldirmaymiz.
-    # Writing: agar partlar bo'lmasa default ishlatiladi.
-    if section in ("reading", "listening"):
-        # Hech qanday default part qo'shilmaydi – faqat JSON dagi partlar.
-        pass
-    else:
-        default_test = DEFAULT_WRITING
-        default_parts = default_test.get("parts", [])
-        for pnum in range(1, max_parts + 1):
-            if any(p.get("part_number") == pnum for p in selected_parts):
-                continue
-            for dp in default_parts:
-                if dp.get("part_number") == pnum:
-                    part_copy = dict(dp)
-                    part_copy["_source_test_id"] = default_test.get("id", section + "_default")
-                    selected_parts.append(part_copy)
-                    break
-        if not selected_parts:
-            selected_parts = [dict(p) for p in default_parts]
-            for p in selected_parts:
-                if "_source_test_id" not in p:
-                    p["_source_test_id"] = default_test.get("id", section + "_default")
     
     # Partlarni part_number bo'yicha tartiblash
     selected_parts.sort(key=lambda p: p.get("part_number", 0))
@@ -507,8 +797,9 @@ def _build_test_from_all_tests(section: str, user: dict) -> dict:
     new_test = {
         "id": section + "_combined",
         "title": first_test.get("title", section.capitalize() + " Test"),
-        "time_limit": first_test.get("time_limit", 60 if section == "reading" else (40 if section == "listening" else 80)),
-        "parts": selected_parts
+        "time_limit": first_test.get("time_limit", 60 if section == "reading" else 40),
+        "parts": selected_parts,
+        "bank_version": sampler.version,
     }
     
     # Partlarni ko'rilmaganlar avval qilib tartiblash (lekin part_number tartibini saqlab qolish)
@@ -589,18 +880,38 @@ def save_test_result(session: dict):
         "reading_total": session.get("reading", {}).get("total", 0),
         "reading_percentage": session.get("reading", {}).get("percentage", 0),
         "reading_details": session.get("reading", {}).get("details", []),
+        "reading_parts": session.get("reading", {}).get("parts", []),
+        # Adaptiv rejimda: qobiliyat bahosi (foiz shundan olingan); oddiy rejimda None
+        "reading_theta": session.get("reading", {}).get("theta"),
+        "reading_se": session.get("reading", {}).get("se"),
         "listening_score": session.get("listening", {}).get("score", 0),
         "listening_total": session.get("listening", {}).get("total", 0),
         "listening_percentage": session.get("listening", {}).get("percentage", 0),
         "listening_details": session.get("listening", {}).get("details", []),
+        "listening_parts": session.get("listening", {}).get("parts", []),
+        "listening_theta": session.get("listening", {}).get("theta"),
+        "listening_se": session.get("listening", {}).get("se"),
         "writing_percentage": session.get("writing", {}).get("percentage", 0),
         "writing_evaluation": session.get("writing", {}).get("evaluation"),
+        # Qayta baholash (re-grade) uchun javob matnlari va test ID si ham saqlanadi
+        "writing_responses": session.get("writing", {}).get("responses"),
+        "writing_test_id": session.get("writing", {}).get("test_id"),
+        # O'xshash ishlarni qidirish uchun MinHash imzolari va topshirish paytida topilgan o'xshashlar
+        "writing_minhash": session.get("writing", {}).get("minhash") or {},
+        "writing_similar": session.get("writing", {}).get("similar") or {},
         "overall_score": session.get("overall_score", 0),
         "cefr_level": session.get("cefr_level") or "—",
         "level_description": session.get("level_description") or "",
     }
     data["results"].append(record)
     save_json(TEST_HISTORY_FILE, data)
+    if _writing_lsh is not None:
+        _index_history_record(_writing_lsh, record)
+    part_index = load_result_part_index()
+    if part_index is not None:
+        index_result_parts(part_index, record)
+        save_json(RESULT_PART_INDEX_FILE, part_index)
+    record_item_stats(record)
 
 def get_test_history(user_id: str, limit: int = 50) -> list:
     data = load_test_history_data()
@@ -1019,133 +1330,1220 @@ def get_session(session_id: str) -> Dict:
 
 # ============ SCORING ============
 
-def calculate_reading_score(answers: Dict[str, str], test_data: dict) -> Dict:
+# Ochiq javoblar (open cloze, sentence/note completion): har bir savol uchun bir marta kompilyatsiya qilinadigan matcher –
+# muqobil javoblar ("alternatives" ro'yxati yoki correct ichida "|"), normallashtirish (registr, tinish belgilari,
+# bo'shliqlar, britancha/amerikancha imlo) va so'z uzunligiga qarab cheklangan tahrir masofasi (xato harflar).
+ANSWER_ALT_SEPARATOR = "|"
+ANSWER_TYPO_TOLERANCE = os.getenv("ANSWER_TYPO_TOLERANCE", "1") not in ("0", "false", "no")
+_ANSWER_PUNCT = re.compile(r"[^\w\s']+")
+_ANSWER_QUOTES = str.maketrans({"’": "'", "‘": "'", "`": "'", "´": "'", "-": " ", "–": " ", "—": " ", "_": " "})
+
+# Britancha o'zak -> amerikancha; so'z shu o'zak bilan boshlansa almashtiriladi (colours -> colors, organisation -> organization).
+# Ikkala tomon (kalit ham, javob ham) bir xil normallashgani uchun faqat yozilishi farq qiladigan shakllar tenglashadi.
+BRITISH_AMERICAN_STEMS = {
+    "colour": "color", "favour": "favor", "flavour": "flavor", "honour": "honor", "humour": "humor",
+    "labour": "labor", "neighbour": "neighbor", "behaviour": "behavior", "harbour": "harbor", "rumour": "rumor",
+    "vapour": "vapor", "armour": "armor", "endeavour": "endeavor", "parlour": "parlor", "savour": "savor",
+    "centre": "center", "theatre": "theater", "metre": "meter", "litre": "liter", "fibre": "fiber", "calibre": "caliber",
+    "kilometre": "kilometer", "centimetre": "centimeter", "millimetre": "millimeter", "sombre": "somber", "spectre": "specter",
+    "organis": "organiz", "realis": "realiz", "recognis": "recogniz", "apologis": "apologiz", "criticis": "criticiz",
+    "emphasis": "emphasiz", "memoris": "memoriz", "minimis": "minimiz", "maximis": "maximiz", "prioritis": "prioritiz",
+    "summaris": "summariz", "specialis": "specializ", "customis": "customiz", "modernis": "moderniz", "globalis": "globaliz",
+    "analys": "analyz", "paralys": "paralyz", "catalys": "catalyz",
+    "travell": "travel", "cancell": "cancel", "modell": "model", "labell": "label", "fuell": "fuel", "levell": "level",
+    "signall": "signal", "channell": "channel", "counsell": "counsel", "jewell": "jewel", "marvell": "marvel",
+    "programme": "program", "catalogue": "catalog", "dialogue": "dialog", "analogue": "analog", "monologue": "monolog",
+    "defence": "defense", "offence": "offense", "licence": "license", "pretence": "pretense",
+    "grey": "gray", "tyre": "tire", "cheque": "check", "aluminium": "aluminum", "plough": "plow", "pyjama": "pajama",
+    "kerb": "curb", "storey": "story", "draught": "draft", "cosy": "cozy", "sceptic": "skeptic", "manoeuvr": "maneuver",
+    "enrolment": "enrollment", "fulfil": "fulfill", "skilful": "skillful", "aeroplane": "airplane", "ageing": "aging",
+    "judgement": "judgment", "mould": "mold", "moustache": "mustache", "paediatric": "pediatric", "encyclopaedia": "encyclopedia",
+    "anaemi": "anemi", "anaesthe": "anesthe", "oesophag": "esophag", "foetus": "fetus", "mum": "mom",
+}
+# Birinchi 3 harf -> (o'zak, amerikancha) uzunidan qisqasiga – aksariyat so'zlar bitta lug'at qidiruvida o'tadi
+_BRITISH_STEMS_BY_PREFIX: Dict[str, list] = {}
+for _stem, _american in sorted(BRITISH_AMERICAN_STEMS.items(), key=lambda kv: -len(kv[0])):
+    _BRITISH_STEMS_BY_PREFIX.setdefault(_stem[:3], []).append((_stem, _american))
+
+
+def _american_spelling(word: str) -> str:
+    for stem, american in _BRITISH_STEMS_BY_PREFIX.get(word[:3], ()):
+        if word.startswith(stem):
+            if american.startswith(stem) and word.startswith(american):
+                return word  # amerikancha shakl o'zakni davom ettiradi (fulfil -> fulfill): so'z allaqachon amerikancha
+            return american + word[len(stem):]
+    return word
+
+
+def normalize_answer(text: str) -> str:
+    """Solishtirish uchun: kichik harf, apostrof/defis bir xil, tinish belgilarisiz, bitta bo'shliq, amerikancha imlo."""
+    text = text or ""
+    if text.isalpha() and text.isascii():
+        return _american_spelling(text.lower())  # ko'p uchraydigan holat: bitta oddiy so'z
+    text = _ANSWER_PUNCT.sub(" ", (text or "").lower().translate(_ANSWER_QUOTES))
+    return " ".join(_american_spelling(w.strip("'")) for w in text.split() if w.strip("'"))
+
+
+def answer_edit_budget(token: str, max_edits: int | None = None) -> int:
+    """Kalitning bitta so'zi uchun ruxsat etilgan xato harflar. Faqat harfli so'zlarda: raqam, sana, vaqt, telefon
+    raqamida bitta belgi farqi — boshqa javob. Standart: 4 harfgacha 0 (a/an, in/on farq qiladi), 8 gacha 1, undan uzunida 2."""
+    if not token.isalpha():
+        return 0
+    if max_edits is not None:
+        return max(int(max_edits), 0)
+    n = len(token)
+    return 0 if n <= 4 else (1 if n <= 8 else 2)
+
+
+def within_edit_distance(a: str, b: str, k: int) -> bool:
+    """Levenshtein(a, b) <= k – faqat diagonal atrofidagi 2k+1 kenglikdagi band hisoblanadi,
+    qatordagi eng kichik qiymat k dan oshsa darhol to'xtaydi."""
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if k <= 0 or abs(la - lb) > k:
+        return False
+    inf = k + 1
+    prev = [j if j <= k else inf for j in range(lb + 1)]
+    for i in range(1, la + 1):
+        cur = [inf] * (lb + 1)
+        if i <= k:
+            cur[0] = i
+        row_min = cur[0]
+        ch = a[i - 1]
+        for j in range(max(1, i - k), min(lb, i + k) + 1):
+            v = prev[j - 1] + (ch != b[j - 1])
+            if prev[j] + 1 < v:
+                v = prev[j] + 1
+            if cur[j - 1] + 1 < v:
+                v = cur[j - 1] + 1
+            cur[j] = v if v < inf else inf
+            if v < row_min:
+                row_min = v
+        if row_min > k:
+            return False
+        prev = cur
+    return prev[lb] <= k
+
+
+def answer_alternatives(q: dict) -> list:
+    """Savolning barcha qabul qilinadigan javoblari: correct ("|" bilan ajratilgan bo'lishi mumkin) + alternatives."""
+    raw = [str(q.get("correct") or "")]
+    alts = q.get("alternatives") or []
+    raw += [alts] if isinstance(alts, str) else [str(a) for a in alts]
+    out = []
+    for item in raw:
+        for alt in item.split(ANSWER_ALT_SEPARATOR):
+            alt = alt.strip()
+            if alt and alt not in out:
+                out.append(alt)
+    return out
+
+
+class AnswerMatcher:
+    """Bitta savol uchun kompilyatsiya qilingan matcher: match(javob, kalit) – comparator interfeysi bilan bir xil.
+
+    contains=True (listening completion): qabul qilingan javob foydalanuvchi javobida butun so'zlar ketma-ketligi
+    sifatida uchrasa ham to'g'ri ("by bus" ichida "bus").
+    fuzzy=True: xato harflarga so'zma-so'z ruxsat (answer_edit_budget; raqamli so'zlar doim aniq). fuzzy=False bo'lsa
+    faqat savolda max_edits berilganda.
+    """
+    __slots__ = ("forms", "fuzzy", "contains", "max_words")
+
+    def __init__(self, alternatives: list, contains: bool = False, max_edits: int | None = None, fuzzy: bool = True):
+        forms = {normalize_answer(a) for a in alternatives} - {""}
+        self.forms = frozenset(forms)
+        # (so'zlar, har so'z uchun ruxsat etilgan tahrirlar) – kamida bitta so'zga tahrir ruxsat etilgan shakllar
+        entries = []
+        if ANSWER_TYPO_TOLERANCE and (fuzzy or max_edits is not None):
+            for f in sorted(forms):
+                words = tuple(f.split())
+                budgets = tuple(answer_edit_budget(w, max_edits) for w in words)
+                if any(budgets):
+                    entries.append((words, budgets))
+        self.fuzzy = tuple(entries)
+        self.contains = contains
+        self.max_words = max((f.count(" ") + 1 for f in forms), default=0)
+
+    def _near(self, words: list) -> bool:
+        for form_words, budgets in self.fuzzy:
+            if len(form_words) != len(words):
+                continue
+            for w, fw, k in zip(words, form_words, budgets):
+                if w != fw and not (k and abs(len(w) - len(fw)) <= k and within_edit_distance(w, fw, k)):
+                    break
+            else:
+                return True
+        return False
+
+    def __call__(self, ua: str, ca: str = "") -> bool:
+        if ua in self.forms:
+            return True
+        norm = normalize_answer(ua)
+        if not norm:
+            return False
+        if norm in self.forms:
+            return True
+        if not self.fuzzy and not self.contains:
+            return False  # open cloze: faqat normallashgan shakllar
+        words = norm.split()
+        if self.fuzzy and self._near(words):
+            return True
+        if self.contains and len(words) > 1:
+            for size in range(1, min(self.max_words, len(words)) + 1):
+                for i in range(len(words) - size + 1):
+                    window = words[i:i + size]
+                    if " ".join(window) in self.forms or (self.fuzzy and self._near(window)):
+                        return True
+        return False
+
+
+def compile_answer_matcher(q: dict, contains: bool = False, fuzzy: bool = True) -> AnswerMatcher:
+    max_edits = q.get("max_edits")
+    return AnswerMatcher(answer_alternatives(q), contains, int(max_edits) if max_edits is not None else None, fuzzy)
+
+
+# Javob kalitlari part bo'yicha bir marta kompilyatsiya qilinadi: tekis (savol raqami, normallashgan kalit,
+# registr funksiyasi, comparator, part raqami) ro'yxati. Submissionni baholash – bitta sikl.
+# Yangi part turi uchun if/elif emas: register_part_type() bilan savollar qaysi maydonda va qaysi comparator.
+
+@dataclass(frozen=True, slots=True)
+class AnswerComparator:
+    name: str
+    case: Callable[[str], str]                    # javob ham, kalit ham shu bilan normallashadi (javob avval strip)
+    match: Callable[[str, str], bool] | None      # (javob, kalit) -> to'g'rimi; None = oddiy tenglik (siklda inline)
+    compile: Callable[[dict], Callable[[str, str], bool]] | None = None  # savolga xos matcher (match o'rniga)
+
+
+ANSWER_COMPARATORS: Dict[str, AnswerComparator] = {}
+# section -> part turi -> ((savollar maydoni, comparator nomi), ...); tartib details tartibini belgilaydi
+PART_ANSWER_FIELDS: Dict[str, Dict[str, tuple]] = {"reading": {}, "listening": {}}
+
+
+def register_comparator(name: str, case: Callable[[str], str], match: Callable[[str, str], bool] | None = None,
+                        compile: Callable[[dict], Callable[[str, str], bool]] | None = None):
+    ANSWER_COMPARATORS[name] = AnswerComparator(name, case, match, compile)
+
+
+def register_part_type(section: str, ptype: str, *fields: tuple):
+    """fields: (maydon yo'li, comparator) – masalan ("gap_fill.questions", "exact")."""
+    for _, comparator in fields:
+        if comparator not in ANSWER_COMPARATORS:
+            raise ValueError(f"Noma'lum comparator: {comparator}")
+    PART_ANSWER_FIELDS.setdefault(section, {})[ptype] = tuple(fields)
+
+
+register_comparator("choice", str.upper)
+register_comparator("exact", str.lower)
+register_comparator("contains", str.lower, lambda ua, ca: ua == ca or ca in ua)
+# Open cloze grammatika/yordamchi so'zlarni tekshiradi: bitta harf farqi ko'pincha boshqa haqiqiy so'z (where/there,
+# being/bring) – xato harflarga faqat savolda max_edits berilsa ruxsat
+register_comparator("open", str.lower, compile=lambda q: compile_answer_matcher(q, fuzzy=False))
+register_comparator("completion", str.lower, compile=lambda q: compile_answer_matcher(q, contains=True))
+
+for _ptype in ("matching_statements", "multiple_choice_cloze", "multiple_choice_comprehension", "matching_headings", "gapped_text"):
+    register_part_type("reading", _ptype, ("questions", "choice"))
+register_part_type("reading", "open_cloze", ("questions", "open"))
+register_part_type("reading", "part5_mixed", ("gap_fill.questions", "open"), ("questions", "choice"))
+
+for _ptype in ("short_conversations", "interview"):
+    register_part_type("listening", _ptype, ("questions", "choice"))
+for _ptype in ("sentence_completion", "note_completion"):
+    register_part_type("listening", _ptype, ("questions", "completion"))
+for _ptype in ("multiple_matching", "speaker_matching"):
+    register_part_type("listening", _ptype, ("answers", "choice"))
+register_part_type("listening", "map_labeling", ("places", "choice"))
+
+# Kompilyatsiya qilingan kalitlar keshi: (section, manba test, part raqami, turi) -> items.
+# save_json test faylini yozganda, yoki fayl tashqaridan o'zgarsa (mtime/hajm, ko'pi bilan sekundiga bir tekshiruv) tozalanadi.
+ANSWER_KEY_FILES = ("reading_tests.json", "listening_tests.json")
+ANSWER_KEY_RECHECK_S = 1.0
+_answer_key_cache: Dict[tuple, tuple] = {}
+_answer_key_stamp: tuple | None = None
+_answer_key_checked = 0.0
+_answer_key_generation = 0  # kesh har tozalanganda oshadi: kalitlardan quriladigan boshqa indekslar shu bilan eskiradi
+
+
+def invalidate_answer_keys():
+    global _answer_key_stamp, _answer_key_generation
+    _answer_key_cache.clear()
+    _answer_key_stamp = None
+    _answer_key_generation += 1
+
+
+def _refresh_answer_key_cache():
+    global _answer_key_stamp, _answer_key_checked, _answer_key_generation
+    now = time.monotonic()
+    if now - _answer_key_checked < ANSWER_KEY_RECHECK_S:
+        return
+    _answer_key_checked = now
+    stamp = []
+    for name in ANSWER_KEY_FILES:
+        try:
+            st = (DATA_DIR / name).stat()
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    stamp = tuple(stamp)
+    if stamp != _answer_key_stamp:
+        _answer_key_cache.clear()
+        _answer_key_stamp = stamp
+        _answer_key_generation += 1
+
+
+def compile_part_key(section: str, part: dict) -> tuple:
+    """Part javob kalitini tekis tuple'ga aylantiradi (kalitlar bir marta normallashadi)."""
+    items = []
+    pn = part.get("part_number")
+    for path, comparator in PART_ANSWER_FIELDS.get(section, {}).get(part.get("type"), ()):
+        cmp = ANSWER_COMPARATORS[comparator]
+        questions = part
+        for field in path.split("."):
+            questions = questions.get(field) or {}
+        for q in questions or ():
+            if cmp.compile is None:
+                items.append((str(q["number"]), cmp.case(q["correct"]), cmp.case, cmp.match, pn))
+            else:
+                shown = " / ".join(answer_alternatives(q)) or q["correct"]
+                items.append((str(q["number"]), cmp.case(shown), cmp.case, cmp.compile(q), pn))
+    return tuple(items)
+
+
+def get_part_key(section: str, part: dict) -> tuple:
+    source = part.get("_source_test_id")
+    if not source:
+        return compile_part_key(section, part)  # manbasi noma'lum part keshlanmaydi
+    ck = (section, source, part.get("part_number"), part.get("type"), part.get("_bank_version"))
+    items = _answer_key_cache.get(ck)
+    if items is None:
+        items = _answer_key_cache[ck] = compile_part_key(section, part)
+    return items
+
+
+def score_answers(answers: Dict[str, str], test_data: dict, section: str) -> Dict:
+    _refresh_answer_key_cache()
+    get = answers.get
     correct = 0
-    total = 0
     details = []
+    append = details.append
     for part in test_data["parts"]:
-        ptype = part["type"]
-        if ptype == "matching_statements":
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = q["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype in ["multiple_choice_cloze", "multiple_choice_comprehension"]:
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = q["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype == "open_cloze":
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().lower()
-                ca = q["correct"].lower()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype == "matching_headings":
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = q["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype == "gapped_text":
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = q["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype == "part5_mixed":
-            for q in part.get("gap_fill", {}).get("questions", []):
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().lower()
-                ca = q["correct"].lower()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = q["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        for qn, ca, case, match, pn in get_part_key(section, part):
+            ua = get(qn)
+            ua = case(ua.strip()) if ua else ""
+            # bo'sh javobni matcher baribir rad etadi (bo'sh shakl qabul qilinmaydi) – chaqirilmaydi
+            ok = ua == ca if match is None else (match(ua, ca) if ua else False)
+            if ok: correct += 1
+            append({"q": qn, "ua": ua, "ca": ca, "ok": ok, "part": pn})
+    total = len(details)
     pct = (correct / total * 100) if total > 0 else 0
     return {"correct": correct, "total": total, "percentage": round(pct, 1), "details": details}
 
 
+def calculate_reading_score(answers: Dict[str, str], test_data: dict) -> Dict:
+    return score_answers(answers, test_data, "reading")
+
+
 def calculate_listening_score(answers: Dict[str, str], test_data: dict) -> Dict:
-    correct = 0
-    total = 0
-    details = []
-    for part in test_data["parts"]:
-        ptype = part["type"]
-        if ptype in ["short_conversations", "interview"]:
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = q["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype in ["sentence_completion", "note_completion"]:
-            for q in part["questions"]:
-                total += 1
-                qn = str(q["number"])
-                ua = answers.get(qn, "").strip().lower()
-                ca = q["correct"].lower()
-                ic = ua == ca or ca in ua
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype in ["multiple_matching", "speaker_matching"]:
-            for a in part["answers"]:
-                total += 1
-                qn = str(a["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = a["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-        elif ptype == "map_labeling":
-            for p in part["places"]:
-                total += 1
-                qn = str(p["number"])
-                ua = answers.get(qn, "").strip().upper()
-                ca = p["correct"].upper()
-                ic = ua == ca
-                if ic: correct += 1
-                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
-    pct = (correct / total * 100) if total > 0 else 0
-    return {"correct": correct, "total": total, "percentage": round(pct, 1), "details": details}
+    return score_answers(answers, test_data, "listening")
+
+
+# ============ NATIJALARNI QAYTA BAHOLASH (javob kaliti o'zgarganda) ============
+
+# Har bir natija qaysi manba partlar bilan baholanganini saqlaydi: {"source", "part", "type", "key"}.
+# "key" — o'sha paytdagi kompilyatsiya qilingan javob kalitining izi (fingerprint). Admin kalitni tuzatsa,
+# izi o'zgaradi va `python manage.py rescore-results` faqat shu partni o'z ichiga olgan natijalarni qayta baholaydi.
+RESULT_PART_INDEX_FILE = "result_part_index.json"
+RESULT_SECTIONS = ("reading", "listening")
+
+
+def part_key_fingerprint(items: tuple) -> str:
+    """Kompilyatsiya qilingan part kalitining qisqa izi (savol raqami + ko'rsatiladigan javob)."""
+    h = hashlib.sha1()
+    for qn, ca, _case, _match, _pn in items:
+        h.update(f"{qn}\t{ca}\n".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def part_index_key(section: str, source: str, part_number) -> str:
+    return f"{section}|{source}|{part_number}"
+
+
+def scored_parts(test: dict, section: str) -> list:
+    """Baholangan testning partlari: natija bilan birga saqlanadi (keyin qayta baholash uchun)."""
+    parts = []
+    for part in test.get("parts", []):
+        source = part.get("_source_test_id")
+        if not source:
+            continue
+        parts.append({
+            "source": source,
+            "part": part.get("part_number"),
+            "type": part.get("type"),
+            "key": part_key_fingerprint(get_part_key(section, part)),
+        })
+    return parts
+
+
+def answer_key_bank(section: str, snapshot: BankSnapshot | None = None) -> dict:
+    """Test bankidagi (standart: joriy versiya) barcha partlar: index kaliti -> {"part", "items", "key"}."""
+    snapshot = snapshot or current_bank(section)
+    bank = {}
+    for test in snapshot.tests:
+        source = test.get("id", "")
+        for part in test.get("parts") or ():
+            part = dict(part, _source_test_id=source, _bank_version=snapshot.version)
+            items = get_part_key(section, part)
+            bank[part_index_key(section, source, part.get("part_number"))] = {
+                "part": part, "items": items, "key": part_key_fingerprint(items),
+            }
+    return bank
+
+
+def infer_record_parts(record: dict, section: str, bank: dict) -> list:
+    """Eski natijalarda part manbasi yo'q: savol raqamlari aynan bitta bank partiga mos kelsa, o'shani oladi.
+    Kalit izi noma'lum ("") — shuning uchun bunday natija birinchi marta albatta qayta baholanadi."""
+    questions: Dict[object, set] = {}
+    for d in record.get(f"{section}_details") or ():
+        questions.setdefault(d.get("part"), set()).add(str(d.get("q")))
+    parts = []
+    for pn, qs in questions.items():
+        matches = [
+            (key, entry) for key, entry in bank.items()
+            if entry["part"].get("part_number") == pn and {it[0] for it in entry["items"]} == qs
+        ]
+        if len(matches) == 1:
+            entry = matches[0][1]
+            parts.append({"source": entry["part"]["_source_test_id"], "part": pn,
+                          "type": entry["part"].get("type"), "key": ""})
+    return parts
+
+
+def record_parts(record: dict, section: str, bank: dict | None = None) -> list:
+    parts = record.get(f"{section}_parts")
+    if parts is None and bank is not None:
+        parts = infer_record_parts(record, section, bank)
+    return parts or []
+
+
+def index_result_parts(index: dict, record: dict, banks: dict | None = None):
+    """Natijani part -> {kalit izi: [session_id, ...]} indeksiga qo'shadi."""
+    sid = record.get("session_id")
+    if not sid:
+        return
+    parts_index = index.setdefault("parts", {})
+    for section in RESULT_SECTIONS:
+        for info in record_parts(record, section, (banks or {}).get(section)):
+            by_key = parts_index.setdefault(part_index_key(section, info["source"], info["part"]), {})
+            sids = by_key.setdefault(info.get("key") or "", [])
+            if sid not in sids:
+                sids.append(sid)
+
+
+def move_indexed_result(index: dict, section: str, info: dict, sid: str, new_key: str):
+    """Qayta baholangan natijani part indeksida yangi kalit izi ostiga ko'chiradi."""
+    by_key = index.setdefault("parts", {}).setdefault(part_index_key(section, info["source"], info["part"]), {})
+    old = by_key.get(info.get("key") or "")
+    if old and sid in old:
+        old.remove(sid)
+        if not old:
+            del by_key[info.get("key") or ""]
+    sids = by_key.setdefault(new_key, [])
+    if sid not in sids:
+        sids.append(sid)
+
+
+def load_result_part_index() -> dict | None:
+    """Indeks hali qurilmagan bo'lsa None (uni `manage.py rescore-results` birinchi o'tishda quradi)."""
+    if not (DATA_DIR / RESULT_PART_INDEX_FILE).exists():
+        return None
+    index = load_json(RESULT_PART_INDEX_FILE)
+    index.setdefault("parts", {})
+    return index
+
+
+def stale_result_sessions(index: dict, banks: dict) -> Dict[str, set]:
+    """Kaliti o'zgargan partlar va ularni o'z ichiga olgan natijalar: index kaliti -> {session_id}."""
+    stale = {}
+    for key, by_key in index.get("parts", {}).items():
+        section = key.split("|", 1)[0]
+        entry = banks.get(section, {}).get(key)
+        if entry is None:
+            continue  # part bankdan o'chirilgan — qayta baholashga kalit yo'q
+        sids = {sid for fp, group in by_key.items() if fp != entry["key"] for sid in group}
+        if sids:
+            stale[key] = sids
+    return stale
+
+
+def rescore_record(record: dict, banks: dict) -> dict | None:
+    """Natijaning kaliti o'zgargan partlarini saqlangan javoblar (ua) bo'yicha joriy kalit bilan qayta baholaydi.
+    Joyida yangilaydi va diff qaytaradi; o'zgartiradigan narsa bo'lmasa None."""
+    diff = {"session_id": record.get("session_id"), "user_id": record.get("user_id"), "sections": {}}
+    touched = False
+    for section in RESULT_SECTIONS:
+        bank = banks.get(section, {})
+        parts = record_parts(record, section, bank)
+        details = record.get(f"{section}_details") or []
+        redo = {}
+        for info in parts:
+            entry = bank.get(part_index_key(section, info["source"], info["part"]))
+            if entry is not None and entry["key"] != info.get("key"):
+                redo[info["part"]] = entry
+        if not redo:
+            if parts and f"{section}_parts" not in record:
+                record[f"{section}_parts"] = parts
+            continue
+        touched = True
+        old_ok = {(d.get("part"), str(d.get("q"))): d.get("ok") for d in details}
+        new_details, emitted = [], set()
+        for d in details:
+            pn = d.get("part")
+            if pn not in redo:
+                new_details.append(d)
+            elif pn not in emitted:
+                emitted.add(pn)
+                answers = {str(x.get("q")): x.get("ua") or "" for x in details if x.get("part") == pn}
+                new_details.extend(score_answers(answers, {"parts": [redo[pn]["part"]]}, section)["details"])
+        changed = [
+            {"part": d["part"], "q": d["q"], "ua": d["ua"], "ca": d["ca"], "ok": [old_ok.get((d["part"], d["q"])), d["ok"]]}
+            for d in new_details
+            if d.get("part") in redo and old_ok.get((d["part"], d["q"])) != d["ok"]
+        ]
+        correct = sum(1 for d in new_details if d.get("ok"))
+        total = len(new_details)
+        pct = round(correct / total * 100, 1) if total else 0
+        if record.get(f"{section}_theta") is not None:
+            # Adaptiv bo'lim: foiz theta dan olinadi
+            theta, se, pct = adaptive_estimate(section, new_details, parts)
+            record[f"{section}_theta"], record[f"{section}_se"] = round(theta, 3), round(se, 3)
+        diff["sections"][section] = {
+            "parts": sorted(part_index_key(section, e["part"]["_source_test_id"], pn) for pn, e in redo.items()),
+            "score": [record.get(f"{section}_score"), correct],
+            "percentage": [record.get(f"{section}_percentage"), pct],
+            "questions": changed,
+        }
+        record[f"{section}_details"] = new_details
+        record[f"{section}_score"] = correct
+        record[f"{section}_total"] = total
+        record[f"{section}_percentage"] = pct
+        record[f"{section}_parts"] = [
+            dict(info, key=redo[info["part"]]["key"]) if info["part"] in redo else info for info in parts
+        ]
+    if not touched:
+        return None
+    final = calc_final(record.get("reading_percentage", 0) or 0, record.get("listening_percentage", 0) or 0,
+                       record.get("writing_percentage", 0) or 0)
+    diff["overall_score"] = [record.get("overall_score"), final["overall_percentage"]]
+    diff["cefr_level"] = [record.get("cefr_level"), final["cefr_level"]]
+    record["overall_score"] = final["overall_percentage"]
+    record["cefr_level"] = final["cefr_level"]
+    record["level_description"] = final["level_description"]
+    return diff
+
+
+def stale_result_count(section: str) -> int:
+    """Admin saqlagandan keyin: shu bo'limda kaliti eskirgan natijalar soni (indeks bo'lmasa -1)."""
+    index = load_result_part_index()
+    if index is None:
+        return -1
+    stale = stale_result_sessions(index, {section: answer_key_bank(section)})
+    return len(set().union(*stale.values())) if stale else 0
+
+
+# ============ ITEM STATISTIKASI (facility, distraktorlar, point-biserial) ============
+
+# Har bir savol (bo'lim|manba test|part|savol) uchun yig'indilar saqlanadi — natija qo'shilganda faqat shu yig'indilar
+# yangilanadi, tarix qayta o'qilmaydi. Mezon sifatida "qolgan ball" (bo'limdagi boshqa savollardagi to'g'ri javoblar ulushi)
+# olinadi, shuning uchun discrimination — tuzatilgan item-total point-biserial.
+ITEM_STATS_FILE = "item_stats.json"
+ITEM_MAX_OPTIONS = 12  # savol bo'yicha alohida sanaladigan javob variantlari; keyingi yangi javoblar "_other" ga
+ITEM_OTHER_OPTION = "_other"
+ITEM_MIN_RESPONSES = 20  # bundan kam javobda statistika ishonchsiz deb belgilanadi
+
+
+def item_key(section: str, source: str, part_number, q) -> str:
+    return f"{section}|{source}|{part_number}|{q}"
+
+
+def result_item_rows(record: dict, banks: dict | None = None):
+    """Natijadagi har bir javob: (item kaliti, to'g'ri (0/1), qolgan ball ulushi, javob, kalit).
+    Part manbasi noma'lum javoblar o'tkazib yuboriladi."""
+    for section in RESULT_SECTIONS:
+        sources = {info["part"]: info["source"] for info in record_parts(record, section, (banks or {}).get(section))}
+        if not sources:
+            continue
+        details = record.get(f"{section}_details") or ()
+        total = len(details)
+        correct = sum(1 for d in details if d.get("ok"))
+        for d in details:
+            source = sources.get(d.get("part"))
+            if source is None:
+                continue
+            x = 1 if d.get("ok") else 0
+            rest = (correct - x) / (total - 1) if total > 1 else 0.0
+            yield item_key(section, source, d.get("part"), d.get("q")), x, rest, d.get("ua") or "", d.get("ca") or ""
+
+
+def _new_item_entry(ca: str) -> dict:
+    return {"ca": ca, "n": 0, "correct": 0, "sum_r": 0.0, "sum_rr": 0.0, "sum_xr": 0.0, "options": {}}
+
+
+def update_item_stats(stats: dict, record: dict, banks: dict | None = None) -> int:
+    """Bitta natijani yig'indilarga qo'shadi; qo'shilgan javoblar sonini qaytaradi."""
+    items = stats.setdefault("items", {})
+    added = 0
+    for key, x, rest, ua, ca in result_item_rows(record, banks):
+        entry = items.get(key)
+        if entry is None:
+            entry = items[key] = _new_item_entry(ca)
+        entry["ca"] = ca
+        entry["n"] += 1
+        entry["correct"] += x
+        entry["sum_r"] += rest
+        entry["sum_rr"] += rest * rest
+        entry["sum_xr"] += x * rest
+        options = entry["options"]
+        if ua not in options and len(options) >= ITEM_MAX_OPTIONS:
+            ua = ITEM_OTHER_OPTION
+        options[ua] = options.get(ua, 0) + 1
+        added += 1
+    stats["results"] = stats.get("results", 0) + (1 if added else 0)
+    stats["responses"] = stats.get("responses", 0) + added
+    return added
+
+
+def item_discrimination(n: int, correct: int, sum_r: float, sum_rr: float, sum_xr: float) -> float | None:
+    """Point-biserial: cov(x, r) / sqrt(var(x) * var(r)) — yig'indilardan hisoblanadi."""
+    if n < 2:
+        return None
+    p = correct / n
+    mean_r = sum_r / n
+    var_x = p * (1 - p)
+    var_r = sum_rr / n - mean_r * mean_r
+    if var_x <= 0 or var_r <= 1e-12:
+        return None
+    return (sum_xr / n - p * mean_r) / math.sqrt(var_x * var_r)
+
+
+def item_stats_summary(key: str, entry: dict) -> dict:
+    section, source, part, q = key.split("|", 3)
+    n = entry["n"]
+    facility = entry["correct"] / n if n else None
+    disc = item_discrimination(n, entry["correct"], entry["sum_r"], entry["sum_rr"], entry["sum_xr"])
+    options = sorted(entry["options"].items(), key=lambda kv: -kv[1])
+    flags = []
+    if n < ITEM_MIN_RESPONSES:
+        flags.append("few_responses")
+    else:
+        if facility is not None and facility > 0.9:
+            flags.append("too_easy")
+        if facility is not None and facility < 0.2:
+            flags.append("too_hard")
+        if disc is not None and disc < 0.2:
+            flags.append("low_discrimination")
+        # Eng ko'p tanlangan noto'g'ri javob to'g'ri javobdan ko'p tanlansa — kalit xato bo'lishi mumkin
+        wrong = [(ua, c) for ua, c in options if ua != entry["ca"] and ua not in ("", ITEM_OTHER_OPTION)]
+        if wrong and wrong[0][1] > entry["correct"]:
+            flags.append("distractor_beats_key")
+    return {
+        "item": key, "section": section, "source": source, "part": int(part) if part.isdigit() else part, "q": q,
+        "ca": entry["ca"], "n": n,
+        "facility": round(facility, 3) if facility is not None else None,
+        "discrimination": round(disc, 3) if disc is not None else None,
+        "options": [{"answer": ua, "count": c, "share": round(c / n, 3)} for ua, c in options],
+        "flags": flags,
+    }
+
+
+def load_item_stats() -> dict:
+    stats = load_json(ITEM_STATS_FILE)
+    stats.setdefault("items", {})
+    return stats
+
+
+def record_item_stats(record: dict):
+    """save_test_result dan: yangi natijani item statistikasiga qo'shadi."""
+    stats = load_item_stats()
+    if update_item_stats(stats, record):
+        stats["updated_at"] = datetime.now().isoformat()
+        save_json(ITEM_STATS_FILE, stats)
+
+
+def item_stats_report(section: str | None = None, source: str | None = None, part: int | None = None,
+                      flagged: bool = False) -> list:
+    rows = []
+    for key, entry in load_item_stats()["items"].items():
+        s, src, pn, _q = key.split("|", 3)
+        if (section and s != section) or (source and src != source) or (part is not None and pn != str(part)):
+            continue
+        row = item_stats_summary(key, entry)
+        if flagged and not row["flags"]:
+            continue
+        rows.append(row)
+    rows.sort(key=lambda r: (r["section"], r["source"], str(r["part"]).zfill(3), r["q"].zfill(4)))
+    return rows
+
+
+# ============ ADAPTIV TEST (CAT) ============
+
+# Adaptiv rejimda bo'lim bitta-bitta part bilan beriladi: har topshirilgan partdan keyin qobiliyat (theta) bahosi
+# yangilanadi va keyingi part shu theta da eng ko'p informatsiya beradigani bo'ladi. O'lchash aniqligi
+# (posterior standart og'ish) maqsadga yetganda bo'lim tugaydi. Savol parametrlari `manage.py calibrate-irt`
+# test bankiga yozgan `irt` blokidan, kalibrlanmagan savollar uchun item statistikasidagi facility dan olinadi.
+ADAPTIVE_TESTING = os.getenv("ADAPTIVE_TESTING", "0") == "1"  # standart rejim; ?mode=adaptive|fixed bilan sessiya uchun
+ADAPTIVE_TARGET_SE = float(os.getenv("ADAPTIVE_TARGET_SE", "0.35"))
+ADAPTIVE_MIN_PARTS = int(os.getenv("ADAPTIVE_MIN_PARTS", "2"))
+SECTION_SLOTS = {"reading": 5, "listening": 6}
+THETA_GRID = tuple(-4.0 + 0.25 * i for i in range(33))
+_THETA_LOG_PRIOR = tuple(-0.5 * t * t for t in THETA_GRID)  # N(0, 1)
+
+
+def item_parameters(section: str) -> Dict[str, tuple]:
+    """Savol kaliti -> (a, b). Kalibrlangan `irt` bloki bo'lmasa: b = -logit(facility), a = 1; statistika ham bo'lmasa (1, 0)."""
+    params: Dict[str, tuple] = {}
+    tests = get_reading_tests() if section == "reading" else get_listening_tests()
+    for test in tests:
+        for pq, p in ((test.get("irt") or {}).get("items") or {}).items():
+            part, q = pq.split("|", 1)
+            params[item_key(section, test.get("id", ""), part, q)] = (float(p.get("a", 1.0)), float(p.get("b", 0.0)))
+    for key, entry in load_item_stats()["items"].items():
+        if key.startswith(section + "|") and key not in params and entry["n"] >= ITEM_MIN_RESPONSES:
+            facility = min(max(entry["correct"] / entry["n"], 0.02), 0.98)
+            params[key] = (1.0, -math.log(facility / (1 - facility)))
+    return params
+
+
+class ItemInformationIndex:
+    """Bo'lim partlarining theta to'ri (THETA_GRID) bo'yicha oldindan hisoblangan informatsiyasi.
+
+    Har bir to'r nuqtasi uchun partlar informatsiya kamayishi tartibida saralangan — keyingi partni tanlash
+    ro'yxat boshidan birinchi mos kelganini olishdan iborat. Savollar uchun log P va log(1 - P) ham
+    saqlanadi, theta bahosi ular bilan yangilanadi.
+    """
+
+    def __init__(self, section: str, generation: int, bank: dict | None = None, params: dict | None = None):
+        self.section = section
+        self.generation = generation
+        self.parts: Dict[str, dict] = {}
+        params = item_parameters(section) if params is None else params
+        bank_p = [0.0] * len(THETA_GRID)
+        bank_items = 0
+        for key, entry in (answer_key_bank(section) if bank is None else bank).items():
+            part = entry["part"]
+            pn = part.get("part_number")
+            if not isinstance(pn, int) or not 1 <= pn <= SECTION_SLOTS[section] or not entry["items"]:
+                continue
+            if not _part_fits_slot(section, pn, part.get("type")):
+                continue
+            info = [0.0] * len(THETA_GRID)
+            items = {}
+            for qn, _ca, _case, _match, _pn in entry["items"]:
+                a, b = params.get(item_key(section, part["_source_test_id"], pn, qn), (1.0, 0.0))
+                log_p, log_q = [], []
+                for g, theta in enumerate(THETA_GRID):
+                    p = 1 / (1 + math.exp(-a * (theta - b)))
+                    info[g] += a * a * p * (1 - p)
+                    bank_p[g] += p
+                    log_p.append(math.log(p))
+                    log_q.append(math.log(1 - p))
+                items[qn] = (log_p, log_q)
+                bank_items += 1
+            self.parts[key] = {"part": part, "slot": pn, "items": items, "info": info}
+        # Teng informatsiyali partlar (masalan, hali kalibrlanmagan) orasida tanlov tasodifiy bo'lsin
+        order = list(self.parts)
+        random.shuffle(order)
+        self.ranked = [
+            sorted(order, key=lambda k, g=g: -self.parts[k]["info"][g]) for g in range(len(THETA_GRID))
+        ]
+        self.expected_pct = [100 * p / bank_items if bank_items else 0.0 for p in bank_p]
+
+    def best(self, theta: float, administered, used_slots, seen_ids=()) -> str | None:
+        """theta ga eng yaqin to'r nuqtasida eng informativ, hali berilmagan va sloti bo'sh part (ko'rilmaganlari avval)."""
+        g = min(range(len(THETA_GRID)), key=lambda i: abs(THETA_GRID[i] - theta))
+        fallback = None
+        for key in self.ranked[g]:
+            entry = self.parts[key]
+            if key in administered or entry["slot"] in used_slots:
+                continue
+            if entry["part"]["_source_test_id"] + "_" + str(entry["slot"]) not in seen_ids:
+                return key
+            if fallback is None:
+                fallback = key
+        return fallback
+
+
+_information_index: Dict[tuple, ItemInformationIndex] = {}
+
+
+def get_information_index(section: str, snapshot: BankSnapshot | None = None) -> ItemInformationIndex:
+    """Bank versiyasi uchun indeks (standart: joriy versiya); o'chirilgan versiyalarning indekslari tashlanadi."""
+    _refresh_answer_key_cache()
+    snapshot = snapshot or current_bank(section)
+    ck = (section, snapshot.version)
+    index = _information_index.get(ck)
+    if index is None or index.generation != _answer_key_generation:
+        for stale in [k for k in _information_index if k[0] == section and k[1] not in _bank_snapshots[section]]:
+            del _information_index[stale]
+        index = _information_index[ck] = ItemInformationIndex(
+            section, _answer_key_generation, bank=answer_key_bank(section, snapshot))
+    return index
+
+
+def estimate_theta(loglik: list) -> tuple:
+    """EAP baho: N(0, 1) prior va to'rdagi log-likelihood dan (theta, posterior SD)."""
+    logs = [lp + ll for lp, ll in zip(_THETA_LOG_PRIOR, loglik)]
+    top = max(logs)
+    weights = [math.exp(v - top) for v in logs]
+    total = sum(weights)
+    mean = sum(w * t for w, t in zip(weights, THETA_GRID)) / total
+    var = sum(w * (t - mean) ** 2 for w, t in zip(weights, THETA_GRID)) / total
+    return mean, math.sqrt(var)
+
+
+def theta_percentage(index: ItemInformationIndex, theta: float) -> float:
+    """theta dagi kutilgan natija butun bank bo'yicha (%) — adaptiv bo'lim foizi qat'iy test foizi bilan solishtiriladigan bo'ladi."""
+    grid, pct = THETA_GRID, index.expected_pct
+    if theta <= grid[0]:
+        return round(pct[0], 1)
+    if theta >= grid[-1]:
+        return round(pct[-1], 1)
+    i = int((theta - grid[0]) / (grid[1] - grid[0]))
+    frac = (theta - grid[i]) / (grid[1] - grid[0])
+    return round(pct[i] + (pct[i + 1] - pct[i]) * frac, 1)
+
+
+def adaptive_loglik(index: ItemInformationIndex, key: str, details: list, loglik: list | None = None) -> list:
+    """Part javoblarini theta to'ridagi log-likelihood ga qo'shadi."""
+    loglik = list(loglik) if loglik else [0.0] * len(THETA_GRID)
+    items = index.parts[key]["items"]
+    for d in details:
+        curves = items.get(d["q"])
+        if curves is None:
+            continue
+        curve = curves[0] if d["ok"] else curves[1]
+        for g in range(len(loglik)):
+            loglik[g] += curve[g]
+    return loglik
+
+
+def adaptive_mode(request: Request, s: dict) -> bool:
+    mode = request.query_params.get("mode")
+    if mode in ("adaptive", "fixed"):
+        s["test_mode"] = mode
+    return s.get("test_mode", "adaptive" if ADAPTIVE_TESTING else "fixed") == "adaptive"
+
+
+def adaptive_next_test(section: str, s: dict, user: dict | None) -> dict | None:
+    """Adaptiv bo'limning navbatdagi partini (bir partli test) qaytaradi; bo'lim tugagan bo'lsa None."""
+    state = s.setdefault("adaptive", {}).get(section)
+    index = get_information_index(section, pin_bank_version(s, section, refresh=state is None))
+    if state is None:
+        state = s["adaptive"][section] = {
+            "started": time.time(), "loglik": None, "theta": 0.0, "se": 1.0,
+            "administered": [], "details": [], "parts": [], "current": None,
+        }
+    if state.get("done"):
+        return None
+    limit = 60 if section == "reading" else 40
+    tests = get_reading_tests() if section == "reading" else get_listening_tests()
+    if tests:
+        limit = tests[0].get("time_limit", limit)
+    remaining = limit * 60 - (time.time() - state["started"])
+    if remaining <= 0:
+        # Bo'lim vaqti tugadi: yangi part berilmaydi, bo'lim shu paytgacha javob berilganlar bo'yicha yakunlanadi
+        finish_adaptive_section(section, s)
+        return None
+    key = state["current"]
+    if key is None or key not in index.parts:
+        seen_ids = set((user or {}).get(f"seen_{section}_parts") or ())
+        used_slots = {index.parts[k]["slot"] for k in state["administered"] if k in index.parts}
+        key = index.best(state["theta"], set(state["administered"]), used_slots, seen_ids)
+        if key is None:
+            return None
+        state["current"] = key
+        record_part_exposure(section, [index.parts[key]["part"]])
+    return {
+        "id": section + "_adaptive",
+        "title": (tests[0].get("title") if tests else None) or section.capitalize() + " Test",
+        "time_limit": math.ceil(remaining / 60),
+        "time_left_s": int(remaining),  # sahifa taymeri bo'limning qolgan vaqtidan (daqiqaga yaxlitlanmagan)
+        "parts": [dict(index.parts[key]["part"])],
+        "adaptive": {"step": len(state["administered"]) + 1, "theta": round(state["theta"], 2), "se": round(state["se"], 2)},
+    }
+
+
+def adaptive_submit(section: str, s: dict, answers: Dict[str, str], user: dict | None) -> dict:
+    """Joriy partni baholaydi, theta ni yangilaydi va to'xtash qoidasini tekshiradi.
+    Qaytaradi: {"done": bool, "part": berilgan part (ko'rilganlarga belgilash uchun)}."""
+    state = (s.get("adaptive") or {}).get(section)
+    index = get_information_index(section, pin_bank_version(s, section))
+    key = state and state.get("current")
+    if not key or key not in index.parts:
+        # Berilgan part bankdan o'chirilgan bo'lsa, sahifa keyingisini oladi
+        if state:
+            state["current"] = None
+        return {"done": False, "part": None}
+    part = index.parts[key]["part"]
+    result = score_answers(answers, {"parts": [part]}, section)
+    state["loglik"] = adaptive_loglik(index, key, result["details"], state["loglik"])
+    state["theta"], state["se"] = estimate_theta(state["loglik"])
+    state["administered"].append(key)
+    state["details"].extend(result["details"])
+    state["parts"].extend(scored_parts({"parts": [part]}, section))
+    state["current"] = None
+    print(f"[CAT] {section} {len(state['administered'])}-part: theta={state['theta']:.2f} se={state['se']:.2f}")
+    precise = state["se"] <= ADAPTIVE_TARGET_SE and len(state["administered"]) >= ADAPTIVE_MIN_PARTS
+    if precise or len(state["administered"]) >= SECTION_SLOTS[section] or adaptive_next_test(section, s, user) is None:
+        finish_adaptive_section(section, s)
+        return {"done": True, "part": part}
+    return {"done": False, "part": part}
+
+
+def finish_adaptive_section(section: str, s: dict):
+    """Bo'limni yakunlaydi: s[section] oddiy rejimdagi bilan bir xil ko'rinishda (foiz theta dan)."""
+    index = get_information_index(section, pin_bank_version(s, section))
+    state = s["adaptive"][section]
+    state["done"] = True
+    state["current"] = None
+    details = state["details"]
+    correct = sum(1 for d in details if d["ok"])
+    s[section] = {
+        "completed": True, "score": correct, "total": len(details),
+        "percentage": theta_percentage(index, state["theta"]), "details": details, "parts": state["parts"],
+        "theta": round(state["theta"], 3), "se": round(state["se"], 3), "adaptive": True,
+    }
+
+
+def adaptive_estimate(section: str, details: list, parts: list) -> tuple:
+    """Saqlangan javoblardan (theta, se, foiz) ni joriy parametrlar bilan qaytadan hisoblaydi (qayta baholashda)."""
+    index = get_information_index(section)
+    sources = {info["part"]: part_index_key(section, info["source"], info["part"]) for info in parts}
+    by_key: Dict[str, list] = {}
+    for d in details:
+        key = sources.get(d.get("part"))
+        if key in index.parts:
+            by_key.setdefault(key, []).append(d)
+    loglik = None
+    for key, part_details in by_key.items():
+        loglik = adaptive_loglik(index, key, part_details, loglik)
+    theta, se = estimate_theta(loglik or [0.0] * len(THETA_GRID))
+    return theta, se, theta_percentage(index, theta)
+
+
+# ============ INGLIZ TILI LUG'ATI (LEXICON) ============
+
+# Bitta faylda ~27 ming so'z (shakllari bilan: -s, -ed, -ing, -er, -ly, noto'g'ri fe'llar); kichik harfda, har qatorda bittadan
+ENGLISH_WORDS_FILE = DATA_DIR / "english_words.txt"
+LEXICON_BACKEND = os.getenv("LEXICON_BACKEND", "set")  # set | packed
+
+
+class EnglishLexicon:
+    """So'zlar ro'yxati ustida a'zolik tekshiruvi.
+
+    backend="set"    – frozenset, O(1) qidiruv (standart).
+    backend="packed" – har bir uzunlik uchun tartiblangan so'zlar bitta satrga yopishtirilgan,
+                       binary search bilan qidiriladi; xotirani bir necha barobar kam oladi.
+    """
+
+    __slots__ = ("backend", "size", "_words", "_buckets")
+
+    def __init__(self, words, backend: str = "set"):
+        if backend not in ("set", "packed"):
+            raise ValueError(f"Noma'lum lexicon backend: {backend}")
+        self.backend = backend
+        self._words = frozenset()
+        self._buckets = {}
+        if backend == "set":
+            self._words = frozenset(words)
+            self.size = len(self._words)
+        else:
+            by_len: dict = {}
+            for w in set(words):
+                by_len.setdefault(len(w), []).append(w)
+            # uzunlik -> (yopishtirilgan so'zlar, so'zlar soni)
+            self._buckets = {n: ("".join(sorted(ws)), len(ws)) for n, ws in by_len.items()}
+            self.size = sum(cnt for _, cnt in self._buckets.values())
+
+    def __contains__(self, word: str) -> bool:
+        if self.backend == "set":
+            return word in self._words
+        n = len(word)
+        bucket = self._buckets.get(n)
+        if bucket is None:
+            return False
+        packed, cnt = bucket
+        lo, hi = 0, cnt
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = packed[mid * n:(mid + 1) * n]
+            if cur < word:
+                lo = mid + 1
+            elif cur > word:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return self.size
+
+    @classmethod
+    def from_file(cls, path: Path = ENGLISH_WORDS_FILE, backend: str = "set") -> "EnglishLexicon":
+        with open(path, "r", encoding="utf-8") as f:
+            words = [w for w in (line.strip().lower() for line in f) if w and not w.startswith("#")]
+        return cls(words, backend)
+
+
+_english_lexicon: EnglishLexicon | None = None
+
+
+def get_english_lexicon() -> EnglishLexicon:
+    """Lug'at birinchi chaqiruvda bir marta yuklanadi va barcha detektorlar uchun umumiy."""
+    global _english_lexicon
+    if _english_lexicon is None:
+        try:
+            _english_lexicon = EnglishLexicon.from_file(ENGLISH_WORDS_FILE, LEXICON_BACKEND)
+            print(f"[Lexicon] {len(_english_lexicon)} so'z yuklandi ({LEXICON_BACKEND})")
+        except OSError as e:
+            print(f"[Lexicon] {ENGLISH_WORDS_FILE} o'qilmadi: {e} - ingliz so'zlari tekshiruvi o'chirildi")
+            _english_lexicon = EnglishLexicon((), "set")
+    return _english_lexicon
+
+
+# ============ WRITING: MATN XUSUSIYATLARI (bir o'tishda) ============
+
+# Spam tekshiruvida eng ko'p uchraydigan so'z hisobidan chiqariladigan yordamchi so'zlar
+SPAM_STOPWORDS = frozenset({'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'must', 'shall', 'can', 'to', 'of', 'in', 'for', 'on', 'with', 'at', 'by', 'from', 'and', 'or', 'but', 'if', 'that', 'this', 'it', 'i', 'you', 'we', 'they', 'he', 'she'})
+
+_WORD_PUNCT = '.,!?;:"\'()[]{}'
+_SENTENCE_SPLIT = re.compile(r'[.!?]+')
+_LINE_SENTENCE_SPLIT = re.compile(r'[.!?\n]+')
+_VOWELS = frozenset("aeiou")
+
+
+@dataclass(frozen=True, slots=True)
+class TextFeatures:
+    """Bitta matn uchun bir marta hisoblanadigan xususiyatlar – barcha writing scorerlari shuni ishlatadi."""
+    text: str
+    tokens: tuple                 # text.split()
+    lower: tuple                  # tokens ning kichik harfli ko'rinishi
+    counts: Mapping[str, int]     # lower bo'yicha chastota
+    diversity: float              # unikal lower / so'zlar soni
+    alpha_chars: int              # matndagi harflar soni
+    alpha_words: int              # faqat harflardan iborat tokenlar soni
+    alpha_unique: int             # ulardan unikal (kichik harfda)
+    content_words: int            # harfli va 3 harfdan uzun tokenlar
+    weird_words: int              # 15+ harfli yoki unlisiz (3+ harf) so'zlar
+    clean_counts: Mapping[str, int]  # tinish belgilarsiz, faqat harfli so'zlar chastotasi
+    english_ratio: float | None   # clean so'zlarning lug'atdagi ulushi (lug'at bo'sh bo'lsa None)
+    sentences: tuple              # [.!?]+ bo'yicha bo'laklar (strip, bo'sh emas)
+    sentence_words: tuple         # har bir bo'lakdagi so'zlar soni
+    line_sentences: tuple         # [.!?\n]+ bo'yicha bo'laklar (strip, kichik harf, bo'sh emas)
+    line_sentence_words: tuple
+    paragraphs: int               # 10 belgidan uzun qatorlar soni
+    ngram_max: tuple              # NGRAM_SIZES (2, 3, 4)-gramlarning eng ko'p takrorlanish soni
+    repeat_span: tuple            # eng uzun takrorlangan bo'lak: (so'zlar soni, 1-pozitsiya, 2-pozitsiya)
+
+    @property
+    def wc(self) -> int:
+        return len(self.tokens)
+
+
+# N-gram takrorlanishi: token ID lar ustida rolling hash, satr yaratilmaydi
+NGRAM_SIZES = (2, 3, 4)
+_SPAN_HASH_MOD = (1 << 61) - 1
+_SPAN_HASH_BASE = 1_000_003
+REPEAT_TEXT_MAX_WORDS = 30  # hisobotda takrorlangan bo'lakning ko'rsatiladigan qismi
+
+
+def token_ids(lower) -> tuple:
+    """Har bir so'zga bir marta butun son ID beradi – (ids, lug'at hajmi)."""
+    vocab: dict = {}
+    ids = [vocab.setdefault(w, len(vocab)) for w in lower]
+    return ids, len(vocab)
+
+
+def ngram_repeat_counts(ids: list, vocab_size: int) -> tuple:
+    """Bitta o'tishda 2-, 3- va 4-gramlarning eng ko'p takrorlanish soni.
+
+    n-gram kaliti = (n-1)-gram kaliti * vocab_size + token ID (asosi lug'at hajmi bo'lgan polinom) –
+    har bir pozitsiyada oldingi kalitlardan hisoblanadi, satr yaratilmaydi va to'qnashuv bo'lmaydi.
+    """
+    base = vocab_size or 1
+    f2: dict = {}
+    f3: dict = {}
+    f4: dict = {}
+    m2 = m3 = m4 = 0
+    h1 = h2 = h3 = -1  # oldingi pozitsiyada tugagan 1-, 2-, 3-gram kalitlari (-1 = hali yo'q)
+    for t in ids:
+        if h3 >= 0:
+            k = h3 * base + t
+            c = f4.get(k, 0) + 1
+            f4[k] = c
+            if c > m4:
+                m4 = c
+        if h2 >= 0:
+            k = h2 * base + t
+            c = f3.get(k, 0) + 1
+            f3[k] = c
+            if c > m3:
+                m3 = c
+            h3 = k
+        if h1 >= 0:
+            k = h1 * base + t
+            c = f2.get(k, 0) + 1
+            f2[k] = c
+            if c > m2:
+                m2 = c
+            h2 = k
+        h1 = t
+    return m2, m3, m4
+
+
+def _span_hashes(ids: list, length: int):
+    """Uzunligi length bo'lgan barcha oynalar uchun polinomial rolling hash (mod 2^61-1)."""
+    mod, base = _SPAN_HASH_MOD, _SPAN_HASH_BASE
+    high = pow(base, length - 1, mod)
+    h = 0
+    for i, t in enumerate(ids):
+        if i >= length:
+            h = (h - (ids[i - length] + 1) * high) % mod
+        h = (h * base + t + 1) % mod
+        if i >= length - 1:
+            yield i - length + 1, h
+
+
+def _find_repeat(ids: list, length: int):
+    seen: dict = {}
+    for start, h in _span_hashes(ids, length):
+        for other in seen.get(h, ()):
+            if ids[other:other + length] == ids[start:start + length]:
+                return other, start
+        seen.setdefault(h, []).append(start)
+    return None
+
+
+def longest_repeated_span(ids: list, ngram_max: tuple | None = None) -> tuple:
+    """Matnda kamida ikki marta uchraydigan eng uzun so'zlar ketma-ketligi – (uzunlik, 1-pozitsiya, 2-pozitsiya).
+
+    ngram_max (2/3/4-gram takrorlari) ma'lum bo'lsa, 4 so'zgacha uzunlik qo'shimcha qidiruvsiz aniqlanadi;
+    undan uzunlari uchun rolling hash bilan eksponensial + binary search (hash mos kelsa bo'lak taqqoslanadi).
+    """
+    if len(ids) < 2:
+        return (0, -1, -1)
+    if ngram_max is None:
+        ngram_max = ngram_repeat_counts(ids, max(ids) + 1)
+    repeated = [len(set(ids)) < len(ids)] + [m >= 2 for m in ngram_max]
+    length = 0
+    while length < len(repeated) and repeated[length]:
+        length += 1
+    if length == 0:
+        return (0, -1, -1)
+    found = _find_repeat(ids, length)
+    if length == len(repeated):
+        # 4+ so'zli takror bor: uzunlikni ikki baravardan oshirib, keyin binary search
+        lo, hi = length + 1, len(ids) - 1
+        probe = length * 2
+        while probe <= hi:
+            hit = _find_repeat(ids, probe)
+            if not hit:
+                hi = probe - 1
+                break
+            length, found = probe, hit
+            lo = probe + 1
+            probe *= 2
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            hit = _find_repeat(ids, mid)
+            if hit:
+                length, found = mid, hit
+                lo = mid + 1
+            else:
+                hi = mid - 1
+    return (length, found[0], found[1])
+
+
+def detect_repetition(text: str, features: TextFeatures | None = None) -> dict:
+    """Takrorlanish hisobotini qaytaradi: n-gramlarning eng ko'p takrori va eng uzun takrorlangan bo'lak."""
+    f = features or extract_text_features(text)
+    length, first, second = f.repeat_span
+    shown = f.tokens[first:first + min(length, REPEAT_TEXT_MAX_WORDS)] if length else ()
+    return {
+        "ngram_max": dict(zip(NGRAM_SIZES, f.ngram_max)),
+        "longest_repeat": {
+            "words": length,
+            "text": " ".join(shown) + (" ..." if length > REPEAT_TEXT_MAX_WORDS else ""),
+            "positions": [first, second] if length else [],
+        },
+    }
+
+
+def extract_text_features(text: str) -> TextFeatures:
+    """Matnni bir marta tahlil qiladi (tokenlar, chastotalar, gaplar, n-gramlar, so'z boyligi, ingliz so'zlari ulushi)."""
+    text = text or ""
+    tokens = tuple(text.split())
+    lower = tuple(w.lower() for w in tokens)
+    ids, vocab_size = token_ids(lower)
+    ngram_max = ngram_repeat_counts(ids, vocab_size)
+    counts: dict = {}
+    alpha_words = content_words = 0
+    alpha_set = set()
+    for w, lw in zip(tokens, lower):
+        counts[lw] = counts.get(lw, 0) + 1
+        if w.isalpha():
+            alpha_words += 1
+            alpha_set.add(lw)
+            if len(lw) > 3:
+                content_words += 1
+
+    lexicon = get_english_lexicon()
+    clean_counts: dict = {}
+    weird = clean_total = known = 0
+    for w, c in counts.items():
+        if len(w) > 15 or (len(w) > 2 and _VOWELS.isdisjoint(w)):
+            weird += c
+        cw = w.strip(_WORD_PUNCT)
+        if cw.isalpha():
+            clean_counts[cw] = clean_counts.get(cw, 0) + c
+            clean_total += c
+            if cw in lexicon:
+                known += c
+
+    sentences = tuple(s for s in (p.strip() for p in _SENTENCE_SPLIT.split(text)) if s)
+    line_sentences = tuple(s for s in (p.strip().lower() for p in _LINE_SENTENCE_SPLIT.split(text)) if s)
+    wc = len(tokens)
+    return TextFeatures(
+        text=text,
+        tokens=tokens,
+        lower=lower,
+        counts=MappingProxyType(counts),
+        diversity=(len(counts) / wc) if wc else 0.0,
+        alpha_chars=sum(1 for c in text if c.isalpha()),
+        alpha_words=alpha_words,
+        alpha_unique=len(alpha_set),
+        content_words=content_words,
+        weird_words=weird,
+        clean_counts=MappingProxyType(clean_counts),
+        english_ratio=((known / clean_total) if clean_total else 0.0) if len(lexicon) else None,
+        sentences=sentences,
+        sentence_words=tuple(len(s.split()) for s in sentences),
+        line_sentences=line_sentences,
+        line_sentence_words=tuple(len(s.split()) for s in line_sentences),
+        paragraphs=sum(1 for p in text.split('\n') if len(p.strip()) > 10),
+        ngram_max=ngram_max,
+        repeat_span=longest_repeated_span(ids, ngram_max),
+    )
 
 
 # ============ WRITING EVALUATION (ULTRA-STRICT) ============
 
-def detect_spam_advanced(text: str) -> dict:
+def detect_spam_advanced(text: str, features: TextFeatures | None = None) -> dict:
     """ULTRA-STRICT spam/gibberish/repetition detection - Band 0 for invalid content"""
     if not text or len(text.strip()) < 5:
         return {"is_spam": True, "score": 0, "reason": "Text is empty or nearly empty - 0%."}
 
-    words = text.split()
-    wc = len(words)
+    f = features or extract_text_features(text)
+    wc = f.wc
 
     # CRITICAL: Less than 20 words = 0% (completely invalid)
     if wc < 20:
@@ -1155,9 +2553,7 @@ def detect_spam_advanced(text: str) -> dict:
     if wc < 50:
         return {"is_spam": True, "score": 1, "reason": f"Only {wc} words - severely under minimum requirement."}
 
-    lw = [w.lower() for w in words]
-    unique = set(lw)
-    diversity = len(unique) / wc
+    diversity = f.diversity
 
     # STRICT: Any low diversity = Band 1
     if diversity < 0.2:
@@ -1166,10 +2562,9 @@ def detect_spam_advanced(text: str) -> dict:
         return {"is_spam": True, "score": 1, "reason": f"Very low vocabulary diversity ({int(diversity*100)}% unique) - Band 1."}
 
     # Check for repeated phrases/sentences - VERY STRICT
-    sentences = re.split(r'[.!?\n]+', text)
-    sentences = [s.strip().lower() for s in sentences if len(s.strip()) > 3]
+    sentences = [(s, n) for s, n in zip(f.line_sentences, f.line_sentence_words) if len(s) > 3]
     if len(sentences) >= 2:
-        unique_sents = set(sentences)
+        unique_sents = {s for s, _ in sentences}
         sent_diversity = len(unique_sents) / len(sentences)
         if sent_diversity < 0.5:
             return {"is_spam": True, "score": 1, "reason": "Repeated sentences detected - spam - Band 1."}
@@ -1177,91 +2572,57 @@ def detect_spam_advanced(text: str) -> dict:
             return {"is_spam": True, "score": 1, "reason": f"High sentence repetition ({int((1-sent_diversity)*100)}% repeated) - Band 1."}
 
     # Check for keyboard spam / random chars
-    alpha = sum(1 for c in text if c.isalpha())
-    if alpha < len(text) * 0.5:
+    if f.alpha_chars < len(text) * 0.5:
         return {"is_spam": True, "score": 1, "reason": "Too many non-alphabetic characters - Band 1."}
 
-    # Check top word frequency - STRICT
-    freq = {}
-    for w in lw:
-        freq[w] = freq.get(w, 0) + 1
-    # Exclude common words
-    common = {'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'must', 'shall', 'can', 'to', 'of', 'in', 'for', 'on', 'with', 'at', 'by', 'from', 'and', 'or', 'but', 'if', 'that', 'this', 'it', 'i', 'you', 'we', 'they', 'he', 'she'}
-    non_common_freq = {w: c for w, c in freq.items() if w not in common}
-    if non_common_freq:
-        top_word_pct = max(non_common_freq.values()) / wc
+    # Check top word frequency - STRICT (common words excluded)
+    top_non_common = max((c for w, c in f.counts.items() if w not in SPAM_STOPWORDS), default=0)
+    if top_non_common:
+        top_word_pct = top_non_common / wc
         if top_word_pct > 0.25:
             return {"is_spam": True, "score": 1, "reason": f"One word repeated {int(top_word_pct*100)}% of text - Band 1."}
 
     # Check n-gram repetition (2-word, 3-word, 4-word) - VERY STRICT
-    for n in [2, 3, 4]:
+    for n, max_ng in zip(NGRAM_SIZES, f.ngram_max):
         if wc >= n * 3:
-            ngrams = [" ".join(lw[i:i+n]) for i in range(wc - n + 1)]
-            ngram_freq = {}
-            for ng in ngrams:
-                ngram_freq[ng] = ngram_freq.get(ng, 0) + 1
-            max_ng = max(ngram_freq.values())
             threshold = 0.2 if n == 2 else 0.15 if n == 3 else 0.1
-            if max_ng > len(ngrams) * threshold:
-                return {"is_spam": True, "score": 1, "reason": f"Repeated {n}-word phrase detected ({max_ng} times) - Band 1."}
+            if max_ng > (wc - n + 1) * threshold:
+                return {"is_spam": True, "score": 1, "reason": f"Repeated {n}-word phrase detected ({max_ng} times) - Band 1.",
+                        "longest_repeat": detect_repetition(text, f)["longest_repeat"]}
 
     # Check if text is mostly the same few sentences reordered
     if len(sentences) >= 3:
-        words_per_sent = [len(s.split()) for s in sentences if s]
-        if words_per_sent:
-            avg_sent_len = sum(words_per_sent) / len(words_per_sent)
-            if avg_sent_len < 4:
-                return {"is_spam": True, "score": 1, "reason": "Sentences too short (avg < 4 words) - Band 1."}
+        avg_sent_len = sum(n for _, n in sentences) / len(sentences)
+        if avg_sent_len < 4:
+            return {"is_spam": True, "score": 1, "reason": "Sentences too short (avg < 4 words) - Band 1."}
 
     # Check for nonsense/gibberish - words not in basic English
     # (simplified check - very short words or very long words)
-    weird_words = [w for w in lw if len(w) > 15 or (len(w) > 2 and not any(c in 'aeiou' for c in w))]
-    if len(weird_words) > wc * 0.2:
+    if f.weird_words > wc * 0.2:
         return {"is_spam": True, "score": 1, "reason": "Too many nonsense/gibberish words - Band 1."}
 
-    # CRITICAL: Check if words are actual English words
-    common_english = {
-        'the', 'be', 'to', 'of', 'and', 'a', 'in', 'that', 'have', 'i', 'it', 'for', 'not', 'on', 'with', 'he', 'as', 'you', 'do', 'at',
-        'this', 'but', 'his', 'by', 'from', 'they', 'we', 'say', 'her', 'she', 'or', 'an', 'will', 'my', 'one', 'all', 'would', 'there',
-        'their', 'what', 'so', 'up', 'out', 'if', 'about', 'who', 'get', 'which', 'go', 'me', 'when', 'make', 'can', 'like', 'time', 'no',
-        'just', 'him', 'know', 'take', 'people', 'into', 'year', 'your', 'good', 'some', 'could', 'them', 'see', 'other', 'than', 'then',
-        'now', 'look', 'only', 'come', 'its', 'over', 'think', 'also', 'back', 'after', 'use', 'two', 'how', 'our', 'work', 'first', 'well',
-        'way', 'even', 'new', 'want', 'because', 'any', 'these', 'give', 'day', 'most', 'us', 'very', 'much', 'before', 'too', 'same',
-        'been', 'has', 'more', 'made', 'did', 'down', 'here', 'still', 'own', 'find', 'world', 'again', 'hand', 'part', 'place', 'during',
-        'where', 'off', 'right', 'man', 'always', 'however', 'another', 'never', 'while', 'last', 'might', 'under', 'such', 'through',
-        'life', 'being', 'long', 'little', 'got', 'those', 'great', 'old', 'many', 'must', 'home', 'big', 'around', 'high', 'each', 'read',
-        'need', 'few', 'between', 'without', 'head', 'small', 'every', 'next', 'something', 'since', 'best', 'both', 'ask', 'house',
-        'why', 'found', 'put', 'does', 'end', 'keep', 'let', 'thought', 'going', 'help', 'nothing', 'really', 'point', 'though', 'went',
-        'better', 'enough', 'money', 'school', 'told', 'turn', 'water', 'three', 'face', 'thing', 'things', 'became', 'believe', 'second',
-        'am', 'is', 'are', 'was', 'were', 'hello', 'dear', 'sincerely', 'regards', 'thanks', 'thank', 'please', 'sorry', 'hope', 'looking',
-        'forward', 'hearing', 'soon', 'write', 'writing', 'touch', 'contact', 'happy', 'sad', 'today', 'morning', 'love', 'book', 'word'
-    }
-    clean_lw = [w.strip('.,!?;:"\'()[]{}') for w in lw if w.strip('.,!?;:"\'()[]{}').isalpha()]
-    if clean_lw:
-        english_count = sum(1 for w in clean_lw if w in common_english)
-        english_ratio = english_count / len(clean_lw)
-        if english_ratio < 0.2:
+    # CRITICAL: Check if words are actual English words (to'liq lug'at bo'yicha)
+    if f.clean_counts and f.english_ratio is not None:
+        english_ratio = f.english_ratio
+        if english_ratio < 0.4:
             return {"is_spam": True, "score": 0, "reason": f"Gibberish detected - only {int(english_ratio*100)}% recognizable English words - 0%."}
-        if english_ratio < 0.3:
+        if english_ratio < 0.6:
             return {"is_spam": True, "score": 1, "reason": f"Mostly gibberish - only {int(english_ratio*100)}% recognizable English words - Band 1."}
 
     return {"is_spam": False, "score": None, "reason": None}
 
 
-def algorithmic_score(text: str, min_w: int, max_w: int, task_type: str) -> dict:
+def algorithmic_score(text: str, min_w: int, max_w: int, task_type: str, features: TextFeatures | None = None) -> dict:
     """ULTRA-STRICT algorithmic evaluation - starts at 2 (Limited User)"""
-    spam = detect_spam_advanced(text)
+    f = features or extract_text_features(text)
+    spam = detect_spam_advanced(text, f)
     if spam["is_spam"]:
-        return {"score": spam["score"], "feedback": spam["reason"], "wc": len(text.split())}
+        return {"score": spam["score"], "feedback": spam["reason"], "wc": f.wc}
 
-    words = text.split()
-    wc = len(words)
-    lw = [w.lower() for w in words if w.isalpha()]
-    unique = len(set(lw))
-    diversity = unique / wc if wc > 0 else 0
+    wc = f.wc
+    diversity = f.alpha_unique / wc if wc > 0 else 0
 
-    sentences = re.split(r'[.!?]+', text)
-    sentences = [s.strip() for s in sentences if len(s.strip()) > 2]
+    sentences = [(s, n) for s, n in zip(f.sentences, f.sentence_words) if len(s) > 2]
     num_sent = len(sentences) if sentences else 1
     avg_sl = wc / num_sent
 
@@ -1323,18 +2684,18 @@ def algorithmic_score(text: str, min_w: int, max_w: int, task_type: str) -> dict
 
     # Paragraph structure for essay - REQUIRED
     if task_type == "essay":
-        paras = [p.strip() for p in text.split('\n') if len(p.strip()) > 10]
-        if len(paras) < 2:
+        paras = f.paragraphs
+        if paras < 2:
             fb.append("No paragraph structure - max Band 3.")
             score = min(score, 3)
-        elif len(paras) < 3:
+        elif paras < 3:
             fb.append("Needs more paragraphs.")
-        elif len(paras) >= 4:
+        elif paras >= 4:
             score += 1
             fb.append("Good structure.")
 
     # Sentence repetition check - STRICT
-    sent_lower = [s.strip().lower() for s in sentences if len(s.strip()) > 5]
+    sent_lower = [s.lower() for s, _ in sentences if len(s) > 5]
     if len(sent_lower) >= 2:
         unique_s = set(sent_lower)
         ratio = len(unique_s) / len(sent_lower)
@@ -1346,8 +2707,7 @@ def algorithmic_score(text: str, min_w: int, max_w: int, task_type: str) -> dict
             fb.append("Some repetition in sentences.")
 
     # Check for real content (not just filler)
-    content_words = [w for w in lw if len(w) > 3]
-    if len(content_words) < wc * 0.4:
+    if f.content_words < wc * 0.4:
         fb.append("Too many short/filler words.")
         score -= 1
 
@@ -1355,78 +2715,709 @@ def algorithmic_score(text: str, min_w: int, max_w: int, task_type: str) -> dict
     return {"score": score, "feedback": " ".join(fb), "wc": wc}
 
 
-async def evaluate_writing_with_ai(task1: str, task2: str, essay: str, writing_test: dict) -> Dict:
-    """100% AI evaluation - NO spam detection, direct AI evaluation only"""
+# ============ WRITING: BATCH TAHLIL (process pool) ============
 
-    print(f"[Writing AI] === BAHOLASH BOSHLANDI ===")
-    print(f"[Writing AI] task1: {len(task1.split())} so'z, task2: {len(task2.split())} so'z, essay: {len(essay.split())} so'z")
-    print(f"[Writing AI] OPENAI_API_KEY mavjud: {bool(OPENAI_API_KEY)}, uzunlik: {len(OPENAI_API_KEY)}")
+# Vazifa turi bo'yicha standart so'z chegaralari (DEFAULT_WRITING bilan bir xil); item'da min_words/max_words berilsa o'shalar ishlatiladi
+WRITING_TASK_WORD_LIMITS = {"task1": (50, 500), "task2": (120, 150), "essay": (180, 200)}
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "0")) or (os.cpu_count() or 1)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
 
-    # Bo'sh yoki juda qisqa matn tekshirish (faqat 5 so'zdan kam)
-    results = {}
-    for name, txt in [("task1", task1), ("task2", task2), ("essay", essay)]:
-        wc = len(txt.split())
-        if wc < 5:
-            print(f"[Writing AI] {name}: faqat {wc} so'z - juda kam, score=0")
-            if name == "essay":
-                results[name] = {
-                    "score": 0, "band": 0, "word_count": wc, "is_valid": False,
-                    "feedback": {
-                        "overall": "Band 0 - Bo'sh",
-                        "task_achievement": f"Faqat {wc} so'z yozilgan. Minimum 20 so'z kerak.",
-                        "coherence_cohesion": "", "lexical_resource": "", "grammatical_range": ""
-                    }
-                }
-            else:
-                results[name] = {
-                    "score": 0, "band": 0, "word_count": wc, "is_valid": False,
-                    "feedback": {
-                        "overall": "Band 0 - Bo'sh",
-                        "content": f"Faqat {wc} so'z yozilgan. Minimum 20 so'z kerak.",
-                        "organization": "", "language": "", "accuracy": ""
-                    }
-                }
+_writing_pool: ProcessPoolExecutor | None = None
 
-    # AI bilan baholash - barcha qolgan qismlar
-    parts_to_eval = [n for n in ["task1", "task2", "essay"] if n not in results]
-    print(f"[Writing AI] AI baholash uchun: {parts_to_eval}")
 
-    if parts_to_eval:
-        ai_result = await try_ai_evaluation(task1, task2, essay, writing_test, parts_to_eval)
-        if ai_result:
-            print(f"[Writing AI] AI muvaffaqiyatli baholadi! Natijalar: {list(ai_result.keys())}")
-            for name in parts_to_eval:
-                if name in ai_result:
-                    results[name] = ai_result[name]
-                    print(f"[Writing AI] {name}: score={ai_result[name].get('score', '?')}")
-        else:
-            print("[Writing AI] AI baholash muvaffaqiyatsiz bo'ldi!")
-            for name in parts_to_eval:
-                txt = task1 if name == "task1" else (task2 if name == "task2" else essay)
-                wc = len(txt.split())
-                if name == "essay":
-                    results[name] = {
-                        "score": 0, "band": 0, "word_count": wc, "is_valid": False,
-                        "feedback": {
-                            "overall": "AI baholash ishlamadi",
-                            "task_achievement": "AI xizmati hozirda ishlamayapti. Qayta urinib ko'ring.",
-                            "coherence_cohesion": "OPENAI_API_KEY tekshiring.",
-                            "lexical_resource": "", "grammatical_range": ""
-                        },
-                        "ai_unavailable": True
-                    }
-                else:
-                    results[name] = {
-                        "score": 0, "band": 0, "word_count": wc, "is_valid": False,
-                        "feedback": {
-                            "overall": "AI baholash ishlamadi",
-                            "content": "AI xizmati hozirda ishlamayapti. Qayta urinib ko'ring.",
-                            "organization": "OPENAI_API_KEY tekshiring.",
-                            "language": "", "accuracy": ""
-                        },
-                        "ai_unavailable": True
+def _batch_worker_init():
+    # Har bir worker lug'atni ishga tushishda bir marta yuklaydi – birinchi matn sekinlashmasin
+    get_english_lexicon()
+
+
+def get_writing_pool() -> ProcessPoolExecutor:
+    global _writing_pool
+    if _writing_pool is None:
+        _writing_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS, initializer=_batch_worker_init)
+    return _writing_pool
+
+
+def analyze_writing_text(item: dict) -> dict:
+    """Bitta matnni algoritmik tahlil qiladi (spam, ball, takrorlanish). Process pool worker'ida ishlaydi."""
+    t0 = time.perf_counter()
+    item_id = item.get("id")
+    try:
+        text = item.get("text") or ""
+        if not isinstance(text, str):
+            raise ValueError("text satr bo'lishi kerak")
+        task_type = item.get("task_type") or "essay"
+        default_min, default_max = WRITING_TASK_WORD_LIMITS.get(task_type, WRITING_TASK_WORD_LIMITS["essay"])
+        min_w = int(item.get("min_words") or default_min)
+        max_w = int(item.get("max_words") or default_max)
+        f = extract_text_features(text)
+        spam = detect_spam_advanced(text, f)
+        scored = algorithmic_score(text, min_w, max_w, task_type, f)
+        result = {
+            "id": item_id,
+            "task_type": task_type,
+            "word_count": f.wc,
+            "is_spam": spam["is_spam"],
+            "spam_reason": spam["reason"],
+            "score": scored["score"],
+            "feedback": scored["feedback"],
+            "diversity": round(f.diversity, 3),
+            "english_ratio": round(f.english_ratio, 3) if f.english_ratio is not None else None,
+            "longest_repeat": detect_repetition(text, f)["longest_repeat"],
+        }
+    except Exception as e:
+        result = {"id": item_id, "error": str(e), "word_count": 0}
+    result["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return result
+
+
+def parse_batch_line(raw, line_no: int) -> dict:
+    """NDJSON qatori -> item. Matn o'rniga oddiy satr ham qabul qilinadi; id berilmasa qator raqami."""
+    item = json.loads(raw)
+    if isinstance(item, str):
+        item = {"text": item}
+    if not isinstance(item, dict):
+        raise ValueError("har bir qator JSON obyekt yoki satr bo'lishi kerak")
+    item.setdefault("id", line_no)
+    return item
+
+
+def summarize_batch_analysis(results: list, elapsed_s: float, workers: int, errors: int = 0) -> dict:
+    """Batch oxiridagi xulosa (trailer): soni, spam, o'tkazuvchanlik va har bir matnga ketgan vaqt."""
+    done = [r for r in results if "error" not in r]
+    item_ms = sorted(r.get("elapsed_ms", 0.0) for r in results)
+    words = sum(r.get("word_count", 0) for r in results)
+    return {
+        "items": len(results),
+        "errors": errors + (len(results) - len(done)),
+        "spam": sum(1 for r in done if r.get("is_spam")),
+        "workers": workers,
+        "elapsed_s": round(elapsed_s, 3),
+        "items_per_s": round(len(results) / elapsed_s, 1) if elapsed_s else 0.0,
+        "words_per_s": round(words / elapsed_s) if elapsed_s else 0,
+        "avg_item_ms": round(sum(item_ms) / len(item_ms), 3) if item_ms else 0.0,
+        "p95_item_ms": item_ms[min(len(item_ms) - 1, int(len(item_ms) * 0.95))] if item_ms else 0.0,
+    }
+
+
+# ============ WRITING: JONLI TAHLIL (incremental) ============
+
+# Matn segmentlarga bo'linadi: chegara faqat [.!?] + bo'shliq yoki yangi qatordan keyin qo'yiladi.
+# Shuning uchun har bir yopiq segment bo'shliq bilan tugaydi va hech bir token ikki segmentga bo'linmaydi –
+# tahrirda faqat o'zgargan segmentlar qayta tokenlanadi, qolganlarining hissasi hisoblagichlarda turadi.
+_LIVE_SEGMENT = re.compile(r'(.*?(?:[.!?]+\s+|\n\s*))|(.+)', re.DOTALL)
+LIVE_WRITING_MAX_STATES = int(os.getenv("LIVE_WRITING_MAX_STATES", "2000"))
+LIVE_WRITING_MAX_CHARS = 20000
+LIVE_OVERUSED_WORD_PCT = 0.08   # bitta (yordamchi bo'lmagan) so'z matnning shuncha qismidan ko'p bo'lsa ogohlantirish
+LIVE_REPEAT_PHRASE_WORDS = 4    # shundan uzun takrorlangan bo'lak ogohlantiriladi
+
+_live_writing_states: Dict[tuple, "LiveWritingState"] = {}
+
+
+class _LiveSegment:
+    """Bitta segmentning tokenlari va hisoblagichlarga qo'shgan hissasi."""
+    __slots__ = ("text", "closed", "tokens", "lower", "ids", "alpha", "content", "alpha_chars",
+                 "weird", "clean", "known", "sent_pieces", "line_pieces", "para_pieces")
+
+    def __init__(self, text: str, closed: bool, vocab: dict, lexicon):
+        self.text = text
+        self.closed = closed
+        self.tokens = tokens = text.split()
+        self.lower = [w.lower() for w in tokens]
+        self.ids = [vocab.setdefault(w, len(vocab)) for w in self.lower]
+        self.alpha = [lw for w, lw in zip(tokens, self.lower) if w.isalpha()]
+        self.content = sum(1 for w in self.alpha if len(w) > 3)
+        self.alpha_chars = sum(1 for c in text if c.isalpha())
+        self.weird = sum(1 for w in self.lower if len(w) > 15 or (len(w) > 2 and _VOWELS.isdisjoint(w)))
+        self.clean = [cw for cw in (w.strip(_WORD_PUNCT) for w in self.lower) if cw.isalpha()]
+        self.known = sum(1 for cw in self.clean if cw in lexicon)
+        self.sent_pieces = _SENTENCE_SPLIT.split(text)
+        self.line_pieces = _LINE_SENTENCE_SPLIT.split(text)
+        self.para_pieces = text.split('\n')
+
+
+class _JoinedView:
+    """Segmentlar split bo'laklaridan yig'ilgan ro'yxat (gaplar / qatorlar / paragraflar), tahrirda qisman yangilanadi.
+
+    Yopiq segment bo'shliq bilan tugagani uchun ajratgich chegaradan o'tmaydi: oldingi segmentning oxirgi bo'lagi
+    keyingisining birinchi bo'lagiga qo'shiladi (o'tsa ham faqat bo'sh bo'laklar qo'shiladi – ular tashlanadi).
+    Natija butun matnni split qilish bilan bir xil.
+
+    emitted[k] – k-segmentda tugagan elementlar (norm dan o'tgan, bo'shlari tashlangan), items – ularning ketma-ket
+    birlashmasi, tail – matn oxiridagi yopilmagan bo'lak.
+    """
+    __slots__ = ("attr", "norm", "emitted", "items", "tail")
+
+    def __init__(self, attr: str, norm):
+        self.attr = attr
+        self.norm = norm
+        self.emitted: list = []
+        self.items: list = []
+        self.tail: list = []
+
+    def _carry(self, segs: list, k: int) -> str:
+        """k-segmentga oldingilaridan o'tadigan yopilmagan bo'lak."""
+        parts = []
+        while k > 0:
+            k -= 1
+            pieces = getattr(segs[k], self.attr)
+            parts.append(pieces[-1])
+            if len(pieces) > 1:
+                break
+        return "".join(reversed(parts))
+
+    def splice(self, segs: list, i: int, old_n: int, new_n: int):
+        """segs[i:i+new_n] – old_n ta eski segment o'rniga kelganlar. Ular va carry o'tadigan keyingi segmentlar qayta yig'iladi."""
+        emitted, attr, norm = self.emitted, self.attr, self.norm
+        start = sum(map(len, emitted[:i]))
+        old_count = sum(map(len, emitted[i:i + old_n]))
+        emitted[i:i + old_n] = [()] * new_n
+        carry = self._carry(segs, i)
+        out: list = []
+        k = i
+        while k < len(segs):
+            pieces = getattr(segs[k], attr)
+            if k >= i + new_n:
+                old_count += len(emitted[k])
+            if len(pieces) > 1:
+                em = [x for x in map(norm, [carry + pieces[0]] + pieces[1:-1]) if x]
+                carry = pieces[-1]
+            else:
+                em = []
+                carry += pieces[0]
+            emitted[k] = em
+            out.extend(em)
+            k += 1
+            if k > i + new_n and len(pieces) > 1:
+                break  # bundan keyingi segmentlarga o'tadigan carry o'zgarmagan
+        if k == len(segs):
+            tail = norm(carry)
+            self.tail = [tail] if tail else []
+        self.items[start:start + old_count] = out
+
+
+def _norm_sentence(p: str) -> str:
+    return p.strip()
+
+
+def _norm_line(p: str) -> str:
+    return p.strip().lower()
+
+
+def _norm_paragraph(p: str) -> str:
+    p = p.strip()
+    return p if len(p) > 10 else ""
+
+
+class _NgramCounter:
+    """n-gram chastotasi + "chastotalar gistogrammasi": ayirishda ham eng ko'p takror O(1) da yangilanadi."""
+    __slots__ = ("n", "counts", "hist", "max")
+
+    def __init__(self, n: int):
+        self.n = n
+        self.counts: dict = {}
+        self.hist: dict = {}
+        self.max = 0
+
+    def update(self, ids: list, sign: int) -> bool:
+        """True – qo'shilgan n-gramlardan kamida bittasi matnda boshqa joyda ham bor (yangi takror bo'lishi mumkin)."""
+        n, counts, hist = self.n, self.counts, self.hist
+        repeated = False
+        for i in range(len(ids) - n + 1):
+            key = tuple(ids[i:i + n])
+            old = counts.get(key, 0)
+            new = old + sign
+            if old:
+                hist[old] -= 1
+            if new:
+                counts[key] = new
+                hist[new] = hist.get(new, 0) + 1
+                if new > self.max:
+                    self.max = new
+                if new >= 2 and sign > 0:
+                    repeated = True
+            else:
+                del counts[key]
+        while self.max and not hist.get(self.max):
+            self.max -= 1
+        return repeated
+
+
+def _counter_update(counter: dict, words, sign: int):
+    for w in words:
+        c = counter.get(w, 0) + sign
+        if c:
+            counter[w] = c
+        else:
+            del counter[w]
+
+
+class LiveWritingState:
+    """Bitta sessiya va vazifa uchun jonli tahlil holati.
+
+    Matn segmentlar ro'yxati sifatida saqlanadi; har bir tahrir (start, delete, insert) faqat u tekkan
+    segmentlarni (chetidagi bittadan qo'shni bilan) qayta tokenlaydi, so'z/n-gram hisoblagichlaridan eski
+    hissani ayirib yangisini qo'shadi. Natijadagi TextFeatures extract_text_features(text) bilan bir xil.
+    """
+
+    def __init__(self, task_type: str, min_w: int, max_w: int):
+        self.task_type = task_type
+        self.min_w = min_w
+        self.max_w = max_w
+        self.version = 0
+        self.text = ""
+        self.segments: List[_LiveSegment] = []
+        self.vocab: dict = {}
+        self.counts: dict = {}
+        self.alpha_counts: dict = {}
+        self.clean_counts: dict = {}
+        self.ngrams = [_NgramCounter(n) for n in NGRAM_SIZES]
+        self.wc = self.alpha_words = self.content_words = self.alpha_chars = 0
+        self.weird = self.clean_total = self.known = 0
+        self._lexicon = get_english_lexicon()
+        # butun matn bo'yicha ko'rinishlar – tahrirda faqat tegilgan segmentlar qismi almashtiriladi
+        self._tokens: list = []
+        self._lower: list = []
+        self._ids: list = []
+        self._sentences = _JoinedView("sent_pieces", _norm_sentence)
+        self._lines = _JoinedView("line_pieces", _norm_line)
+        self._paragraphs = _JoinedView("para_pieces", _norm_paragraph)
+        self._span = None       # (takror bayroqlari, repeat_span)
+        self._span_grow = False
+        self._features = None   # (version, TextFeatures)
+
+    # --- hisoblagichlar ---
+    def _account(self, seg: _LiveSegment, sign: int):
+        _counter_update(self.counts, seg.lower, sign)
+        _counter_update(self.alpha_counts, seg.alpha, sign)
+        _counter_update(self.clean_counts, seg.clean, sign)
+        self.wc += sign * len(seg.lower)
+        self.alpha_words += sign * len(seg.alpha)
+        self.content_words += sign * seg.content
+        self.alpha_chars += sign * seg.alpha_chars
+        self.weird += sign * seg.weird
+        self.clean_total += sign * len(seg.clean)
+        self.known += sign * seg.known
+
+    def _context_ids(self, i: int, step: int, need: int = NGRAM_SIZES[-1] - 1) -> list:
+        """i-segmentdan step yo'nalishida eng ko'pi need ta token ID (n-gram chegarasi uchun kontekst)."""
+        out: list = []
+        while 0 <= i < len(self.segments) and len(out) < need:
+            ids = self.segments[i].ids
+            out = (ids + out)[-need:] if step < 0 else (out + ids)[:need]
+            i += step
+        return out
+
+    def _segment(self, text: str) -> List[_LiveSegment]:
+        return [_LiveSegment(m.group(0), m.group(1) is not None, self.vocab, self._lexicon)
+                for m in _LIVE_SEGMENT.finditer(text)]
+
+    # --- tahrirlar ---
+    def reset(self, text: str):
+        """To'liq matn bilan qayta sinxronlash."""
+        self.__init__(self.task_type, self.min_w, self.max_w)
+        self.apply(0, 0, text)
+
+    def apply(self, start: int, delete: int, insert: str):
+        """text[start:start+delete] ni insert bilan almashtiradi va faqat tegishli segmentlarni qayta hisoblaydi."""
+        if start < 0 or delete < 0 or start + delete > len(self.text):
+            raise ValueError("tahrir matn chegarasidan tashqarida")
+        segs = self.segments
+        # tahrir tekkan segmentlar [i, j]; ofsetlar segment uzunliklari yig'indisidan (matn oxiriga yozish – oxirgi segment)
+        i, j, i_pos, pos = max(len(segs) - 1, 0), len(segs) - 1, 0, 0
+        found = False
+        for k, seg in enumerate(segs):
+            end = pos + len(seg.text)
+            if not found and start < end:
+                i, i_pos, found = k, pos, True
+            if found and start + delete <= end:
+                j = k
+                break
+            pos = end
+        if not found and segs:
+            i_pos = len(self.text) - len(segs[-1].text)
+        # chapdan bitta qo'shni: tahrir segment boshida bo'lsa oldingi segmentning oxirgi bo'shlig'i o'zgarishi mumkin
+        if i > 0:
+            i -= 1
+            i_pos -= len(segs[i].text)
+        j = min(j + 1, len(segs) - 1)
+        while True:
+            old = segs[i:j + 1]
+            region = "".join(s.text for s in old)
+            rel = start - i_pos
+            new_text = region[:rel] + insert + region[rel + delete:]
+            new = self._segment(new_text)
+            # o'ng chegara yopiq bo'lishi kerak, aks holda keyingi segment ham qo'shiladi
+            if j + 1 >= len(segs) or (new and new[-1].closed):
+                break
+            j += 1
+        left = self._context_ids(i - 1, -1)
+        right = self._context_ids(j + 1, 1)
+        old_ids = left + [t for s in old for t in s.ids] + right
+        new_ids = left + [t for s in new for t in s.ids] + right
+        for ng in self.ngrams:
+            ng.update(old_ids, -1)
+            if ng.update(new_ids, 1) and ng is self.ngrams[-1]:
+                self._span_grow = True  # tahrir atrofida takrorlangan 4-gram – takror uzayishi mumkin
+        for s in old:
+            self._account(s, -1)
+        for s in new:
+            self._account(s, 1)
+        t0 = sum(len(s.ids) for s in segs[:i])
+        t1 = t0 + sum(len(s.ids) for s in old)
+        self._tokens[t0:t1] = [w for s in new for w in s.tokens]
+        self._lower[t0:t1] = [w for s in new for w in s.lower]
+        self._ids[t0:t1] = [t for s in new for t in s.ids]
+        if self._span is not None:
+            length, _, second = self._span[1]
+            if length and t0 < second + length:
+                self._span = None  # tahrir takrorlangan bo'lakka yoki undan oldinga tegdi
+        segs[i:j + 1] = new
+        for view in (self._sentences, self._lines, self._paragraphs):
+            view.splice(segs, i, len(old), len(new))
+        self.text = self.text[:start] + insert + self.text[start + delete:]
+        self.version += 1
+
+    # --- natija ---
+    def _repeat_span(self, ngram_max: tuple) -> tuple:
+        """longest_repeated_span, lekin imkon bo'lsa keshdan.
+
+        Keshlangan juftlik (1- va 2-pozitsiya) o'zgarmagan bo'lsa (apply undan oldingi tahrirda keshni tashlaydi),
+        yangi takror faqat 2-pozitsiyadan keyin boshlanishi mumkin. Takror bayroqlari (unigram + 2/3/4-gram max >= 2)
+        o'zgarmasa uzunlik ham o'zgarmaydi; 4+ so'zli takror esa faqat tahrir takrorlangan 4-gram qo'shganda
+        uzayishi mumkin – shunda bitta uzunroq qidiruv yetadi.
+        """
+        flags = (self.wc > len(self.counts),) + tuple(m >= 2 for m in ngram_max)
+        grow, self._span_grow = self._span_grow, False
+        if self._span is not None and self._span[0] == flags:
+            span = self._span[1]
+            length = span[0]
+            if (length < len(flags) or not grow
+                    or length + 1 > len(self._ids) - 1 or not _find_repeat(self._ids, length + 1)):
+                return span
+        span = longest_repeated_span(self._ids, ngram_max)
+        self._span = (flags, span)
+        return span
+
+    def features(self) -> TextFeatures:
+        """Hisoblagichlar va keshlangan ko'rinishlardan TextFeatures yig'adi – matn qayta tokenlanmaydi."""
+        if self._features is not None and self._features[0] == self.version:
+            return self._features[1]
+        sentences = tuple(self._sentences.items + self._sentences.tail)
+        line_sentences = tuple(self._lines.items + self._lines.tail)
+        ngram_max = tuple(ng.max for ng in self.ngrams)
+        wc = self.wc
+        f = TextFeatures(
+            text=self.text,
+            tokens=tuple(self._tokens),
+            lower=tuple(self._lower),
+            counts=MappingProxyType(self.counts),
+            diversity=(len(self.counts) / wc) if wc else 0.0,
+            alpha_chars=self.alpha_chars,
+            alpha_words=self.alpha_words,
+            alpha_unique=len(self.alpha_counts),
+            content_words=self.content_words,
+            weird_words=self.weird,
+            clean_counts=MappingProxyType(self.clean_counts),
+            english_ratio=((self.known / self.clean_total) if self.clean_total else 0.0) if len(self._lexicon) else None,
+            sentences=sentences,
+            sentence_words=tuple(len(s.split()) for s in sentences),
+            line_sentences=line_sentences,
+            line_sentence_words=tuple(len(s.split()) for s in line_sentences),
+            paragraphs=len(self._paragraphs.items) + len(self._paragraphs.tail),
+            ngram_max=ngram_max,
+            repeat_span=self._repeat_span(ngram_max),
+        )
+        self._features = (self.version, f)
+        return f
+
+def writing_task_word_limits(test: dict, task_type: str) -> tuple:
+    """Writing testidagi vazifa (task1/task2/essay) uchun (min, max) so'z chegarasi."""
+    default_min, default_max = WRITING_TASK_WORD_LIMITS.get(task_type, WRITING_TASK_WORD_LIMITS["essay"])
+    for part in test.get("parts", []):
+        for item in [part] + list(part.get("tasks") or []):
+            if item.get("type") == task_type:
+                return int(item.get("min_words") or default_min), int(item.get("max_words") or default_max)
+    return default_min, default_max
+
+
+def get_live_writing_state(session_id: str, task_type: str) -> LiveWritingState:
+    """(sessiya, vazifa) uchun holat; eng eski holatlar LIVE_WRITING_MAX_STATES dan oshganda o'chiriladi."""
+    key = (session_id, task_type)
+    state = _live_writing_states.pop(key, None)
+    if state is None:
+        version = pinned_bank_version(sessions.get(session_id), "writing")
+        min_w, max_w = writing_task_word_limits(get_writing_test_for_grading(version=version), task_type)
+        state = LiveWritingState(task_type, min_w, max_w)
+        while len(_live_writing_states) >= LIVE_WRITING_MAX_STATES:
+            _live_writing_states.pop(next(iter(_live_writing_states)))
+    _live_writing_states[key] = state  # oxirgi ishlatilgan – lug'at oxirida
+    return state
+
+
+def drop_live_writing_states(session_id: str):
+    for task_type in WRITING_TASK_WORD_LIMITS:
+        _live_writing_states.pop((session_id, task_type), None)
+
+
+def live_writing_warnings(f: TextFeatures) -> list:
+    """Takrorlanish ogohlantirishlari: takrorlangan gaplar, haddan ko'p ishlatilgan so'z, uzun takrorlangan bo'lak."""
+    warnings = []
+    seen: dict = {}
+    for s in f.line_sentences:
+        if len(s) > 3:
+            seen[s] = seen.get(s, 0) + 1
+    for s, c in seen.items():
+        if c > 1:
+            warnings.append({"type": "repeated_sentence", "text": s[:80], "count": c})
+    word, top = max(((w, c) for w, c in f.counts.items() if w not in SPAM_STOPWORDS and w.strip(_WORD_PUNCT)),
+                    key=lambda wc: wc[1], default=(None, 0))
+    if f.wc >= 20 and top >= 4 and top / f.wc > LIVE_OVERUSED_WORD_PCT:
+        warnings.append({"type": "overused_word", "text": word.strip(_WORD_PUNCT), "count": top})
+    if f.repeat_span[0] >= LIVE_REPEAT_PHRASE_WORDS:
+        rep = detect_repetition(f.text, f)["longest_repeat"]
+        warnings.append({"type": "repeated_phrase", "text": rep["text"], "count": 2, "words": rep["words"]})
+    return warnings
+
+
+def live_writing_feedback(state: LiveWritingState) -> dict:
+    """Jonli javob: so'zlar soni, ogohlantirishlar va algorithmic_score bo'yicha taxminiy band."""
+    f = state.features()
+    scored = algorithmic_score(state.text, state.min_w, state.max_w, state.task_type, f)
+    return {
+        "version": state.version,
+        "word_count": f.wc,
+        "band": scored["score"],
+        "feedback": scored["feedback"],
+        "warnings": live_writing_warnings(f),
+    }
+
+
+# ============ WRITING: O'XSHASH ISHLAR (MinHash + LSH) ============
+
+# Har bir javob so'z 3-gramlari (shingle) to'plamiga aylantiriladi; MinHash imzosi Jaccard o'xshashligini
+# MINHASH_PERM ta son bilan taxmin qiladi. LSH: imzo LSH_BANDS ta bo'lakka bo'linadi, bo'lagi to'liq mos
+# kelgan ishlargina nomzod bo'ladi – juftma-juft solishtirish yo'q. 16 x 4 da chegara ≈ (1/16)^(1/4) ≈ 0.5.
+MINHASH_PERM = 64
+LSH_BANDS = 16
+SHINGLE_WORDS = 3
+MINHASH_MIN_WORDS = 20  # bundan qisqa javoblar solishtirilmaydi
+WRITING_SIMILARITY_THRESHOLD = float(os.getenv("WRITING_SIMILARITY_THRESHOLD", "0.5"))
+WRITING_TASKS = ("task1", "task2", "essay")
+_MINHASH_PRIME = (1 << 61) - 1
+# Permutatsiya koeffitsientlari qat'iy seed bilan – saqlangan imzolar qayta ishga tushirishdan keyin ham mos keladi
+_minhash_rng = random.Random(20240601)
+_MINHASH_COEFFS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+                   for _ in range(MINHASH_PERM)]
+_SHINGLE_TOKEN = re.compile(r"[a-z0-9']+")
+
+
+def text_shingles(text: str) -> set:
+    """Kichik harfli so'z 3-gramlarining 61-bitli barqaror hashlari."""
+    words = _SHINGLE_TOKEN.findall((text or "").lower())
+    if len(words) < MINHASH_MIN_WORDS:
+        return set()
+    mask = _MINHASH_PRIME
+    return {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i:i + SHINGLE_WORDS]).encode(), digest_size=8).digest(), "little") & mask
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+
+
+def minhash_signature(text: str) -> array | None:
+    """MINHASH_PERM ta (a*x + b) mod p permutatsiyasi bo'yicha minimumlar; qisqa matn uchun None."""
+    shingles = text_shingles(text)
+    if not shingles:
+        return None
+    p = _MINHASH_PRIME
+    return array("Q", [min([(a * x + b) % p for x in shingles]) for a, b in _MINHASH_COEFFS])
+
+
+def encode_signature(sig: array) -> str:
+    return base64.b64encode(sig.tobytes()).decode("ascii")
+
+
+def decode_signature(data: str) -> array | None:
+    try:
+        sig = array("Q", base64.b64decode(data))
+    except (ValueError, TypeError):
+        return None
+    return sig if len(sig) == MINHASH_PERM else None
+
+
+def signature_similarity(a: array, b: array) -> float:
+    """Mos keladigan MinHash qiymatlari ulushi – Jaccard o'xshashligining bahosi."""
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+class MinHashLSH:
+    """Band bo'yicha LSH indeksi: har bir band qiymatlari -> shu bandi bir xil ishlar kalitlari."""
+
+    def __init__(self, bands: int = LSH_BANDS):
+        self.bands = bands
+        self.rows = MINHASH_PERM // bands
+        self.buckets: List[Dict[int, list]] = [{} for _ in range(bands)]
+        self.signatures: Dict[tuple, array] = {}
+        self.meta: Dict[tuple, dict] = {}
+
+    def _band_keys(self, sig: array):
+        raw = sig.tobytes()
+        width = self.rows * sig.itemsize
+        for b in range(self.bands):
+            yield b, hash(raw[b * width:(b + 1) * width])
+
+    def add(self, key: tuple, sig: array, meta: dict | None = None):
+        if key in self.signatures:
+            return
+        self.signatures[key] = sig
+        self.meta[key] = meta or {}
+        for b, h in self._band_keys(sig):
+            self.buckets[b].setdefault(h, []).append(key)
+
+    def query(self, sig: array, threshold: float = WRITING_SIMILARITY_THRESHOLD, limit: int = 5,
+              exclude_session: str | None = None, exclude_user: str | None = None) -> list:
+        """Kamida bitta bandi mos nomzodlar imzo bo'yicha tekshiriladi; o'xshashligi threshold dan yuqorilar."""
+        candidates = set()
+        for b, h in self._band_keys(sig):
+            candidates.update(self.buckets[b].get(h, ()))
+        matches = []
+        for key in candidates:
+            if exclude_session and key[0] == exclude_session:
+                continue
+            if exclude_user and self.meta[key].get("user_id") == exclude_user:
+                continue
+            sim = signature_similarity(sig, self.signatures[key])
+            if sim >= threshold:
+                matches.append({"session_id": key[0], "task": key[1], "similarity": round(sim, 3), **self.meta[key]})
+        matches.sort(key=lambda m: -m["similarity"])
+        return matches[:limit]
+
+    def __len__(self):
+        return len(self.signatures)
+
+
+_writing_lsh: MinHashLSH | None = None
+
+
+def _index_history_record(index: MinHashLSH, record: dict):
+    meta = {"user_id": record.get("user_id"), "completed_at": record.get("completed_at")}
+    for task, data in (record.get("writing_minhash") or {}).items():
+        sig = decode_signature(data) if data else None
+        if sig is not None:
+            index.add((record.get("session_id"), task), sig, meta)
+
+
+def get_writing_lsh() -> MinHashLSH:
+    """test_history.json dagi saqlangan imzolardan indeks – birinchi kerak bo'lganda bir marta quriladi."""
+    global _writing_lsh
+    if _writing_lsh is None:
+        index = MinHashLSH()
+        for record in load_test_history_data().get("results", []):
+            _index_history_record(index, record)
+        _writing_lsh = index
+        print(f"[Similarity] LSH indeksi: {len(index)} ta imzo")
+    return _writing_lsh
+
+
+def writing_signatures(responses: dict) -> dict:
+    """{task: imzo} – juda qisqa javoblar tashlab ketiladi."""
+    sigs = {}
+    for task in WRITING_TASKS:
+        sig = minhash_signature((responses or {}).get(task) or "")
+        if sig is not None:
+            sigs[task] = sig
+    return sigs
+
+
+def find_similar_submissions(signatures: dict, exclude_session: str | None = None, exclude_user: str | None = None) -> dict:
+    """Har bir vazifa uchun boshqa foydalanuvchilarning oldingi ishlari orasidan o'xshashlari: {task: [match, ...]}."""
+    index = get_writing_lsh()
+    found = {}
+    for task, sig in signatures.items():
+        matches = index.query(sig, exclude_session=exclude_session, exclude_user=exclude_user)
+        if matches:
+            found[task] = matches
+    return found
+
+def recent_similar_submissions(limit: int = 20) -> list:
+    """Admin panel uchun: topshirishda o'xshash ish topilgan oxirgi natijalar (saqlangan moslar – qayta qidiruvsiz)."""
+    rows = []
+    for r in reversed(load_test_history_data().get("results", [])):
+        for task, matches in (r.get("writing_similar") or {}).items():
+            if not matches:
+                continue
+            best = matches[0]
+            rows.append({
+                "session_id": r.get("session_id"),
+                "user_id": r.get("user_id"),
+                "completed_at": r.get("completed_at"),
+                "task": task,
+                "similarity": best.get("similarity"),
+                "match_session_id": best.get("session_id"),
+                "match_user_id": best.get("user_id"),
+                "match_completed_at": best.get("completed_at"),
+                "matches": len(matches),
+            })
+        if len(rows) >= limit:
+            break
+    return rows[:limit]
+
+
+def _short_writing_results(task1: str, task2: str, essay: str) -> dict:
+    """Bo'sh yoki juda qisqa (5 so'zdan kam) qismlar uchun 0 ballik natijalar."""
+    results = {}
+    for name, txt in [("task1", task1), ("task2", task2), ("essay", essay)]:
+        wc = len(txt.split())
+        if wc < 5:
+            print(f"[Writing AI] {name}: faqat {wc} so'z - juda kam, score=0")
+            if name == "essay":
+                results[name] = {
+                    "score": 0, "band": 0, "word_count": wc, "is_valid": False,
+                    "feedback": {
+                        "overall": "Band 0 - Bo'sh",
+                        "task_achievement": f"Faqat {wc} so'z yozilgan. Minimum 20 so'z kerak.",
+                        "coherence_cohesion": "", "lexical_resource": "", "grammatical_range": ""
+                    }
+                }
+            else:
+                results[name] = {
+                    "score": 0, "band": 0, "word_count": wc, "is_valid": False,
+                    "feedback": {
+                        "overall": "Band 0 - Bo'sh",
+                        "content": f"Faqat {wc} so'z yozilgan. Minimum 20 so'z kerak.",
+                        "organization": "", "language": "", "accuracy": ""
                     }
+                }
+    return results
+
+
+def _ai_unavailable_result(name: str, txt: str) -> dict:
+    """AI baholash ishlamagan qism uchun natija."""
+    wc = len(txt.split())
+    if name == "essay":
+        return {
+            "score": 0, "band": 0, "word_count": wc, "is_valid": False,
+            "feedback": {
+                "overall": "AI baholash ishlamadi",
+                "task_achievement": "AI xizmati hozirda ishlamayapti. Qayta urinib ko'ring.",
+                "coherence_cohesion": "OPENAI_API_KEY tekshiring.",
+                "lexical_resource": "", "grammatical_range": ""
+            },
+            "ai_unavailable": True
+        }
+    return {
+        "score": 0, "band": 0, "word_count": wc, "is_valid": False,
+        "feedback": {
+            "overall": "AI baholash ishlamadi",
+            "content": "AI xizmati hozirda ishlamayapti. Qayta urinib ko'ring.",
+            "organization": "OPENAI_API_KEY tekshiring.",
+            "language": "", "accuracy": ""
+        },
+        "ai_unavailable": True
+    }
+
 
+def _finalize_writing_evaluation(results: dict) -> Dict:
+    """task1/task2/essay natijalaridan umumiy band, foiz va CEFR darajani hisoblaydi."""
     # Ensure all parts have results
     for name in ["task1", "task2", "essay"]:
         if name not in results:
@@ -1459,39 +3450,46 @@ async def evaluate_writing_with_ai(task1: str, task2: str, essay: str, writing_t
     }
 
 
-COMMON_ENGLISH_WORDS = {
-    'the', 'be', 'to', 'of', 'and', 'a', 'in', 'that', 'have', 'i', 'it', 'for', 'not', 'on', 'with', 'he', 'as', 'you', 'do', 'at',
-    'this', 'but', 'his', 'by', 'from', 'they', 'we', 'say', 'her', 'she', 'or', 'an', 'will', 'my', 'one', 'all', 'would', 'there',
-    'their', 'what', 'so', 'up', 'out', 'if', 'about', 'who', 'get', 'which', 'go', 'me', 'when', 'make', 'can', 'like', 'time', 'no',
-    'just', 'him', 'know', 'take', 'people', 'into', 'year', 'your', 'good', 'some', 'could', 'them', 'see', 'other', 'than', 'then',
-    'now', 'look', 'only', 'come', 'its', 'over', 'think', 'also', 'back', 'after', 'use', 'two', 'how', 'our', 'work', 'first', 'well',
-    'way', 'even', 'new', 'want', 'because', 'any', 'these', 'give', 'day', 'most', 'us', 'very', 'much', 'before', 'too', 'same',
-    'been', 'has', 'more', 'made', 'did', 'down', 'here', 'still', 'own', 'find', 'world', 'again', 'hand', 'part', 'place', 'during',
-    'where', 'off', 'right', 'man', 'always', 'however', 'another', 'never', 'while', 'last', 'might', 'under', 'such', 'through',
-    'life', 'being', 'long', 'little', 'got', 'those', 'great', 'old', 'many', 'must', 'home', 'big', 'around', 'high', 'each', 'read',
-    'need', 'few', 'between', 'without', 'head', 'small', 'every', 'next', 'something', 'still', 'since', 'best', 'both', 'ask', 'house',
-    'why', 'found', 'put', 'does', 'end', 'keep', 'let', 'thought', 'going', 'help', 'nothing', 'really', 'point', 'though', 'went',
-    'better', 'enough', 'money', 'school', 'told', 'turn', 'water', 'three', 'face', 'thing', 'things', 'became', 'believe', 'second',
-    'person', 'state', 'night', 'away', 'having', 'room', 'should', 'number', 'yes', 'called', 'family', 'feel', 'began', 'sure', 'name',
-    'become', 'important', 'business', 'looking', 'children', 'rather', 'later', 'used', 'kind', 'once', 'four', 'five', 'six', 'seven',
-    'eight', 'nine', 'ten', 'today', 'morning', 'love', 'book', 'write', 'writing', 'written', 'wrote', 'word', 'words', 'english',
-    'test', 'email', 'letter', 'review', 'essay', 'opinion', 'agree', 'disagree', 'think', 'believe', 'feel', 'suggest', 'recommend',
-    'therefore', 'moreover', 'furthermore', 'however', 'although', 'nevertheless', 'conclusion', 'finally', 'firstly', 'secondly',
-    'addition', 'example', 'instance', 'order', 'result', 'reason', 'fact', 'indeed', 'certainly', 'course', 'generally', 'usually',
-    'often', 'sometimes', 'always', 'never', 'perhaps', 'probably', 'possible', 'impossible', 'necessary', 'important', 'different',
-    'interesting', 'beautiful', 'wonderful', 'excellent', 'amazing', 'terrible', 'horrible', 'difficult', 'easy', 'simple', 'hard',
-    'experience', 'education', 'environment', 'technology', 'information', 'communication', 'development', 'opportunity', 'community',
-    'restaurant', 'hotel', 'movie', 'film', 'music', 'sport', 'travel', 'friend', 'friends', 'dear', 'sincerely', 'regards', 'best',
-    'thanks', 'thank', 'please', 'sorry', 'hope', 'looking', 'forward', 'hearing', 'soon', 'write', 'writing', 'touch', 'contact',
-    'happy', 'sad', 'angry', 'excited', 'worried', 'surprised', 'disappointed', 'satisfied', 'comfortable', 'uncomfortable',
-    'would', 'could', 'should', 'might', 'may', 'must', 'will', 'shall', 'can', 'able', 'unable', 'doing', 'done', 'seen', 'took',
-    'gave', 'came', 'knew', 'thought', 'wanted', 'needed', 'tried', 'started', 'began', 'finished', 'ended', 'continued', 'stopped'
-}
+async def evaluate_writing_with_ai(task1: str, task2: str, essay: str, writing_test: dict) -> Dict:
+    """100% AI evaluation - NO spam detection, direct AI evaluation only"""
 
-async def get_strict_ai_score(text: str, task_type: str) -> int:
+    print(f"[Writing AI] === BAHOLASH BOSHLANDI ===")
+    print(f"[Writing AI] task1: {len(task1.split())} so'z, task2: {len(task2.split())} so'z, essay: {len(essay.split())} so'z")
+    print(f"[Writing AI] OPENAI_API_KEY mavjud: {bool(OPENAI_API_KEY)}, uzunlik: {len(OPENAI_API_KEY)}")
+
+    # Bo'sh yoki juda qisqa matn tekshirish (faqat 5 so'zdan kam)
+    results = _short_writing_results(task1, task2, essay)
+
+    # AI bilan baholash - barcha qolgan qismlar
+    parts_to_eval = [n for n in ["task1", "task2", "essay"] if n not in results]
+    print(f"[Writing AI] AI baholash uchun: {parts_to_eval}")
+
+    telemetry = None
+    if parts_to_eval:
+        ai_result = await try_ai_evaluation(task1, task2, essay, writing_test, parts_to_eval)
+        if ai_result:
+            telemetry = ai_result.get("telemetry")
+            print(f"[Writing AI] AI muvaffaqiyatli baholadi! Natijalar: {list(ai_result.keys())}")
+            for name in parts_to_eval:
+                if name in ai_result:
+                    results[name] = ai_result[name]
+                    print(f"[Writing AI] {name}: score={ai_result[name].get('score', '?')}")
+        else:
+            print("[Writing AI] AI baholash muvaffaqiyatsiz bo'ldi!")
+            for name in parts_to_eval:
+                txt = task1 if name == "task1" else (task2 if name == "task2" else essay)
+                results[name] = _ai_unavailable_result(name, txt)
+
+    evaluation = _finalize_writing_evaluation(results)
+    if telemetry:
+        evaluation["telemetry"] = telemetry
+    return evaluation
+
+
+async def get_strict_ai_score(text: str, task_type: str, features: TextFeatures | None = None) -> int:
     """ULTRA-STRICT fallback score when AI is unavailable - properly detects gibberish"""
-    words = text.split()
-    wc = len(words)
+    f = features or extract_text_features(text)
+    wc = f.wc
 
     # Absolute minimums
     if wc < 20:
@@ -1499,28 +3497,33 @@ async def get_strict_ai_score(text: str, task_type: str) -> int:
     if wc < 40:
         return 1
 
-    # Clean words (lowercase, alphabetic only)
-    clean_words = [w.lower().strip('.,!?;:"\'()[]{}') for w in words]
-    clean_words = [w for w in clean_words if w.isalpha() and len(w) > 1]
-
-    if len(clean_words) < 15:
+    # Clean words (lowercase, alphabetic only, 2+ letters)
+    lexicon = get_english_lexicon()
+    clean_total = english_word_count = unique = 0
+    for w, c in f.clean_counts.items():
+        if len(w) > 1:
+            clean_total += c
+            unique += 1
+            if w in lexicon:
+                english_word_count += c
+
+    if clean_total < 15:
         return 0
 
-    # Check how many words are actual English words
-    english_word_count = sum(1 for w in clean_words if w in COMMON_ENGLISH_WORDS)
-    english_ratio = english_word_count / len(clean_words) if clean_words else 0
+    # Check how many words are actual English words (lug'at yuklanmagan bo'lsa tekshiruv o'tkazib yuboriladi)
+    english_ratio = english_word_count / clean_total if len(lexicon) else None
 
-    # STRICT: If less than 30% recognized English words = gibberish
-    if english_ratio < 0.25:
-        return 0  # Completely gibberish
-    if english_ratio < 0.35:
-        return 1  # Mostly gibberish
-    if english_ratio < 0.45:
-        return 2  # Significant gibberish
+    # STRICT: to'liq lug'atda real matn 85%+ beradi, shuning uchun chegaralar shunga moslangan
+    if english_ratio is not None:
+        if english_ratio < 0.5:
+            return 0  # Completely gibberish
+        if english_ratio < 0.65:
+            return 1  # Mostly gibberish
+        if english_ratio < 0.75:
+            return 2  # Significant gibberish
 
     # Check word diversity
-    unique = len(set(clean_words))
-    diversity = unique / len(clean_words) if clean_words else 0
+    diversity = unique / clean_total
 
     if diversity < 0.2:
         return 1  # Too repetitive
@@ -1528,14 +3531,13 @@ async def get_strict_ai_score(text: str, task_type: str) -> int:
         return 2
 
     # Check sentence structure
-    sentences = re.split(r'[.!?]+', text)
-    sentences = [s.strip() for s in sentences if len(s.strip()) > 3]
+    sentence_words = [n for s, n in zip(f.sentences, f.sentence_words) if len(s) > 3]
 
-    if len(sentences) < 2:
+    if len(sentence_words) < 2:
         return 2  # No real sentence structure
 
     # Check average sentence length (too short = gibberish)
-    avg_sent_len = sum(len(s.split()) for s in sentences) / len(sentences) if sentences else 0
+    avg_sent_len = sum(sentence_words) / len(sentence_words)
     if avg_sent_len < 5:
         return 1  # Fragmented text
 
@@ -1556,31 +3558,21 @@ async def get_strict_ai_score(text: str, task_type: str) -> int:
         base_score = 4
 
     # Adjust for English quality
-    if english_ratio > 0.6:
+    if english_ratio is None:
+        pass
+    elif english_ratio > 0.9:
         base_score = min(base_score + 1, 5)
-    elif english_ratio < 0.5:
+    elif english_ratio < 0.8:
         base_score = max(base_score - 1, 2)
 
     # Cap at 5 without proper AI evaluation
     return min(base_score, 5)
 
 
-async def try_ai_evaluation(task1: str, task2: str, essay: str, writing_test: dict, parts_to_eval: list) -> dict:
-    """Try AI evaluation via Anthropic or OpenAI"""
-    t1_instruction = ""
-    t2_instruction = ""
-    essay_instruction = ""
-    if writing_test and writing_test.get("parts"):
-        for p in writing_test["parts"]:
-            if p.get("part_number") == 1 and p.get("tasks"):
-                t1_instruction = (p["tasks"][0].get("situation") or "")[:300]
-                if len(p["tasks"]) > 1:
-                    t2_instruction = (p["tasks"][1].get("situation") or "")[:300]
-            if p.get("part_number") == 2:
-                essay_instruction = (p.get("prompt") or "")[:400]
-    prompt = f"""You are a CEFR English writing examiner. Evaluate the candidate's writing strictly but fairly.
+WRITING_SYSTEM_PROMPT = "You are a CEFR writing examiner. Reply ONLY with a valid JSON object. Do NOT use markdown code blocks. Do NOT add any text before or after the JSON. The JSON must have keys: task1, task2, essay, general_feedback. Each of task1, task2, essay must have a \"score\" field (integer 0-9) and feedback fields."
 
-SCORING GUIDE (0-9 scale). IMPORTANT: Use 0 when the answer deserves no credit.
+# Baholash mezonlari (rubric) – o'zgarsa WRITING_RUBRIC_VERSION ham o'zgaradi va eski natijalarni qayta baholash mumkin
+WRITING_SCORING_GUIDE = """SCORING GUIDE (0-9 scale). IMPORTANT: Use 0 when the answer deserves no credit.
 - Score 0: Empty, nearly empty (e.g. under 10 words), gibberish, nonsense, completely off-topic, non-English, or no meaningful content. Give 0 whenever the writing does not deserve any credit.
 - Score 1: Only if there is at least minimal relevant content but very poor (e.g. a few relevant words or one short relevant sentence). Otherwise use 0.
 - Score 2: Very limited English, mostly incomprehensible
@@ -1597,9 +3589,76 @@ RULES:
 - Repeated sentences or spam = score 0 or 1
 - Off-topic = score 0 (write "Off-topic" or "Irrelevant" in feedback)
 - Under word count = max score 4
-- Each score must be a NUMBER from 0 to 9 (use 0 when appropriate)
+- Each score must be a NUMBER from 0 to 9 (use 0 when appropriate)"""
+
+WRITING_OUTPUT_FORMAT = """IMPORTANT: general_feedback must be written in Uzbek (Latin script): 2-3 sentences overall summary and 1-2 short recommendations for the candidate. Other feedback fields can be in English.
+
+Return ONLY valid JSON (no markdown, no code blocks):
+{"task1":{"score":5,"content":"feedback","organization":"feedback","language":"feedback","accuracy":"feedback"},"task2":{"score":5,"content":"feedback","organization":"feedback","language":"feedback","accuracy":"feedback"},"essay":{"score":5,"task_achievement":"feedback","coherence_cohesion":"feedback","lexical_resource":"feedback","grammatical_range":"feedback"},"general_feedback":"umumiy xulosa va tavsiyalar o'zbekchada"}"""
+
+# Har bir so'rovda bayt-ma-bayt bir xil system prefiks – provider prompt cache dan foydalanish uchun.
+# Bu yerga hech qanday o'zgaruvchan (test yoki nomzodga bog'liq) matn qo'shilmasin.
+WRITING_SYSTEM_PREFIX = "\n\n".join([
+    WRITING_SYSTEM_PROMPT,
+    "Evaluate the candidate's writing strictly but fairly.",
+    WRITING_SCORING_GUIDE,
+    WRITING_OUTPUT_FORMAT,
+])
 
-TASK 1 instruction: {t1_instruction}
+WRITING_RUBRIC_VERSION = hashlib.sha1(WRITING_SYSTEM_PREFIX.encode("utf-8")).hexdigest()[:12]
+
+# Provider prompt cache faqat prefiks shu uzunlikdan (token) oshsa ishlaydi, aks holda har so'rov to'liq narxda.
+# OpenAI: 1024; Anthropic: Haiku 3 / 3.5 uchun 2048, qolgan Claude modellari 1024.
+PROMPT_CACHE_MIN_TOKENS = {"openai": 1024, "claude-3-haiku": 2048, "claude-3-5-haiku": 2048, "anthropic": 1024}
+
+
+def prompt_cache_min_tokens(provider: str, model: str = "") -> int:
+    for prefix, n in PROMPT_CACHE_MIN_TOKENS.items():
+        if model.startswith(prefix):
+            return n
+    return PROMPT_CACHE_MIN_TOKENS.get(provider, 1024)
+
+
+# Taxminiy (~4 belgi/token); aniq qiymat provider usage dagi cached_tokens da ko'rinadi
+WRITING_PREFIX_TOKENS_EST = len(WRITING_SYSTEM_PREFIX) // 4
+# Writing baholashda ishlatiladigan modellar (try_ai_evaluation dagi tartibda)
+WRITING_AI_MODELS = {"openai": ("gpt-4o-mini", "gpt-4o", "gpt-3.5-turbo"), "anthropic": ("claude-3-haiku-20240307",)}
+
+
+def writing_prefix_cache_status() -> dict:
+    """Har model uchun: prompt cache minimumi va system prefiks undan uzunmi (keshlanadimi)."""
+    out = {}
+    for provider, models in WRITING_AI_MODELS.items():
+        for model in models:
+            need = prompt_cache_min_tokens(provider, model)
+            out[model] = {"min_tokens": need, "cacheable": WRITING_PREFIX_TOKENS_EST >= need}
+    return out
+
+
+def _writing_instructions(writing_test: dict) -> tuple:
+    """Writing testdan (task1, task2, essay) ko'rsatmalarini qisqartirib oladi."""
+    t1_instruction = ""
+    t2_instruction = ""
+    essay_instruction = ""
+    if writing_test and writing_test.get("parts"):
+        for p in writing_test["parts"]:
+            if p.get("part_number") == 1 and p.get("tasks"):
+                t1_instruction = (p["tasks"][0].get("situation") or "")[:300]
+                if len(p["tasks"]) > 1:
+                    t2_instruction = (p["tasks"][1].get("situation") or "")[:300]
+            if p.get("part_number") == 2:
+                essay_instruction = (p.get("prompt") or "")[:400]
+    return t1_instruction, t2_instruction, essay_instruction
+
+
+def build_writing_prompt(task1: str, task2: str, essay: str, writing_test: dict) -> str:
+    """AI ga yuboriladigan user xabar – faqat o'zgaruvchan qism (WRITING_SYSTEM_PREFIX dan keyin).
+
+    Test ko'rsatmalari (ko'pchilik nomzodlar uchun bir xil) oldin, nomzod matnlari oxirida turadi,
+    shunda keshlanadigan prefiks iloji boricha uzun bo'ladi. Online baholash va offline re-grade uchun bir xil.
+    """
+    t1_instruction, t2_instruction, essay_instruction = _writing_instructions(writing_test)
+    return f"""TASK 1 instruction: {t1_instruction}
 TASK 2 instruction: {t2_instruction}
 ESSAY topic: {essay_instruction}
 
@@ -1610,131 +3669,294 @@ ESSAY topic: {essay_instruction}
 {task2[:2000]}
 
 === CANDIDATE ESSAY ({len(essay.split())} words) ===
-{essay[:3000]}
+{essay[:3000]}"""
 
-IMPORTANT: general_feedback must be written in Uzbek (Latin script): 2-3 sentences overall summary and 1-2 short recommendations for the candidate. Other feedback fields can be in English.
 
-Return ONLY valid JSON (no markdown, no code blocks):
-{{"task1":{{"score":5,"content":"feedback","organization":"feedback","language":"feedback","accuracy":"feedback"}},"task2":{{"score":5,"content":"feedback","organization":"feedback","language":"feedback","accuracy":"feedback"}},"essay":{{"score":5,"task_achievement":"feedback","coherence_cohesion":"feedback","lexical_resource":"feedback","grammatical_range":"feedback"}},"general_feedback":"umumiy xulosa va tavsiyalar o'zbekchada"}}"""
+# ============ AI JAVOBINI PARSE QILISH (structured output + tolerant parser) ============
 
-    def extract_json(text: str):
-        """AI javobidan JSON ni ajratib olish - bir necha usul bilan sinab ko'radi"""
-        if not text or not text.strip():
-            print("[Writing AI] extract_json: bo'sh matn")
-            return None
-        raw = text.strip()
+_TASK_FIELDS = ("content", "organization", "language", "accuracy")
+_ESSAY_FIELDS = ("task_achievement", "coherence_cohesion", "lexical_resource", "grammatical_range")
 
-        def try_parse(s: str):
-            try:
-                return json.loads(s)
-            except json.JSONDecodeError:
-                return None
 
-        # 1) To'g'ridan-to'g'ri parse
-        out = try_parse(raw)
-        if out and isinstance(out, dict):
-            return out
-
-        # 2) ```json ... ``` blokini olib tashlash
-        if "```" in raw:
-            code_match = re.search(r"```(?:json)?\s*(\{[\s\S]*?\})\s*```", raw)
-            if code_match:
-                out = try_parse(code_match.group(1).strip())
-                if out and isinstance(out, dict):
-                    return out
-            # Greedy variant
-            code_match = re.search(r"```(?:json)?\s*(\{[\s\S]*\})\s*```", raw)
-            if code_match:
-                out = try_parse(code_match.group(1).strip())
-                if out and isinstance(out, dict):
-                    return out
-
-        # 3) Trailing vergul bo'lsa olib tashlash
-        cleaned = re.sub(r",\s*}", "}", raw)
-        cleaned = re.sub(r",\s*]", "]", cleaned)
-        out = try_parse(cleaned)
-        if out and isinstance(out, dict):
-            return out
-
-        # 4) { ... } blokini topish
-        # Eng katta blokdan boshlab sinash
-        brace_start = raw.find('{')
-        brace_end = raw.rfind('}')
-        if brace_start >= 0 and brace_end > brace_start:
-            candidate = raw[brace_start:brace_end+1]
-            out = try_parse(candidate)
-            if out and isinstance(out, dict):
-                return out
-            # Trailing vergul bilan
-            candidate_clean = re.sub(r",\s*}", "}", candidate)
-            candidate_clean = re.sub(r",\s*]", "]", candidate_clean)
-            out = try_parse(candidate_clean)
-            if out and isinstance(out, dict):
-                return out
-
-        print(f"[Writing AI] extract_json: parse qilib bo'lmadi. Matn uzunligi: {len(raw)}, boshi: {raw[:150]}")
-        return None
+def _eval_part_schema(fields: tuple) -> dict:
+    props = {"score": {"type": "number"}}
+    props.update({f: {"type": "string"} for f in fields})
+    return {"type": "object", "properties": props, "required": list(props), "additionalProperties": False}
 
-    def normalize_ev(ev):
-        """API turli kalit nomlari (Task1, task 1, task_1) ni task1, task2, essay ga aylantiradi."""
-        if not ev or not isinstance(ev, dict):
-            return ev
-        normalized = {}
-        for k, v in ev.items():
-            if not isinstance(k, str):
-                continue
-            key_clean = k.strip().lower().replace(" ", "").replace("_", "").replace("-", "")
-            if key_clean in ("task1",):
-                normalized["task1"] = v
-            elif key_clean in ("task2",):
-                normalized["task2"] = v
-            elif key_clean in ("essay",):
-                normalized["essay"] = v
-            elif key_clean in ("generalfeedback", "feedback", "overall"):
-                normalized["general_feedback"] = v
-        return normalized
-
-    def validate_ev(ev):
-        """AI javobida task1, task2, essay borligini tekshirish."""
-        if not ev or not isinstance(ev, dict):
-            print(f"[Writing AI] validate_ev: dict emas - {type(ev)}")
-            return False
-        missing = []
-        for key in ("task1", "task2", "essay"):
-            if key not in ev:
-                missing.append(key)
-            elif not isinstance(ev.get(key), dict):
-                missing.append(f"{key}(not dict)")
-        if missing:
-            print(f"[Writing AI] validate_ev: yetishmayotgan kalitlar: {missing}, mavjud: {list(ev.keys())}")
-            return False
-        return True
+
+# Provider tomonida majburlanadigan JSON sxema (OpenAI json_schema, Anthropic tool input_schema)
+WRITING_EVAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "task1": _eval_part_schema(_TASK_FIELDS),
+        "task2": _eval_part_schema(_TASK_FIELDS),
+        "essay": _eval_part_schema(_ESSAY_FIELDS),
+        "general_feedback": {"type": "string"},
+    },
+    "required": ["task1", "task2", "essay", "general_feedback"],
+    "additionalProperties": False,
+}
+
+# OpenAI modellari qaysi structured output rejimini qo'llab-quvvatlaydi
+OPENAI_RESPONSE_FORMATS = {
+    "gpt-4o-mini": {"type": "json_schema", "json_schema": {"name": "writing_evaluation", "strict": True, "schema": WRITING_EVAL_SCHEMA}},
+    "gpt-4o": {"type": "json_schema", "json_schema": {"name": "writing_evaluation", "strict": True, "schema": WRITING_EVAL_SCHEMA}},
+    "gpt-3.5-turbo": {"type": "json_object"},
+}
+
+ANTHROPIC_EVAL_TOOL = {
+    "name": "submit_evaluation",
+    "description": "Submit the CEFR writing evaluation for task1, task2 and essay.",
+    "input_schema": WRITING_EVAL_SCHEMA,
+}
+
+_EV_KEY_ALIASES = {
+    "task1": "task1", "task2": "task2", "essay": "essay",
+    "generalfeedback": "general_feedback", "feedback": "general_feedback", "overall": "general_feedback",
+}
+
+
+def _scan_json_object(raw: str) -> tuple:
+    """Matndagi birinchi JSON obyektni bir o'tishda ajratadi va yo'l-yo'lakay tuzatadi.
+
+    Code fence / oldidagi matn tashlab ketiladi, trailing vergullar olib tashlanadi,
+    satr ichidagi yangi qatorlar escape qilinadi, qirqilgan obyekt yopiladi.
+    (json_text | None, repairs) qaytaradi.
+    """
+    repairs = []
+    start = raw.find("{")
+    if start < 0:
+        return None, repairs
+    if start > 0:
+        repairs.append("code_fence" if "```" in raw[:start] else "prose")
+    out = []
+    closers = []
+    in_str = esc = False
+    comma_at = None  # hali tasdiqlanmagan vergulning out dagi indeksi
+    for i in range(start, len(raw)):
+        c = raw[i]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+            elif c == "\n":
+                c = "\\n"
+                if "control_char" not in repairs:
+                    repairs.append("control_char")
+            out.append(c)
+            continue
+        if c == "}" or c == "]":
+            if comma_at is not None:
+                out[comma_at] = ""
+                comma_at = None
+                if "trailing_comma" not in repairs:
+                    repairs.append("trailing_comma")
+            if not closers or closers[-1] != c:
+                return None, repairs
+            closers.pop()
+            out.append(c)
+            if not closers:
+                return "".join(out), repairs
+            continue
+        if c == ",":
+            comma_at = len(out)
+        elif not c.isspace():
+            comma_at = None
+            if c == '"':
+                in_str = True
+            elif c == "{":
+                closers.append("}")
+            elif c == "[":
+                closers.append("]")
+        out.append(c)
+    # Matn tugadi, obyekt yopilmagan – qirqilgan javob
+    if in_str:
+        out.append('"')
+    if comma_at is not None:
+        out[comma_at] = ""
+    out.extend(reversed(closers))
+    repairs.append("truncated")
+    return "".join(out), repairs
+
+
+def _coerce_evaluation(obj) -> tuple:
+    """Kalit nomlarini (Task1, task 1, task_1 ...) normallashtiradi va task1/task2/essay borligini tekshiradi."""
+    repairs = []
+    if not isinstance(obj, dict):
+        return None, repairs
+    # {"evaluation": {...}} kabi o'ralgan javob
+    if len(obj) == 1 and isinstance(next(iter(obj.values())), dict) and not any(
+            k.strip().lower().replace(" ", "").replace("_", "").replace("-", "") in _EV_KEY_ALIASES for k in obj if isinstance(k, str)):
+        obj = next(iter(obj.values()))
+        repairs.append("unwrapped")
+    ev = {}
+    for k, v in obj.items():
+        if not isinstance(k, str):
+            continue
+        key = _EV_KEY_ALIASES.get(k.strip().lower().replace(" ", "").replace("_", "").replace("-", ""))
+        if key is None:
+            continue
+        if key != k and "key_alias" not in repairs:
+            repairs.append("key_alias")
+        ev[key] = v
+    missing = [k for k in ("task1", "task2", "essay") if not isinstance(ev.get(k), dict)]
+    if missing:
+        print(f"[Writing AI] yetishmayotgan kalitlar: {missing}, mavjud: {list(obj.keys())}")
+        return None, repairs
+    return ev, repairs
+
+
+def parse_ai_evaluation(text: str) -> tuple:
+    """AI javobini baholash dict iga aylantiradi: (ev | None, repairs).
+
+    Toza JSON bir marta json.loads bilan o'qiladi; aks holda _scan_json_object bilan
+    bir o'tishda tuzatilib, yana bir marta parse qilinadi. repairs – qo'llangan tuzatishlar ro'yxati.
+    """
+    raw = (text or "").strip()
+    if not raw:
+        return None, []
+    obj = None
+    repairs: list = []
+    if raw[0] == "{" and raw[-1] == "}":
+        try:
+            obj = json.loads(raw)
+        except json.JSONDecodeError:
+            obj = None
+    if obj is None:
+        candidate, repairs = _scan_json_object(raw)
+        if candidate is None:
+            print(f"[Writing AI] JSON topilmadi. Matn uzunligi: {len(raw)}, boshi: {raw[:150]}")
+            return None, repairs
+        try:
+            obj = json.loads(candidate)
+        except json.JSONDecodeError as e:
+            print(f"[Writing AI] JSON tuzatib bo'lmadi ({e}). Boshi: {raw[:150]}")
+            return None, repairs
+    ev, key_repairs = _coerce_evaluation(obj)
+    return ev, repairs + key_repairs
+
+
+# Model bo'yicha baholash telemetriyasi: parse natijalari + token / prompt cache / umumiy latency
+# (latency – so'rov yuborilgandan to'liq javob kelguncha; streaming yo'q, shuning uchun birinchi token vaqti (TTFT) o'lchanmaydi)
+AI_EVAL_STATS: Dict[str, Dict[str, float]] = {}
+
+
+def _model_stats(model: str) -> dict:
+    return AI_EVAL_STATS.setdefault(model, {
+        "responses": 0, "structured": 0, "clean": 0, "repaired": 0, "failed": 0,
+        "calls": 0, "input_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0, "cache_hits": 0,
+        "total_latency_ms_sum": 0.0,
+    })
+
+
+def record_parse_result(model: str, ok: bool, repairs: list, structured: bool = False):
+    st = _model_stats(model)
+    st["responses"] += 1
+    if structured:
+        st["structured"] += 1
+    if not ok:
+        st["failed"] += 1
+    elif repairs:
+        st["repaired"] += 1
+    else:
+        st["clean"] += 1
+    for rep in repairs:
+        st["repair:" + rep] = st.get("repair:" + rep, 0) + 1
+
+
+def record_ai_usage(model: str, usage: dict, total_latency_s: float) -> dict:
+    """Provider usage obyektidan input / keshlangan tokenlarni oladi va statistikaga qo'shadi.
+
+    OpenAI: prompt_tokens, prompt_tokens_details.cached_tokens.
+    Anthropic: input_tokens + cache_read_input_tokens + cache_creation_input_tokens.
+    """
+    usage = usage or {}
+    if "prompt_tokens" in usage:
+        input_tokens = usage.get("prompt_tokens") or 0
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        cache_write = 0
+    else:
+        cached = usage.get("cache_read_input_tokens") or 0
+        cache_write = usage.get("cache_creation_input_tokens") or 0
+        input_tokens = (usage.get("input_tokens") or 0) + cached + cache_write
+    st = _model_stats(model)
+    st["calls"] += 1
+    st["input_tokens"] += input_tokens
+    st["cached_tokens"] += cached
+    st["cache_write_tokens"] += cache_write
+    if cached:
+        st["cache_hits"] += 1
+    st["total_latency_ms_sum"] += total_latency_s * 1000
+    return {"model": model, "total_latency_ms": round(total_latency_s * 1000), "input_tokens": input_tokens,
+            "cached_tokens": cached, "cache_write_tokens": cache_write, "cache_hit": bool(cached)}
+
+
+def get_ai_eval_stats() -> dict:
+    """AI_EVAL_STATS + hosila ko'rsatkichlar (admin uchun)."""
+    out = {}
+    for model, st in AI_EVAL_STATS.items():
+        n = st["responses"] or 1
+        calls = st["calls"] or 1
+        out[model] = dict(
+            st,
+            repair_rate=round(st["repaired"] / n, 4),
+            failure_rate=round(st["failed"] / n, 4),
+            cache_hit_rate=round(st["cache_hits"] / calls, 4),
+            cached_token_ratio=round(st["cached_tokens"] / (st["input_tokens"] or 1), 4),
+            avg_total_latency_ms=round(st["total_latency_ms_sum"] / calls, 1),
+        )
+    return out
+
+
+async def try_ai_evaluation(task1: str, task2: str, essay: str, writing_test: dict, parts_to_eval: list) -> dict:
+    """Try AI evaluation via Anthropic or OpenAI"""
+    prompt = build_writing_prompt(task1, task2, essay, writing_test)
 
     try:
         # ========== 1) OpenAI ==========
         if OPENAI_API_KEY:
             print(f"[Writing AI] OpenAI ga so'rov yuborilmoqda... (kalit: {OPENAI_API_KEY[:8]}...)")
-            for model in ("gpt-4o-mini", "gpt-4o", "gpt-3.5-turbo"):
+            for model in WRITING_AI_MODELS["openai"]:
                 try:
                     print(f"[Writing AI] Model: {model} sinab ko'rilmoqda...")
-                    async with httpx.AsyncClient(timeout=120.0) as client:
+                    payload = {
+                        "model": model,
+                        "messages": [
+                            {"role": "system", "content": WRITING_SYSTEM_PREFIX},
+                            {"role": "user", "content": prompt}
+                        ],
+                        "temperature": 0.3,
+                        "max_tokens": 2000,
+                        # Bir xil prefiksli so'rovlarni bitta cache ga yo'naltirish
+                        "prompt_cache_key": f"cefr-writing-{WRITING_RUBRIC_VERSION}",
+                    }
+                    if model in OPENAI_RESPONSE_FORMATS:
+                        payload["response_format"] = OPENAI_RESPONSE_FORMATS[model]
+                    t0 = time.perf_counter()
+                    async with httpx.AsyncClient(timeout=AI_TIMEOUT) as client:
                         r = await client.post(
-                            "https://api.openai.com/v1/chat/completions",
+                            f"{OPENAI_BASE_URL}/chat/completions",
                             headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
-                            json={
-                                "model": model,
-                                "messages": [
-                                    {"role": "system", "content": "You are a CEFR writing examiner. Reply ONLY with a valid JSON object. Do NOT use markdown code blocks. Do NOT add any text before or after the JSON. The JSON must have keys: task1, task2, essay, general_feedback. Each of task1, task2, essay must have a \"score\" field (integer 0-9) and feedback fields."},
-                                    {"role": "user", "content": prompt}
-                                ],
-                                "temperature": 0.3,
-                                "max_tokens": 2000,
-                            },
+                            json=payload,
                         )
+                        if r.status_code == 400 and "response_format" in payload and "response_format" in r.text:
+                            # Model structured output ni qo'llamasa – oddiy rejimda qayta so'rash
+                            print(f"[Writing AI] OpenAI ({model}) response_format qo'llanmadi, oddiy rejimda qayta so'ralmoqda...")
+                            payload.pop("response_format")
+                            r = await client.post(
+                                f"{OPENAI_BASE_URL}/chat/completions",
+                                headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
+                                json=payload,
+                            )
                         print(f"[Writing AI] OpenAI ({model}) status: {r.status_code}")
 
                         if r.status_code == 200:
                             data = r.json()
+                            telemetry = record_ai_usage(model, data.get("usage"), time.perf_counter() - t0)
+                            print(f"[Writing AI] OpenAI ({model}) usage: {telemetry}")
                             choices = data.get("choices") or []
                             if choices:
                                 msg = choices[0].get("message") or {}
@@ -1742,28 +3964,21 @@ Return ONLY valid JSON (no markdown, no code blocks):
                                 print(f"[Writing AI] OpenAI ({model}) javob uzunligi: {len(content)}")
                                 if content:
                                     print(f"[Writing AI] Javob boshi: {content[:200]}")
-                                    ev = extract_json(content)
-                                    if ev:
-                                        print(f"[Writing AI] JSON parse muvaffaqiyatli. Kalitlar: {list(ev.keys())}")
-                                        ev = normalize_ev(ev)
-                                        print(f"[Writing AI] Normalize keyin: {list(ev.keys())}")
-                                    if ev and validate_ev(ev):
-                                        # Score larni tekshirish
-                                        for k in ("task1", "task2", "essay"):
-                                            s = ev.get(k, {}).get("score", "YO'Q")
-                                            print(f"[Writing AI] {k} score = {s}")
-                                        print(f"[Writing AI] OpenAI ({model}) MUVAFFAQIYATLI!")
-                                        return format_ai_result(ev, task1, task2, essay)
-                                    else:
-                                        print(f"[Writing AI] OpenAI ({model}) javob yaroqsiz.")
-                                        if ev:
-                                            # score kaliti bor/yo'qligini tekshirish
-                                            for k in ("task1", "task2", "essay"):
-                                                d = ev.get(k, "YO'Q")
-                                                if isinstance(d, dict):
-                                                    print(f"[Writing AI]   {k}: keys={list(d.keys())}, score={d.get('score', 'YOQ')}")
-                                                else:
-                                                    print(f"[Writing AI]   {k}: {type(d)} = {str(d)[:100]}")
+                                ev, repairs = parse_ai_evaluation(content)
+                                record_parse_result(model, ev is not None, repairs, structured="response_format" in payload)
+                                if ev:
+                                    if repairs:
+                                        print(f"[Writing AI] OpenAI ({model}) javobi tuzatildi: {repairs}")
+                                    # Score larni tekshirish
+                                    for k in ("task1", "task2", "essay"):
+                                        s = ev.get(k, {}).get("score", "YO'Q")
+                                        print(f"[Writing AI] {k} score = {s}")
+                                    print(f"[Writing AI] OpenAI ({model}) MUVAFFAQIYATLI!")
+                                    result = format_ai_result(ev, task1, task2, essay)
+                                    result["telemetry"] = dict(telemetry, provider="openai", repairs=repairs)
+                                    return result
+                                else:
+                                    print(f"[Writing AI] OpenAI ({model}) javob yaroqsiz.")
                             else:
                                 print(f"[Writing AI] OpenAI ({model}) - choices bo'sh!")
                         elif r.status_code == 401:
@@ -1776,7 +3991,7 @@ Return ONLY valid JSON (no markdown, no code blocks):
                         else:
                             print(f"[Writing AI] OpenAI ({model}) xato: status={r.status_code}, body={r.text[:300]}")
                 except httpx.TimeoutException:
-                    print(f"[Writing AI] OpenAI ({model}) TIMEOUT (120s)")
+                    print(f"[Writing AI] OpenAI ({model}) TIMEOUT ({AI_TIMEOUT:.0f}s)")
                 except Exception as e:
                     print(f"[Writing AI] OpenAI ({model}) Exception: {type(e).__name__}: {e}")
         else:
@@ -1786,32 +4001,51 @@ Return ONLY valid JSON (no markdown, no code blocks):
         if ANTHROPIC_API_KEY and ANTHROPIC_API_KEY.strip():
             print("[Writing AI] Anthropic ga so'rov yuborilmoqda...")
             try:
-                async with httpx.AsyncClient(timeout=120.0) as client:
+                anthropic_model = WRITING_AI_MODELS["anthropic"][0]
+                t0 = time.perf_counter()
+                async with httpx.AsyncClient(timeout=AI_TIMEOUT) as client:
                     r = await client.post(
-                        "https://api.anthropic.com/v1/messages",
+                        f"{ANTHROPIC_BASE_URL}/messages",
                         headers={"x-api-key": ANTHROPIC_API_KEY.strip(), "anthropic-version": "2023-06-01", "content-type": "application/json"},
-                        json={"model": "claude-3-haiku-20240307", "max_tokens": 2000, "messages": [{"role": "user", "content": prompt}]},
+                        json={
+                            "model": anthropic_model, "max_tokens": 2000,
+                            # Barqaror prefiks (tools + system) keshlanadi, faqat user xabari o'zgaradi
+                            "system": [{"type": "text", "text": WRITING_SYSTEM_PREFIX, "cache_control": {"type": "ephemeral"}}],
+                            "messages": [{"role": "user", "content": prompt}],
+                            # Tool input_schema orqali JSON strukturasini majburlash
+                            "tools": [ANTHROPIC_EVAL_TOOL],
+                            "tool_choice": {"type": "tool", "name": ANTHROPIC_EVAL_TOOL["name"]},
+                        },
                     )
                     print(f"[Writing AI] Anthropic status: {r.status_code}")
                     if r.status_code == 200:
                         data = r.json()
+                        telemetry = record_ai_usage(anthropic_model, data.get("usage"), time.perf_counter() - t0)
+                        print(f"[Writing AI] Anthropic usage: {telemetry}")
                         content = ""
+                        tool_input = None
                         for block in data.get("content", []):
-                            if block.get("type") == "text":
+                            if block.get("type") == "tool_use" and isinstance(block.get("input"), dict):
+                                tool_input = block["input"]
+                            elif block.get("type") == "text":
                                 content += block.get("text", "")
-                        if not content and data.get("content"):
-                            content = str(data["content"][0].get("text", ""))
-                        content = (content or "").strip()
-                        if content:
+                        if tool_input is not None:
+                            ev, repairs = _coerce_evaluation(tool_input)
+                            record_parse_result(anthropic_model, ev is not None, repairs, structured=True)
+                        else:
+                            content = (content or "").strip()
                             print(f"[Writing AI] Anthropic javob uzunligi: {len(content)}")
-                            ev = extract_json(content)
-                            if ev:
-                                ev = normalize_ev(ev)
-                            if ev and validate_ev(ev):
-                                print("[Writing AI] Anthropic MUVAFFAQIYATLI!")
-                                return format_ai_result(ev, task1, task2, essay)
-                            else:
-                                print(f"[Writing AI] Anthropic javob yaroqsiz: {content[:200]}")
+                            ev, repairs = parse_ai_evaluation(content)
+                            record_parse_result(anthropic_model, ev is not None, repairs)
+                        if ev:
+                            if repairs:
+                                print(f"[Writing AI] Anthropic javobi tuzatildi: {repairs}")
+                            print("[Writing AI] Anthropic MUVAFFAQIYATLI!")
+                            result = format_ai_result(ev, task1, task2, essay)
+                            result["telemetry"] = dict(telemetry, provider="anthropic", repairs=repairs)
+                            return result
+                        else:
+                            print(f"[Writing AI] Anthropic javob yaroqsiz: {(content or str(tool_input))[:200]}")
                     else:
                         print(f"[Writing AI] Anthropic xato: status={r.status_code}, body={r.text[:300]}")
             except Exception as e:
@@ -1926,11 +4160,151 @@ def calc_final(reading_pct, listening_pct, writing_pct):
     return {"overall_percentage": round(overall, 1), "cefr_level": cefr, "level_description": desc}
 
 
+# ============ AUDIO METAMA'LUMOTLARI (MP3 / WAV / OGG) ============
+
+# Davomiylik, bitrate va hajm fayl sarlavhalaridan (kutubxonasiz) olinadi: MP3 — Xing/Info yoki VBRI sarlavhasi, bo'lmasa
+# freymlar sanaladi; WAV — fmt/data chunklari; OGG — Vorbis/Opus identifikatsiya paketi va oxirgi sahifaning granule'i.
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 25: (11025, 12000, 8000)}
+
+
+def _mp3_frame(buf, pos: int) -> tuple | None:
+    """pos dagi MPEG audio freym sarlavhasi -> (uzunlik, namunalar soni, sample rate, bitrate kbps, versiya, mono)."""
+    if pos + 4 > len(buf) or buf[pos] != 0xFF or buf[pos + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2, b3 = buf[pos + 1], buf[pos + 2], buf[pos + 3]
+    version = {3: 1, 2: 2, 0: 25}.get((b1 >> 3) & 3)
+    layer = {3: 1, 2: 2, 1: 3}.get((b1 >> 1) & 3)
+    br_index, sr_index = b2 >> 4, (b2 >> 2) & 3
+    if version is None or layer is None or br_index in (0, 15) or sr_index == 3:
+        return None
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][br_index]
+    sample_rate = _MP3_SAMPLE_RATES[version][sr_index]
+    samples = 384 if layer == 1 else 1152 if layer == 2 or version == 1 else 576
+    padding = (b2 >> 1) & 1
+    length = samples // 8 * bitrate * 1000 // sample_rate + padding * (4 if layer == 1 else 1)
+    return length, samples, sample_rate, bitrate, version, (b3 >> 6) == 3
+
+
+def parse_mp3(buf) -> dict | None:
+    pos = 0
+    if buf[:3] == b"ID3" and len(buf) >= 10:
+        size = (buf[6] & 0x7F) << 21 | (buf[7] & 0x7F) << 14 | (buf[8] & 0x7F) << 7 | (buf[9] & 0x7F)
+        pos = 10 + size + (10 if buf[5] & 0x10 else 0)
+    # Birinchi freym: ketidan yana freym kelishi kerak (tasodifiy 0xFFE baytlari hisobga olinmasin)
+    limit = min(len(buf), pos + 64 * 1024)
+    while pos < limit:
+        frame = _mp3_frame(buf, pos)
+        if frame and (pos + frame[0] >= len(buf) or _mp3_frame(buf, pos + frame[0])):
+            break
+        pos += 1
+    else:
+        return None
+    start = pos
+    length, samples, sample_rate, _bitrate, version, mono = frame
+    frames = None
+    side = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+    tag = bytes(buf[start + 4 + side:start + 8 + side])
+    if tag in (b"Xing", b"Info") and buf[start + 11 + side] & 1:
+        frames = int.from_bytes(buf[start + 12 + side:start + 16 + side], "big")
+    elif bytes(buf[start + 36:start + 40]) == b"VBRI":
+        frames = int.from_bytes(buf[start + 50:start + 54], "big")
+    if not frames:
+        frames = 0
+        while frame:
+            frames += 1
+            pos += frame[0]
+            frame = _mp3_frame(buf, pos)
+    duration = frames * samples / sample_rate
+    return {"format": "mp3", "duration": duration, "sample_rate": sample_rate,
+            "bitrate": (len(buf) - start) * 8 / duration / 1000 if duration else None}
+
+
+def parse_wav(buf) -> dict | None:
+    if buf[:4] != b"RIFF" or buf[8:12] != b"WAVE":
+        return None
+    pos, byte_rate, sample_rate = 12, None, None
+    while pos + 8 <= len(buf):
+        chunk, size = bytes(buf[pos:pos + 4]), int.from_bytes(buf[pos + 4:pos + 8], "little")
+        if chunk == b"fmt ":
+            sample_rate = int.from_bytes(buf[pos + 12:pos + 16], "little")
+            byte_rate = int.from_bytes(buf[pos + 16:pos + 20], "little")
+        elif chunk == b"data" and byte_rate:
+            size = min(size, len(buf) - pos - 8)
+            return {"format": "wav", "duration": size / byte_rate, "sample_rate": sample_rate,
+                    "bitrate": byte_rate * 8 / 1000}
+        pos += 8 + size + (size & 1)
+    return None
+
+
+def parse_ogg(buf) -> dict | None:
+    if buf[:4] != b"OggS" or len(buf) < 28:
+        return None
+    packet = bytes(buf[27 + buf[26]:27 + buf[26] + 32])  # birinchi sahifaning birinchi paketi (27 bayt sarlavha + segment jadvali)
+    if packet[:7] == b"\x01vorbis":
+        sample_rate, pre_skip = int.from_bytes(packet[12:16], "little"), 0
+    elif packet[:8] == b"OpusHead":
+        sample_rate, pre_skip = 48000, int.from_bytes(packet[10:12], "little")
+    else:
+        return None
+    last = bytes(buf[max(0, len(buf) - 65536):]).rfind(b"OggS")
+    if last < 0 or not sample_rate:
+        return None
+    last += max(0, len(buf) - 65536)
+    granule = int.from_bytes(buf[last + 6:last + 14], "little")
+    duration = max(granule - pre_skip, 0) / sample_rate
+    return {"format": "ogg", "duration": duration, "sample_rate": sample_rate,
+            "bitrate": len(buf) * 8 / duration / 1000 if duration else None}
+
+
+def audio_metadata(path: Path) -> dict:
+    """Fayl hajmi va (formati tanilsa) davomiylik (s), o'rtacha bitrate (kbps), sample rate."""
+    size = path.stat().st_size
+    meta = None
+    if size:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for parse in (parse_wav, parse_ogg, parse_mp3):
+                try:
+                    meta = parse(buf)
+                except (IndexError, ValueError, ZeroDivisionError):
+                    meta = None
+                if meta:
+                    break
+    meta = meta or {"format": path.suffix.lstrip(".").lower() or None, "duration": None, "bitrate": None}
+    meta["bytes"] = size
+    if meta.get("duration") is not None:
+        meta["duration"] = round(meta["duration"], 2)
+    if meta.get("bitrate") is not None:
+        meta["bitrate"] = round(meta["bitrate"])
+    return meta
+
+
 # ============ ROUTES ============
 
 @app.on_event("startup")
 async def startup():
     init_default_data()
+    gc_bank_versions()
+    schedule_listening_prewarm()
+    short = [m for m, st in writing_prefix_cache_status().items() if not st["cacheable"]]
+    if short:
+        print(f"[Writing AI] System prefiks ~{WRITING_PREFIX_TOKENS_EST} token – prompt cache minimumidan kichik, "
+              f"keshlanmaydi: {', '.join(short)} (GET /admin/ai-stats)")
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _writing_pool is not None:
+        _writing_pool.shutdown(cancel_futures=True)
+    if _image_pool is not None:
+        _image_pool.shutdown(cancel_futures=True)
+    flush_part_exposure()
 
 @app.get("/lang/{lang}")
 async def set_language(lang: str):
@@ -2344,8 +4718,18 @@ async def reading_test(request: Request):
         s = get_session(sid)
         s["user_id"] = user["id"]
 
-    test = _build_test_from_all_tests("reading", user)
     s = get_session(sid)
+    if adaptive_mode(request, s):
+        test = adaptive_next_test("reading", s, user)
+        if test is None:
+            if not s.get("reading", {}).get("completed"):
+                finish_adaptive_section("reading", s)
+            resp = RedirectResponse(url="/test/listening", status_code=302)
+            resp.set_cookie(key="session_id", value=sid, max_age=7200)
+            return resp
+    else:
+        test = _build_test_from_all_tests("reading", user)
+        pin_served_test("reading", s, test)
     s["reading_test_id"] = test.get("id", "reading_combined")
     t = get_translations(request)
     lang = get_lang(request)
@@ -2362,10 +4746,18 @@ async def submit_reading(request: Request):
     user = get_user_by_id(user_id) if user_id else None
     fd = await request.form()
     answers = {k: v for k, v in fd.items() if k != "session_id"}
-    # Rebuild test from all tests (same as when showing)
-    test = _build_test_from_all_tests("reading", user or {})
+    adaptive_state = s.get("adaptive", {}).get("reading")
+    if adaptive_state and not adaptive_state.get("done"):
+        step = adaptive_submit("reading", s, answers, user)
+        if user_id and step["part"]:
+            _mark_parts_seen(user_id, "reading", step["part"]["_source_test_id"], [step["part"]])
+        res = s.get("reading", {}) if step["done"] else {}
+        return JSONResponse({"success": True, "adaptive": True, "done": step["done"], "score": res.get("score"), "total": res.get("total"),
+                             "percentage": res.get("percentage"), "redirect": "/test/listening" if step["done"] else "/test/reading"})
+    # Sahifada ko'rsatilgan partlar bo'yicha; sessiyada bo'lmasa (eski sessiya) qayta tanlanadi
+    test = served_test("reading", s) or _build_test_from_all_tests("reading", user or {})
     result = calculate_reading_score(answers, test)
-    s["reading"] = {"completed": True, "score": result["correct"], "total": result["total"], "percentage": result["percentage"], "details": result["details"]}
+    s["reading"] = {"completed": True, "score": result["correct"], "total": result["total"], "percentage": result["percentage"], "details": result["details"], "parts": scored_parts(test, "reading")}
     if user_id:
         # Mark parts as seen - use _source_test_id if available
         for part in test["parts"]:
@@ -2391,68 +4783,453 @@ async def listening_test(request: Request):
     s = get_session(sid)
     user_id = s.get("user_id")
     user = get_user_by_id(user_id) if user_id else None
-    test = _build_test_from_all_tests("listening", user or {})
+    if adaptive_mode(request, s):
+        test = adaptive_next_test("listening", s, user)
+        if test is None:
+            if not s.get("listening", {}).get("completed"):
+                finish_adaptive_section("listening", s)
+            return RedirectResponse(url="/test/writing", status_code=302)
+    else:
+        test = _build_test_from_all_tests("listening", user or {})
+        pin_served_test("listening", s, test)
     s["listening_test_id"] = test.get("id", "listening_combined")
     t = get_translations(request)
     lang = get_lang(request)
     return templates.TemplateResponse("test_listening.html", {"request": request, "test_data": test, "session_id": sid, "t": t, "lang": lang})
 
 # ============ TTS AUDIO GENERATION FOR LISTENING ============
-import hashlib
-import base64
 
-# Cache for generated audio (in-memory, for demo; use Redis/disk in production)
-audio_cache: Dict[str, bytes] = {}
+# Sintez qilingan audio diskda kontent-manzil bo'yicha saqlanadi: data/tts_cache/<sha256>.mp3, kalit —
+# (model, ovoz, matn) hash'i. Takroriy so'rov OpenAI ga bormaydi va audio JSON da qaytmaydi — URL qaytadi.
+# Umumiy hajm TTS_CACHE_MAX_BYTES dan oshsa eng uzoq ishlatilmagan fayllar o'chiriladi (tartib fayl mtime'ida
+# saqlanadi, qayta ishga tushganda ham saqlanib qoladi). Eng so'nggi fayllar xotirada ham turadi (hot tier).
+TTS_MODEL = "tts-1"
+TTS_VOICES = {"alloy", "echo", "fable", "onyx", "nova", "shimmer"}
+TTS_MAX_CHARS = 4000
+TTS_CACHE_DIR = DATA_DIR / "tts_cache"
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TTS_HOT_MAX_BYTES = int(os.getenv("TTS_HOT_MAX_BYTES", str(16 * 1024 * 1024)))
+TTS_HOT_ITEM_MAX_BYTES = 2 * 1024 * 1024
+
+
+class AudioStore:
+    """Kontent-manzilli audio fayllar: diskda hajm bo'yicha LRU, xotirada kichik hot tier."""
+
+    def __init__(self, directory: Path, max_bytes: int, hot_max_bytes: int, suffix: str = ".mp3"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_max_bytes = hot_max_bytes
+        self.suffix = suffix
+        self._index: OrderedDict[str, int] | None = None  # kalit -> hajm, eng eskisi boshida
+        self._total = 0
+        self._hot: OrderedDict[str, bytes] = OrderedDict()
+        self._hot_total = 0
+        self._pinned: set = set()  # bankdagi partlar ishlatadigan fayllar LRU bo'yicha o'chirilmaydi
+
+    def _scan(self):
+        """Indeksni diskdan qayta quradi: LRU tartibi fayl mtime bo'yicha (contains har hitda utime qiladi),
+        shuning uchun barcha workerlarning ishlatishi hisobga olinadi."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.directory.glob("*" + self.suffix):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path.stem, st.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _mtime, key, size in entries)
+        self._total = sum(self._index.values())
+
+    def _load_index(self) -> OrderedDict[str, int]:
+        if self._index is None:
+            self._scan()
+            self._evict(rescan=False)  # limit kamaytirilgan bo'lishi mumkin
+        return self._index
+
+    def path(self, key: str) -> Path:
+        return self.directory / (key + self.suffix)
+
+    def contains(self, key: str) -> bool:
+        """Kalit bor bo'lsa LRU tartibida yangilanadi. Boshqa worker o'chirgan fayl indeksdan chiqariladi,
+        indeks yuklangandan keyin boshqa worker yozgan fayl esa diskdan topilib indeksga qo'shiladi."""
+        index = self._load_index()
+        path = self.path(key)
+        if key not in index:
+            try:
+                size = path.stat().st_size
+            except OSError:
+                return False
+            index[key] = size
+            self._total += size
+        try:
+            os.utime(path)
+        except OSError:
+            self._drop(key)
+            return False
+        index.move_to_end(key)
+        return True
+
+    def get_hot(self, key: str) -> bytes | None:
+        data = self._hot.get(key)
+        if data is not None:
+            self._hot.move_to_end(key)
+        return data
+
+    async def read(self, key: str) -> bytes | None:
+        """Kichik fayl baytlari: hot tier dan yoki diskdan (keyin hot tier ga qo'shiladi). Katta yoki yo'q fayl — None."""
+        data = self.get_hot(key)
+        if data is not None or not self.contains(key) or self._index[key] > min(TTS_HOT_ITEM_MAX_BYTES, self.hot_max_bytes):
+            return data
+        try:
+            data = await asyncio.to_thread(self.path(key).read_bytes)
+        except OSError:
+            self._drop(key)
+            return None
+        self._remember_hot(key, data)
+        return data
+
+    def write(self, key: str, data: bytes):
+        """Faylni atomik yozadi (bloklaydi — event loop dan `asyncio.to_thread` bilan chaqiring); keyin `add`."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp = self.directory / f"{key}.{uuid.uuid4().hex[:8]}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def add(self, key: str, data: bytes):
+        index = self._load_index()
+        if key in index:
+            self._total -= index.pop(key)
+        index[key] = len(data)
+        self._total += len(data)
+        self._remember_hot(key, data)
+        self._evict()
+
+    def _remember_hot(self, key: str, data: bytes):
+        if len(data) > min(TTS_HOT_ITEM_MAX_BYTES, self.hot_max_bytes):
+            return
+        old = self._hot.pop(key, None)
+        if old is not None:
+            self._hot_total -= len(old)
+        self._hot[key] = data
+        self._hot_total += len(data)
+        while self._hot_total > self.hot_max_bytes:
+            _key, evicted = self._hot.popitem(last=False)
+            self._hot_total -= len(evicted)
+
+    def pin(self, keys, add: bool = False):
+        if not add:
+            self._pinned = set()
+        self._pinned.update(k for k in keys if k)
+
+    def _drop(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._total -= size
+        data = self._hot.pop(key, None)
+        if data is not None:
+            self._hot_total -= len(data)
+
+    def _evict(self, rescan: bool = True):
+        """_total – shu process ko'rgan hajm (taxmin): limitdan oshsa, o'chirishdan oldin disk qayta sanaladi."""
+        if self._total <= self.max_bytes:
+            return
+        if rescan:
+            self._scan()
+            if self._total <= self.max_bytes:
+                return
+        index = self._index
+        for key in [k for k in index if k not in self._pinned]:
+            if self._total <= self.max_bytes or len(index) <= 1:
+                break
+            self.path(key).unlink(missing_ok=True)
+            self._drop(key)
+            print(f"[TTS] keshdan o'chirildi: {key}")
+
+    def stats(self) -> dict:
+        index = self._load_index()
+        return {"files": len(index), "bytes": self._total, "max_bytes": self.max_bytes, "pinned": len(self._pinned),
+                "hot_files": len(self._hot), "hot_bytes": self._hot_total}
+
+
+tts_store = AudioStore(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_HOT_MAX_BYTES)
+
+
+def tts_cache_key(text: str, voice: str) -> str:
+    return hashlib.sha256(f"{TTS_MODEL}\n{voice}\n{text}".encode("utf-8")).hexdigest()
+
+
+def tts_audio_url(key: str) -> str:
+    return f"/audio/tts/{key}.mp3"
+
+
+# Bir xil kalit uchun bir vaqtda kelgan so'rovlar bitta OpenAI chaqiruvini kutadi (single-flight)
+_tts_inflight: Dict[str, asyncio.Task] = {}
+_tts_metrics = {"cache_hits": 0, "synthesized": 0, "coalesced": 0, "errors": 0}
+
+
+def _tts_flight_done(key: str, task: asyncio.Task):
+    _tts_inflight.pop(key, None)
+    if not task.cancelled() and task.exception() is not None:
+        _tts_metrics["errors"] += 1
+
+
+async def synthesize_tts(text: str, voice: str) -> str:
+    """Matnni audio faylga aylantiradi va kesh kalitini qaytaradi. Keshda bo'lsa OpenAI chaqirilmaydi; shu kalit
+    hozir sintez qilinayotgan bo'lsa, o'sha ishni kutadi. Ish alohida task: kutayotganlardan biri uzilsa ham to'xtamaydi."""
+    key = tts_cache_key(text, voice)
+    if tts_store.contains(key):
+        _tts_metrics["cache_hits"] += 1
+        return key
+    task = _tts_inflight.get(key)
+    if task is None:
+        task = _tts_inflight[key] = asyncio.create_task(_fetch_tts(key, text, voice))
+        task.add_done_callback(lambda t, key=key: _tts_flight_done(key, t))
+    else:
+        _tts_metrics["coalesced"] += 1
+    return await asyncio.shield(task)
+
+
+async def _fetch_tts(key: str, text: str, voice: str) -> str:
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        r = await client.post(
+            f"{OPENAI_BASE_URL}/audio/speech",
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
+            json={"model": TTS_MODEL, "input": text, "voice": voice, "response_format": "mp3"},
+        )
+    if r.status_code != 200:
+        print(f"[TTS] OpenAI error: {r.status_code} - {r.text[:200]}")
+        raise RuntimeError(f"TTS API error: {r.status_code}")
+    await asyncio.to_thread(tts_store.write, key, r.content)
+    tts_store.add(key, r.content)
+    _tts_metrics["synthesized"] += 1
+    return key
+
 
 @app.post("/api/tts")
 async def generate_tts(request: Request):
-    """Generate audio from transcript text using OpenAI TTS API"""
-    if not OPENAI_API_KEY:
-        return JSONResponse({"error": "TTS not available - OPENAI_API_KEY not set"}, status_code=503)
-    
+    """Transcript uchun audio URL (OpenAI TTS, diskdagi kesh orqali)."""
     try:
         body = await request.json()
-        text = body.get("text", "").strip()
-        voice = body.get("voice", "alloy")  # alloy, echo, fable, onyx, nova, shimmer
-        
-        if not text:
-            return JSONResponse({"error": "Text is required"}, status_code=400)
-        
-        if len(text) > 4000:
-            return JSONResponse({"error": "Text too long (max 4000 chars)"}, status_code=400)
-        
-        # Check cache
-        cache_key = hashlib.md5(f"{text}:{voice}".encode()).hexdigest()
-        if cache_key in audio_cache:
-            audio_b64 = base64.b64encode(audio_cache[cache_key]).decode()
-            return JSONResponse({"audio": audio_b64, "cached": True})
-        
-        # Call OpenAI TTS API
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post(
-                "https://api.openai.com/v1/audio/speech",
-                headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
-                json={
-                    "model": "tts-1",
-                    "input": text,
-                    "voice": voice,
-                    "response_format": "mp3"
-                }
-            )
-            
-            if r.status_code == 200:
-                audio_data = r.content
-                # Cache the audio
-                audio_cache[cache_key] = audio_data
-                audio_b64 = base64.b64encode(audio_data).decode()
-                return JSONResponse({"audio": audio_b64, "cached": False})
-            else:
-                print(f"[TTS] OpenAI error: {r.status_code} - {r.text[:200]}")
-                return JSONResponse({"error": f"TTS API error: {r.status_code}"}, status_code=500)
-                
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    text = (body.get("text") or "").strip()
+    voice = body.get("voice") or "alloy"
+    if not text:
+        return JSONResponse({"error": "Text is required"}, status_code=400)
+    if len(text) > TTS_MAX_CHARS:
+        return JSONResponse({"error": f"Text too long (max {TTS_MAX_CHARS} chars)"}, status_code=400)
+    if voice not in TTS_VOICES:
+        return JSONResponse({"error": "Unknown voice"}, status_code=400)
+    cached = tts_store.contains(tts_cache_key(text, voice))
+    if not cached and not OPENAI_API_KEY:
+        return JSONResponse({"error": "TTS not available - OPENAI_API_KEY not set"}, status_code=503)
+    try:
+        key = await synthesize_tts(text, voice)
     except Exception as e:
         print(f"[TTS] Error: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
+    return JSONResponse({"url": tts_audio_url(key), "cached": cached})
+
+
+AUDIO_CHUNK_BYTES = 64 * 1024
+
+
+def parse_byte_range(header: str, size: int) -> tuple | None:
+    """`Range: bytes=a-b` (bitta oraliq) -> (start, end) yopiq oraliq. Noto'g'ri yoki qoniqtirib bo'lmaydigan — ValueError;
+    bir nechta oraliq so'ralsa None (butun fayl qaytariladi)."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        raise ValueError("bad range")
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        length = int(last)
+        if length <= 0:
+            raise ValueError("bad range")
+        start, end = max(size - length, 0), size - 1
+    if start > end or start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+def _iter_file(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(AUDIO_CHUNK_BYTES, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_audio_response(request: Request, path: Path, etag: str, media_type: str = "audio/mpeg",
+                          data: bytes | None = None, cache_control: str = "public, max-age=31536000, immutable"):
+    """Audio javobi: ETag/If-None-Match (304), Range/If-Range (206/416), fayl bo'laklab oqim bilan uzatiladi
+    (xotirada `data` bo'lsa undan kesib olinadi). <audio> butun fayl kelishini kutmasdan ijro eta oladi."""
+    etag = f'"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    size = len(data) if data is not None else path.stat().st_size
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size - 1)
+    length = max(end - start + 1, 0)
+    headers["Content-Length"] = str(length)
+    status = 200
+    if byte_range:
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if request.method == "HEAD":
+        return Response(status_code=status, headers=headers, media_type=media_type)
+    if data is not None:
+        return Response(data[start:end + 1], status_code=status, headers=headers, media_type=media_type)
+    return StreamingResponse(_iter_file(path, start, length), status_code=status, headers=headers, media_type=media_type)
+
+
+@app.api_route("/audio/tts/{key}.mp3", methods=["GET", "HEAD"])
+async def tts_audio(request: Request, key: str):
+    """Keshdagi TTS audio: kontent-manzilli, shuning uchun ETag = kalit va javob o'zgarmas (uzoq keshlanadi)."""
+    if not re.fullmatch(r"[0-9a-f]{64}", key):
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    data = await tts_store.read(key)
+    if data is None and not tts_store.contains(key):
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    try:
+        return ranged_audio_response(request, tts_store.path(key), key, data=data)
+    except FileNotFoundError:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+# Listening bankidagi audio oldindan tayyorlanadi: admin saqlaganda va ishga tushganda audio_url siz (yoki transcripti
+# o'zgargan) partlar fonda sintez qilinadi va URL partga yoziladi — nomzod TTS ni kutmaydi.
+TTS_PREWARM = os.getenv("TTS_PREWARM", "1") == "1"
+TTS_PREWARM_CONCURRENCY = max(1, int(os.getenv("TTS_PREWARM_CONCURRENCY", "4")))
+TTS_PREWARM_VOICE = "alloy"
+_tts_prewarm_task: asyncio.Task | None = None
+_tts_prewarm_again = False
+_tts_prewarm_last: dict = {}
+
+
+def part_transcript(part: dict) -> str:
+    """Part audiosi uchun matn — test_listening.html dagi data-transcript bilan bir xil."""
+    if part.get("type") == "short_conversations":
+        return "\n\n".join(q.get("transcript") or "" for q in part.get("questions") or ())
+    if part.get("type") in ("speaker_matching", "multiple_matching"):
+        return "\n\n".join(s.get("transcript") or "" for s in part.get("speakers") or ())
+    return part.get("transcript") or ""
+
+
+def part_tts_key(part: dict) -> str | None:
+    text = part_transcript(part)[:TTS_MAX_CHARS].strip()
+    return tts_cache_key(text, TTS_PREWARM_VOICE) if text else None
+
+
+def generated_audio_key(part: dict) -> str | None:
+    """audio_url sintez qilingan fayl (/audio/tts/<kalit>.mp3) bo'lsa — uning kaliti. Admin panel partni formadan
+    qayta yig'adi, shuning uchun kalit alohida maydonda emas, URL ning o'zida."""
+    m = re.fullmatch(r"/audio/tts/([0-9a-f]{64})\.mp3", part.get("audio_url") or "")
+    return m.group(1) if m else None
+
+
+def parts_needing_audio(tests: list):
+    """(part, kalit, matn): audio_url yo'q, transcripti o'zgargan yoki sintez qilingan fayli yo'qolgan partlar.
+    Admin yuklagan audio tegilmaydi."""
+    for test in tests:
+        for part in test.get("parts") or ():
+            generated = generated_audio_key(part)
+            if part.get("audio_url") and not generated:
+                continue
+            key = part_tts_key(part)
+            if key is None:
+                continue
+            if generated == key and tts_store.contains(key):
+                continue
+            yield part, key, part_transcript(part)[:TTS_MAX_CHARS].strip()
+
+
+def pin_bank_audio():
+    """Bankdagi partlar URL orqali ishlatadigan sintez fayllari LRU bo'yicha o'chirilmasin."""
+    tts_store.pin(generated_audio_key(part) for test in current_bank("listening").tests for part in test.get("parts") or ())
+
+
+async def prewarm_listening_audio() -> dict:
+    """Audiosi yo'q partlarni cheklangan parallellikda sintez qiladi, so'ng URL larni bank fayliga yozadi
+    (fayl oxirida qayta o'qiladi: shu orada admin o'zgartirgan partlar transcript kaliti bo'yicha tekshiriladi)."""
+    pin_bank_audio()
+    jobs = {key: text for _part, key, text in parts_needing_audio(current_bank("listening").tests)}
+    tts_store.pin(jobs, add=True)
+    stats = {"pending": len(jobs), "generated": 0, "failed": 0, "updated_parts": 0}
+    if not jobs:
+        return stats
+    sem = asyncio.Semaphore(TTS_PREWARM_CONCURRENCY)
+
+    async def one(key: str, text: str) -> str | None:
+        async with sem:
+            try:
+                return await synthesize_tts(text, TTS_PREWARM_VOICE)
+            except Exception as e:
+                print(f"[TTS] oldindan sintez xatosi ({key[:12]}): {e}")
+                return None
+
+    t0 = time.perf_counter()
+    done = {key for key in await asyncio.gather(*(one(k, t) for k, t in jobs.items())) if key}
+    stats["generated"] = len(done)
+    stats["failed"] = len(jobs) - len(done)
+    tests = load_json("listening_tests.json").get("tests", [])
+    for part, key, _text in list(parts_needing_audio(tests)):
+        if key in done:
+            part["audio_url"] = tts_audio_url(key)
+            stats["updated_parts"] += 1
+    if stats["updated_parts"]:
+        attach_audio_metadata(tests)  # o'qish va yozish orasida await bo'lmasin (admin saqlashi bilan aralashmasin)
+        publish_bank("listening", tests)
+    print(f"[TTS] oldindan sintez: {stats} ({time.perf_counter() - t0:.1f}s)")
+    return stats
+
+
+async def _run_listening_prewarm():
+    global _tts_prewarm_task, _tts_prewarm_again, _tts_prewarm_last
+    try:
+        while True:
+            _tts_prewarm_again = False
+            _tts_prewarm_last = dict(await prewarm_listening_audio(), finished_at=datetime.now().isoformat())
+            if not _tts_prewarm_again:
+                break
+    except Exception as e:
+        print(f"[TTS] oldindan sintez to'xtadi: {e}")
+    finally:
+        _tts_prewarm_task = None
+
+
+def schedule_listening_prewarm():
+    """Fonda oldindan sintezni boshlaydi; ishlab turgan bo'lsa, tugagach yana bir marta o'tadi."""
+    global _tts_prewarm_task, _tts_prewarm_again
+    if not (TTS_PREWARM and OPENAI_API_KEY):
+        pin_bank_audio()
+        return
+    if _tts_prewarm_task is not None:
+        _tts_prewarm_again = True
+        return
+    _tts_prewarm_task = asyncio.create_task(_run_listening_prewarm())
+
+
+@app.get("/admin/tts/stats", response_class=JSONResponse)
+async def admin_tts_stats(request: Request):
+    if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    return JSONResponse({"store": tts_store.stats(), "requests": dict(_tts_metrics, in_flight=len(_tts_inflight)),
+                         "prewarm": {"running": _tts_prewarm_task is not None, "last": _tts_prewarm_last}})
 
 @app.post("/test/listening/submit")
 async def submit_listening(request: Request):
@@ -2463,10 +5240,18 @@ async def submit_listening(request: Request):
     user = get_user_by_id(user_id) if user_id else None
     fd = await request.form()
     answers = {k: v for k, v in fd.items() if k != "session_id"}
-    # Rebuild test from all tests (same as when showing)
-    test = _build_test_from_all_tests("listening", user or {})
+    adaptive_state = s.get("adaptive", {}).get("listening")
+    if adaptive_state and not adaptive_state.get("done"):
+        step = adaptive_submit("listening", s, answers, user)
+        if user_id and step["part"]:
+            _mark_parts_seen(user_id, "listening", step["part"]["_source_test_id"], [step["part"]])
+        res = s.get("listening", {}) if step["done"] else {}
+        return JSONResponse({"success": True, "adaptive": True, "done": step["done"], "score": res.get("score"), "total": res.get("total"),
+                             "percentage": res.get("percentage"), "redirect": "/test/writing" if step["done"] else "/test/listening"})
+    # Sahifada ko'rsatilgan partlar bo'yicha; sessiyada bo'lmasa (eski sessiya) qayta tanlanadi
+    test = served_test("listening", s) or _build_test_from_all_tests("listening", user or {})
     result = calculate_listening_score(answers, test)
-    s["listening"] = {"completed": True, "score": result["correct"], "total": result["total"], "percentage": result["percentage"], "details": result["details"]}
+    s["listening"] = {"completed": True, "score": result["correct"], "total": result["total"], "percentage": result["percentage"], "details": result["details"], "parts": scored_parts(test, "listening")}
     if user_id:
         # Mark parts as seen - use _source_test_id if available
         for part in test["parts"]:
@@ -2501,6 +5286,16 @@ def _writing_test_for_display(test: dict) -> dict:
     return test
 
 
+def get_writing_test_for_grading(test_id: str | None = None, version: str | None = None) -> dict:
+    """Baholash uchun writing test: test_id bo'yicha, topilmasa birinchi test (submit_writing bilan bir xil).
+    version berilsa (sessiya pin qilgan) — shu bank versiyasidan."""
+    tests = (bank_snapshot("writing", version) or current_bank("writing")).tests
+    test = next((t for t in tests if test_id and t.get("id") == test_id), None)
+    if test is None:
+        test = tests[0] if tests else DEFAULT_WRITING
+    return _writing_test_for_display(test)
+
+
 def _default_writing_part(part_number: int) -> dict:
     """DEFAULT_WRITING dan bitta part nusxasi."""
     for p in DEFAULT_WRITING.get("parts", []):
@@ -2513,13 +5308,57 @@ def _default_writing_part(part_number: int) -> dict:
 async def writing_test(request: Request):
     sid = request.cookies.get("session_id")
     if not sid: return RedirectResponse(url="/dashboard", status_code=302)
-    tests = get_writing_tests()
+    tests = pin_bank_version(get_session(sid), "writing", refresh=True).tests
     test = tests[0] if tests else DEFAULT_WRITING
     test = _writing_test_for_display(test)
     t = get_translations(request)
     lang = get_lang(request)
     return templates.TemplateResponse("test_writing.html", {"request": request, "test_data": test, "session_id": sid, "t": t, "lang": lang})
 
+@app.post("/test/writing/live")
+async def writing_live_feedback(request: Request):
+    """Yozish paytidagi jonli tahlil.
+
+    Body: {"task", "version", "start", "delete", "insert", "length"} – oxirgi yuborilgan matnga nisbatan bitta tahrir,
+    yoki {"task", "text"} – to'liq qayta sinxronlash. Versiya/uzunlik mos kelmasa 409 {"resync": true}.
+    """
+    sid = request.cookies.get("session_id")
+    if not sid: return JSONResponse({"error": "No session"}, status_code=400)
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    task = body.get("task") if isinstance(body, dict) else None
+    if task not in WRITING_TASK_WORD_LIMITS:
+        return JSONResponse({"error": "Unknown task"}, status_code=400)
+    t0 = time.perf_counter()
+    state = get_live_writing_state(sid, task)
+    if "text" in body:
+        text = body.get("text") or ""
+        if not isinstance(text, str):
+            return JSONResponse({"error": "text must be a string"}, status_code=400)
+        if len(text) > LIVE_WRITING_MAX_CHARS:
+            return JSONResponse({"error": "Text too long"}, status_code=413)
+        state.reset(text)
+    else:
+        try:
+            version = int(body["version"])
+            start = int(body["start"])
+            delete = int(body.get("delete") or 0)
+            insert = body.get("insert") or ""
+            length = int(body["length"])
+        except (KeyError, TypeError, ValueError):
+            return JSONResponse({"error": "Invalid delta"}, status_code=400)
+        if (not isinstance(insert, str) or version != state.version or start < 0 or delete < 0
+                or start + delete > len(state.text) or length != len(state.text) - delete + len(insert)):
+            return JSONResponse({"resync": True, "version": state.version}, status_code=409)
+        if length > LIVE_WRITING_MAX_CHARS:
+            return JSONResponse({"error": "Text too long"}, status_code=413)
+        state.apply(start, delete, insert)
+    result = live_writing_feedback(state)
+    result["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return JSONResponse(result)
+
 @app.post("/test/writing/submit")
 async def submit_writing(request: Request):
     sid = request.cookies.get("session_id")
@@ -2528,19 +5367,25 @@ async def submit_writing(request: Request):
     t1 = fd.get("task1", "")
     t2 = fd.get("task2", "")
     essay = fd.get("essay", "")
-    tests = get_writing_tests()
-    test = tests[0] if tests else DEFAULT_WRITING
-    test = _writing_test_for_display(test)
-    ev = await evaluate_writing_with_ai(t1, t2, essay, test)
     s = get_session(sid)
-    s["writing"] = {"completed": True, "responses": {"task1": t1, "task2": t2, "essay": essay}, "evaluation": ev, "percentage": ev["overall_percentage"]}
+    test = get_writing_test_for_grading(version=pinned_bank_version(s, "writing"))
+    ev = await evaluate_writing_with_ai(t1, t2, essay, test)
+    drop_live_writing_states(sid)
+    responses = {"task1": t1, "task2": t2, "essay": essay}
+    sigs = writing_signatures(responses)
+    similar = find_similar_submissions(sigs, exclude_session=sid, exclude_user=s.get("user_id"))
+    if similar:
+        top = ", ".join(f"{task}: {matches[0]['similarity']}" for task, matches in similar.items())
+        print(f"[Similarity] {sid}: o'xshash ishlar topildi – {top}")
+    s["writing"] = {"completed": True, "test_id": test.get("id"), "responses": responses, "evaluation": ev, "percentage": ev["overall_percentage"],
+                    "minhash": {k: encode_signature(v) for k, v in sigs.items()}, "similar": similar}
     r_pct = s.get("reading", {}).get("percentage", 0)
     l_pct = s.get("listening", {}).get("percentage", 0)
     final = calc_final(r_pct, l_pct, ev["overall_percentage"])
     s["overall_score"] = final["overall_percentage"]
     s["cefr_level"] = final["cefr_level"]
     s["level_description"] = final["level_description"]
-    return JSONResponse({"success": True, "evaluation": ev, "redirect": "/results"})
+    return JSONResponse({"success": True, "evaluation": ev, "similar": {k: [m["similarity"] for m in v] for k, v in similar.items()}, "redirect": "/results"})
 
 @app.get("/results", response_class=HTMLResponse)
 async def results(request: Request):
@@ -2625,7 +5470,8 @@ async def admin_dashboard(request: Request):
         "reading_tests": reading,
         "listening_tests": listening,
         "writing_tests": writing,
-        "users": users_list
+        "users": users_list,
+        "similar_submissions": recent_similar_submissions()
     })
 
 @app.get("/admin/data/{section}", response_class=JSONResponse)
@@ -2645,16 +5491,61 @@ async def admin_save_data(request: Request, section: str):
     errors: list[str] = []
     if section == "reading":
         cleaned, errors = _validate_reading_tests(tests)
-        save_json("reading_tests.json", {"tests": cleaned})
     elif section == "listening":
         cleaned, errors = _validate_listening_tests(tests)
-        save_json("listening_tests.json", {"tests": cleaned})
+        attach_map_variants(cleaned)
+        await asyncio.to_thread(attach_audio_metadata, cleaned)
     elif section == "writing":
         cleaned, errors = _validate_writing_tests(tests)
-        save_json("writing_tests.json", {"tests": cleaned})
     else:
         return JSONResponse({"error": "Unknown section"}, status_code=400)
-    return JSONResponse({"success": True, "errors": errors})
+    # Fayl ustiga yoziladi, lekin boshlangan sessiyalar o'z versiyasi bilan davom etadi
+    publish_bank(section, cleaned)
+    version = current_bank(section).version
+    if section == "listening":
+        schedule_listening_prewarm()
+    if section in RESULT_SECTIONS:
+        # Javob kaliti o'zgargan bo'lsa, saqlangan natijalar eskiradi: `python manage.py rescore-results`
+        return JSONResponse({"success": True, "errors": errors, "version": version,
+                             "stale_results": stale_result_count(section)})
+    return JSONResponse({"success": True, "errors": errors, "version": version})
+
+
+# Admin yuklashlari: fayl bo'laklab asinxron diskka yoziladi, hajm limiti oqim davomida tekshiriladi, SHA-256 yo'l-yo'lakay
+# hisoblanadi va fayl kontent-manzil (<sha256><ext>) bilan saqlanadi — bir xil fayl qayta yuklansa mavjudi ishlatiladi.
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MAX_MAP_UPLOAD_BYTES = int(os.getenv("MAX_MAP_UPLOAD_MB", "10")) * 1024 * 1024
+MAX_AUDIO_UPLOAD_BYTES = int(os.getenv("MAX_AUDIO_UPLOAD_MB", "100")) * 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def store_upload(file: UploadFile, directory: Path, ext: str, max_bytes: int) -> dict:
+    """Yuklangan faylni bo'laklab `directory/<sha256><ext>` ga yozadi. Qaytaradi: {"name", "sha256", "size", "deduplicated"}.
+    Limitdan oshsa UploadTooLarge (qisman yozilgan fayl o'chiriladi)."""
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp = directory / f".{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Fayl juda katta (max {max_bytes // (1024 * 1024)} MB)")
+                digest.update(chunk)
+                await out.write(chunk)
+        name = digest.hexdigest() + ext
+        path = directory / name
+        deduplicated = path.exists()
+        if not deduplicated:
+            os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return {"name": name, "sha256": digest.hexdigest(), "size": size, "deduplicated": deduplicated}
 
 
 # Admin: Listening Part 4 xarita rasm yuklash
@@ -2662,6 +5553,87 @@ UPLOAD_MAPS_DIR = Path(__file__).resolve().parent / "static" / "uploads" / "list
 ALLOWED_MAP_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
 
 
+# Xarita rasmlari uchun kichraytirilgan WebP variantlar (yuklashda, alohida process pool'da): <sha256>-<eni>w.webp va
+# <sha256>.variants.json. Listening saqlanganda variantlar partga (map_image_variants) yoziladi, sahifa srcset ishlatadi.
+MAP_VARIANT_WIDTHS = (320, 640, 1024)
+MAP_WEBP_QUALITY = 80
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0")) or min(2, os.cpu_count() or 1)
+
+_image_pool: ProcessPoolExecutor | None = None
+
+
+def get_image_pool() -> ProcessPoolExecutor:
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _image_pool
+
+
+def make_image_variants(src: str, out_dir: str, stem: str, widths: tuple, quality: int) -> dict | None:
+    """Rasmdan berilgan enlardagi (asl enidan kichiklari; hech biri bo'lmasa asl eni) WebP nusxalar. Process pool worker'ida ishlaydi."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print("[Upload] Pillow o'rnatilmagan – rasm variantlari yaratilmaydi")
+        return None
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+        width, height = im.size
+        variants = []
+        for w in [w for w in widths if w < width] or [width]:
+            h = max(1, round(height * w / width))
+            name = f"{stem}-{w}w.webp"
+            path = Path(out_dir) / name
+            tmp = path.with_name(f".{name}.{os.getpid()}.tmp")
+            im.resize((w, h), Image.LANCZOS).save(tmp, "WEBP", quality=quality, method=4)
+            os.replace(tmp, path)
+            variants.append({"file": name, "width": w, "height": h, "bytes": path.stat().st_size})
+    return {"width": width, "height": height, "variants": variants}
+
+
+def _map_manifest_path(stem: str) -> Path:
+    return UPLOAD_MAPS_DIR / f"{stem}.variants.json"
+
+
+async def build_map_variants(name: str) -> dict | None:
+    """Yuklangan xarita uchun variantlar manifesti (bir xil fayl qayta yuklansa mavjudi qaytadi)."""
+    stem = Path(name).stem
+    manifest = _map_manifest_path(stem)
+    if manifest.exists():
+        return json.loads(manifest.read_text(encoding="utf-8"))
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(get_image_pool(), make_image_variants, str(UPLOAD_MAPS_DIR / name),
+                                            str(UPLOAD_MAPS_DIR), stem, MAP_VARIANT_WIDTHS, MAP_WEBP_QUALITY)
+    except Exception as e:
+        print(f"[Upload] {name}: rasm variantlari yaratilmadi – {e}")
+        return None
+    if result is not None:
+        tmp = manifest.with_suffix(".tmp")
+        tmp.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, manifest)
+    return result
+
+
+def attach_map_variants(tests: list):
+    """map_image_url yuklangan rasm bo'lsa, uning variantlarini partga yozadi (admin panel bu maydonlarni saqlamaydi)."""
+    prefix = "/static/uploads/listening_maps/"
+    for test in tests:
+        for part in test.get("parts") or ():
+            url = part.get("map_image_url") or ""
+            manifest = _map_manifest_path(Path(url).stem) if url.startswith(prefix) else None
+            if manifest is None or not manifest.exists():
+                part.pop("map_image_variants", None)
+                part.pop("map_image_size", None)
+                continue
+            data = json.loads(manifest.read_text(encoding="utf-8"))
+            part["map_image_size"] = [data["width"], data["height"]]
+            part["map_image_variants"] = [
+                {"url": prefix + v["file"], "width": v["width"], "height": v["height"]} for v in data["variants"]
+            ]
+
+
 @app.post("/admin/upload-listening-map", response_class=JSONResponse)
 async def admin_upload_listening_map(request: Request, file: UploadFile = File(...)):
     if not check_admin(request):
@@ -2671,16 +5643,18 @@ async def admin_upload_listening_map(request: Request, file: UploadFile = File(.
     ext = Path(file.filename).suffix.lower()
     if ext not in ALLOWED_MAP_EXTENSIONS:
         return JSONResponse({"error": "Faqat rasm fayllari (png, jpg, gif, webp)"}, status_code=400)
-    UPLOAD_MAPS_DIR.mkdir(parents=True, exist_ok=True)
-    name = f"{uuid.uuid4().hex}{ext}"
-    path = UPLOAD_MAPS_DIR / name
     try:
-        content = await file.read()
-        path.write_bytes(content)
+        stored = await store_upload(file, UPLOAD_MAPS_DIR, ext, MAX_MAP_UPLOAD_BYTES)
+    except UploadTooLarge as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
-    url = f"/static/uploads/listening_maps/{name}"
-    return JSONResponse({"url": url})
+    url = f"/static/uploads/listening_maps/{stored['name']}"
+    variants = await build_map_variants(stored["name"])
+    return JSONResponse({"url": url, "sha256": stored["sha256"], "size": stored["size"],
+                         "deduplicated": stored["deduplicated"],
+                         "variants": [dict(v, url=f"/static/uploads/listening_maps/{v['file']}")
+                                      for v in (variants or {}).get("variants", [])]})
 
 
 # Admin: Listening audio yuklash (har qanday part uchun)
@@ -2688,6 +5662,32 @@ UPLOAD_AUDIO_DIR = Path(__file__).resolve().parent / "static" / "uploads" / "lis
 ALLOWED_AUDIO_EXTENSIONS = {".mp3", ".wav", ".m4a", ".ogg", ".webm"}
 
 
+def upload_audio_metadata(path: Path) -> dict:
+    """Yuklangan audio metama'lumoti: fayl kontent-manzilli, shuning uchun bir marta hisoblanib <sha256>.meta.json ga yoziladi."""
+    manifest = path.with_name(f"{path.stem}.meta.json")
+    if manifest.exists():
+        return json.loads(manifest.read_text(encoding="utf-8"))
+    meta = audio_metadata(path)
+    tmp = manifest.with_suffix(".tmp")
+    tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, manifest)
+    return meta
+
+
+def attach_audio_metadata(tests: list):
+    """audio_url yuklangan yoki sintez qilingan fayl bo'lsa, partga audio_meta (duration, bitrate, bytes) yozadi."""
+    prefix = "/static/uploads/listening_audio/"
+    for test in tests:
+        for part in test.get("parts") or ():
+            url = part.get("audio_url") or ""
+            key = generated_audio_key(part)
+            path = tts_store.path(key) if key else UPLOAD_AUDIO_DIR / Path(url).name if url.startswith(prefix) else None
+            if path is None or not path.exists():
+                part.pop("audio_meta", None)
+                continue
+            part["audio_meta"] = audio_metadata(path) if key else upload_audio_metadata(path)
+
+
 @app.post("/admin/upload-listening-audio", response_class=JSONResponse)
 async def admin_upload_listening_audio(request: Request, file: UploadFile = File(...)):
     if not check_admin(request):
@@ -2697,18 +5697,105 @@ async def admin_upload_listening_audio(request: Request, file: UploadFile = File
     ext = Path(file.filename).suffix.lower()
     if ext not in ALLOWED_AUDIO_EXTENSIONS:
         return JSONResponse({"error": "Faqat audio fayllari (mp3, wav, m4a, ogg, webm)"}, status_code=400)
-    UPLOAD_AUDIO_DIR.mkdir(parents=True, exist_ok=True)
-    name = f"{uuid.uuid4().hex}{ext}"
-    path = UPLOAD_AUDIO_DIR / name
     try:
-        content = await file.read()
-        path.write_bytes(content)
+        stored = await store_upload(file, UPLOAD_AUDIO_DIR, ext, MAX_AUDIO_UPLOAD_BYTES)
+        meta = await asyncio.to_thread(upload_audio_metadata, UPLOAD_AUDIO_DIR / stored["name"])
+    except UploadTooLarge as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
-    url = f"/static/uploads/listening_audio/{name}"
-    return JSONResponse({"url": url})
+    url = f"/static/uploads/listening_audio/{stored['name']}"
+    return JSONResponse({"url": url, "sha256": stored["sha256"], "size": stored["size"],
+                         "deduplicated": stored["deduplicated"], "meta": meta})
+
+
+@app.get("/admin/ai-stats", response_class=JSONResponse)
+async def admin_ai_stats(request: Request):
+    """Model bo'yicha AI baholash telemetriyasi: parse (structured / tuzatilgan / xato), tokenlar, prompt cache, umumiy (to'liq javob) latency."""
+    if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    return JSONResponse({"models": get_ai_eval_stats(), "rubric_version": WRITING_RUBRIC_VERSION,
+                         "prefix_tokens_est": WRITING_PREFIX_TOKENS_EST,
+                         "prefix_cache": writing_prefix_cache_status()})
 
 
+@app.post("/admin/writing/batch-analyze")
+async def admin_writing_batch_analyze(request: Request):
+    """NDJSON kiritish ({"id", "text", "task_type", "min_words", "max_words"} har qatorda) -> NDJSON natijalar.
+
+    Qatorlar yuklanish davomida process pool'ga yuboriladi; natijalar tayyor bo'lish tartibida qaytadi,
+    oxirgi qator {"summary": {...}} – o'tkazuvchanlik ko'rsatkichlari.
+    """
+    if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    loop = asyncio.get_running_loop()
+    pool = get_writing_pool()
+    started = time.perf_counter()
+    futures: list = []
+    bad_lines: list = []
+    line_no = 0
+
+    def submit(raw: bytes):
+        nonlocal line_no
+        line_no += 1
+        if not raw.strip():
+            return
+        try:
+            item = parse_batch_line(raw, line_no)
+        except ValueError as e:
+            bad_lines.append({"line": line_no, "error": str(e)})
+            return
+        if len(futures) >= BATCH_MAX_ITEMS:
+            bad_lines.append({"line": line_no, "error": f"limit {BATCH_MAX_ITEMS} ta matn"})
+            return
+        futures.append(loop.run_in_executor(pool, analyze_writing_text, item))
+
+    # Body to'liq o'qib olinadi (javob oqimi boshlanishidan oldin), lekin tahlil yuklanish bilan parallel boshlanadi
+    buf = b""
+    async for chunk in request.stream():
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for raw in lines:
+            submit(raw)
+    submit(buf)
+
+    async def stream():
+        results = []
+        for bad in bad_lines:
+            yield json.dumps(bad, ensure_ascii=False) + "\n"
+        for fut in asyncio.as_completed(futures):
+            r = await fut
+            results.append(r)
+            yield json.dumps(r, ensure_ascii=False) + "\n"
+        summary = summarize_batch_analysis(results, time.perf_counter() - started, BATCH_WORKERS, len(bad_lines))
+        print(f"[Batch] {summary['items']} ta matn, {summary['items_per_s']} matn/s, {summary['workers']} worker")
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/admin/writing/similar", response_class=JSONResponse)
+async def admin_writing_similar(request: Request, limit: int = 50):
+    """O'xshash deb topilgan yozma ishlar va LSH indeksidagi imzolar soni."""
+    if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    return JSONResponse({"items": recent_similar_submissions(max(1, min(limit, 500))), "indexed": len(get_writing_lsh())})
+
+@app.get("/admin/items/stats", response_class=JSONResponse)
+async def admin_item_stats(request: Request, section: str | None = None, source: str | None = None,
+                           part: int | None = None, flagged: bool = False):
+    """Savollar bo'yicha statistika: facility, discrimination (point-biserial), javob variantlari ulushi."""
+    if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    stats = load_item_stats()
+    return JSONResponse({
+        "items": item_stats_report(section, source, part, flagged),
+        "results": stats.get("results", 0), "responses": stats.get("responses", 0),
+        "updated_at": stats.get("updated_at"),
+    })
+
+@app.get("/admin/parts/exposure", response_class=JSONResponse)
+async def admin_part_exposure(request: Request):
+    """Slotlar bo'yicha partlar: necha marta ko'rsatilgan va hozirgi tanlanish ehtimoli."""
+    if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    return JSONResponse({section: part_exposure_report(section) for section in SECTION_SLOTS})
+
 @app.post("/admin/user/{user_id}")
 async def admin_update_user(request: Request, user_id: str):
     if not check_admin(request): return JSONResponse({"error": "Unauthorized"}, status_code=401)
@@ -0,0 +1,1635 @@
+"""CEFR Level – offline ishlar (CLI).
+
+Bu skript live server (app.py) so'rov yo'lidan tashqarida ishlaydi:
+ma'lumotlarni data/ papkasidan o'qiydi va natijalarni alohida fayllarga yozadi.
+
+Foydalanish:
+    python manage.py regrade-writing --provider mock --batch-size 500
+    python manage.py regrade-writing --provider openai --apply
+    python manage.py loadtest-writing --requests 200 --concurrency 20
+    python manage.py rescore-results --apply
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+from array import array
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+import app
+
+
+# ============ UMUMIY YORDAMCHILAR ============
+
+def _atomic_write_json(path: Path, data: dict):
+    """Checkpoint fayllarini yarim yozilgan holatda qoldirmaslik uchun tmp + os.replace."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _read_json(path: Path, default: dict) -> dict:
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return default
+
+
+# ============ BATCH PROVIDER INTERFEYSI ============
+
+class BatchEvaluationProvider:
+    """Batch uslubidagi AI provider interfeysi.
+
+    Har bir so'rov: {"custom_id", "system", "prompt", "meta"}.
+    submit() batch_id qaytaradi, poll() holatni ("in_progress" | "completed" | "failed"),
+    results() esa {custom_id: {"content": str} yoki {"error": str}} qaytaradi.
+    """
+    name = "base"
+
+    def submit(self, requests: list) -> str:
+        raise NotImplementedError
+
+    def poll(self, batch_id: str) -> str:
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> dict:
+        raise NotImplementedError
+
+
+class MockBatchProvider(BatchEvaluationProvider):
+    """Lokal mock: mock_ai_server dagi sintetik baholash bilan JSON javob yasaydi (API kalitsiz sinov uchun).
+
+    latency – batch tayyor bo'lguncha soniya; fail_rate – har bir element uchun xato ehtimoli.
+    """
+    name = "mock"
+
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, seed: int | None = None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self._rng = random.Random(seed)
+        self._batches: dict = {}
+
+    def submit(self, requests: list) -> str:
+        batch_id = f"mock_batch_{len(self._batches) + 1}_{int(time.time() * 1000)}"
+        self._batches[batch_id] = {"requests": list(requests), "ready_at": time.monotonic() + self.latency}
+        return batch_id
+
+    def poll(self, batch_id: str) -> str:
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            # Mock batchlar jarayon bilan birga yo'qoladi – resume paytida qayta yuborish kerak
+            return "failed"
+        return "completed" if time.monotonic() >= batch["ready_at"] else "in_progress"
+
+    def results(self, batch_id: str) -> dict:
+        from mock_ai_server import fake_evaluation_json
+
+        out = {}
+        for req in self._batches.get(batch_id, {}).get("requests", []):
+            if self._rng.random() < self.fail_rate:
+                out[req["custom_id"]] = {"error": "mock: injected failure"}
+                continue
+            meta = req.get("meta") or {}
+            out[req["custom_id"]] = {"content": fake_evaluation_json(meta.get("task1"), meta.get("task2"), meta.get("essay"))}
+        return out
+
+
+class OpenAIBatchProvider(BatchEvaluationProvider):
+    """OpenAI Batch API (/v1/files + /v1/batches) orqali baholash."""
+    name = "openai"
+
+    def __init__(self, api_key: str, model: str = "gpt-4o-mini", base_url: str | None = None):
+        self.model = model
+        self.base_url = (base_url or app.OPENAI_BASE_URL).rstrip("/")
+        self._client = httpx.Client(timeout=120.0, headers={"Authorization": f"Bearer {api_key}"})
+
+    def submit(self, requests: list) -> str:
+        lines = []
+        for req in requests:
+            lines.append(json.dumps({
+                "custom_id": req["custom_id"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": [
+                        {"role": "system", "content": req["system"]},
+                        {"role": "user", "content": req["prompt"]},
+                    ],
+                    "temperature": 0.3,
+                    "max_tokens": 2000,
+                    **({"response_format": app.OPENAI_RESPONSE_FORMATS[self.model]} if self.model in app.OPENAI_RESPONSE_FORMATS else {}),
+                },
+            }, ensure_ascii=False))
+        payload = ("\n".join(lines) + "\n").encode("utf-8")
+        r = self._client.post(
+            f"{self.base_url}/files",
+            data={"purpose": "batch"},
+            files={"file": ("regrade.jsonl", payload, "application/jsonl")},
+        )
+        r.raise_for_status()
+        file_id = r.json()["id"]
+        r = self._client.post(
+            f"{self.base_url}/batches",
+            json={"input_file_id": file_id, "endpoint": "/v1/chat/completions", "completion_window": "24h"},
+        )
+        r.raise_for_status()
+        return r.json()["id"]
+
+    def _batch(self, batch_id: str) -> dict:
+        r = self._client.get(f"{self.base_url}/batches/{batch_id}")
+        r.raise_for_status()
+        return r.json()
+
+    def poll(self, batch_id: str) -> str:
+        status = self._batch(batch_id).get("status")
+        if status == "completed":
+            return "completed"
+        if status in ("failed", "expired", "cancelled"):
+            return "failed"
+        return "in_progress"
+
+    def _file_lines(self, file_id: str):
+        r = self._client.get(f"{self.base_url}/files/{file_id}/content")
+        r.raise_for_status()
+        for line in r.text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+    def results(self, batch_id: str) -> dict:
+        batch = self._batch(batch_id)
+        out = {}
+        if batch.get("output_file_id"):
+            for row in self._file_lines(batch["output_file_id"]):
+                resp = row.get("response") or {}
+                if resp.get("status_code") == 200:
+                    choices = (resp.get("body") or {}).get("choices") or []
+                    content = ((choices[0].get("message") or {}).get("content") or "") if choices else ""
+                    out[row["custom_id"]] = {"content": content}
+                else:
+                    out[row["custom_id"]] = {"error": f"status={resp.get('status_code')}"}
+        if batch.get("error_file_id"):
+            for row in self._file_lines(batch["error_file_id"]):
+                err = row.get("error") or {}
+                out.setdefault(row["custom_id"], {"error": err.get("message") or "batch error"})
+        return out
+
+
+# ============ WRITING QAYTA BAHOLASH (RE-GRADE) ============
+
+REGRADE_CHECKPOINT = app.DATA_DIR / "regrade_checkpoint.json"
+REGRADE_OUTPUT = app.DATA_DIR / "writing_regrades.jsonl"
+
+
+def iter_writing_submissions():
+    """test_history dan writing javoblari saqlangan yozuvlarni birma-bir qaytaradi (HistoryStream – xotira o'zgarmas)."""
+    path = _history_path()
+    if not path.exists():
+        return
+    for _raw, record in HistoryStream(path):
+        responses = record.get("writing_responses")
+        if record.get("session_id") and isinstance(responses, dict):
+            yield record
+
+
+def _build_regrade_request(record: dict, tests_cache: dict) -> dict:
+    test_id = record.get("writing_test_id")
+    if test_id not in tests_cache:
+        tests_cache[test_id] = app.get_writing_test_for_grading(test_id)
+    resp = record["writing_responses"]
+    t1, t2, essay = resp.get("task1") or "", resp.get("task2") or "", resp.get("essay") or ""
+    return {
+        "custom_id": record["session_id"],
+        "system": app.WRITING_SYSTEM_PREFIX,
+        "prompt": app.build_writing_prompt(t1, t2, essay, tests_cache[test_id]),
+        "meta": {"task1": t1, "task2": t2, "essay": essay},
+    }
+
+
+def _regrade_outcome(record: dict, content: str, provider_name: str = "batch") -> dict | None:
+    """Batch javobini online baholash bilan bir xil tarzda yakuniy natijaga aylantiradi."""
+    ev, repairs = app.parse_ai_evaluation(content)
+    app.record_parse_result(f"batch:{provider_name}", ev is not None, repairs)
+    if not ev:
+        return None
+    resp = record["writing_responses"]
+    t1, t2, essay = resp.get("task1") or "", resp.get("task2") or "", resp.get("essay") or ""
+    results = app._short_writing_results(t1, t2, essay)
+    formatted = app.format_ai_result(ev, t1, t2, essay)
+    for name in ("task1", "task2", "essay"):
+        if name not in results:
+            results[name] = formatted[name]
+    evaluation = app._finalize_writing_evaluation(results)
+    final = app.calc_final(record.get("reading_percentage", 0), record.get("listening_percentage", 0), evaluation["overall_percentage"])
+    return {
+        "session_id": record["session_id"],
+        "rubric_version": app.WRITING_RUBRIC_VERSION,
+        "regraded_at": datetime.now().isoformat(),
+        "writing_evaluation": evaluation,
+        "writing_percentage": evaluation["overall_percentage"],
+        "overall_score": final["overall_percentage"],
+        "cefr_level": final["cefr_level"],
+        "level_description": final["level_description"],
+    }
+
+
+def _new_checkpoint() -> dict:
+    return {
+        "rubric_version": app.WRITING_RUBRIC_VERSION,
+        "done": [], "failed": {}, "attempts": {}, "pending": None,
+        "stats": {"submitted": 0, "succeeded": 0, "failed": 0, "retried": 0, "batches": 0, "elapsed_s": 0.0},
+    }
+
+
+def run_regrade(provider: BatchEvaluationProvider, batch_size: int = 500, max_retries: int = 3,
+                poll_interval: float = 10.0, limit: int | None = None,
+                checkpoint_path: Path = REGRADE_CHECKPOINT, output_path: Path = REGRADE_OUTPUT) -> dict:
+    """test_history bo'ylab writing javoblarini batchlab qayta baholaydi.
+
+    Checkpoint har bir batchdan keyin yoziladi, shuning uchun ish to'xtatilsa
+    keyingi ishga tushishda yakunlangan yozuvlar o'tkazib yuboriladi va kutilayotgan batch davom ettiriladi.
+    Rubric o'zgarsa (WRITING_RUBRIC_VERSION), checkpoint yangidan boshlanadi.
+    """
+    ckpt = _read_json(checkpoint_path, _new_checkpoint())
+    if ckpt.get("rubric_version") != app.WRITING_RUBRIC_VERSION:
+        print(f"[Regrade] Rubric o'zgargan ({ckpt.get('rubric_version')} -> {app.WRITING_RUBRIC_VERSION}), checkpoint yangilanadi.")
+        ckpt = _new_checkpoint()
+    done = set(ckpt["done"])
+    failed = ckpt["failed"]
+    attempts = ckpt["attempts"]
+    stats = ckpt["stats"]
+    started = time.monotonic()
+    elapsed_before = stats.get("elapsed_s", 0.0)
+
+    records = {}
+    tests_cache: dict = {}
+    retry_queue: list = []
+    source = iter_writing_submissions()
+    exhausted = False
+    taken = 0
+
+    def save_checkpoint():
+        ckpt["done"] = sorted(done)
+        stats["elapsed_s"] = round(elapsed_before + time.monotonic() - started, 2)
+        _atomic_write_json(checkpoint_path, ckpt)
+
+    def next_chunk() -> list:
+        nonlocal exhausted, taken
+        chunk = []
+        while retry_queue and len(chunk) < batch_size:
+            chunk.append(retry_queue.pop(0))
+        while not exhausted and len(chunk) < batch_size:
+            if limit is not None and taken >= limit:
+                exhausted = True
+                break
+            record = next(source, None)
+            if record is None:
+                exhausted = True
+                break
+            sid = record["session_id"]
+            if sid in done or sid in failed or sid in records:
+                continue
+            records[sid] = record
+            taken += 1
+            chunk.append(sid)
+        return chunk
+
+    def handle_results(custom_ids: list, results: dict):
+        with open(output_path, "a", encoding="utf-8") as out:
+            for sid in custom_ids:
+                record = records.get(sid)
+                res = results.get(sid) or {"error": "natija yo'q"}
+                outcome = _regrade_outcome(record, res["content"], provider.name) if record and "content" in res else None
+                if outcome:
+                    out.write(json.dumps(outcome, ensure_ascii=False) + "\n")
+                    done.add(sid)
+                    stats["succeeded"] += 1
+                    records.pop(sid, None)
+                    continue
+                attempts[sid] = attempts.get(sid, 0) + 1
+                if attempts[sid] < max_retries and record:
+                    retry_queue.append(sid)
+                    stats["retried"] += 1
+                else:
+                    failed[sid] = res.get("error") or "yaroqsiz JSON"
+                    stats["failed"] += 1
+                    records.pop(sid, None)
+
+    # Oldingi ishga tushishdan qolgan batchni davom ettirish: faqat uning yozuvlari olinadi,
+    # hammasi topilgach o'qish to'xtaydi
+    pending = ckpt.get("pending")
+    if pending:
+        print(f"[Regrade] Kutilayotgan batch davom ettirilmoqda: {pending['batch_id']} ({len(pending['custom_ids'])} ta)")
+        missing = set(pending["custom_ids"])
+        for record in iter_writing_submissions():
+            if record["session_id"] in missing:
+                records[record["session_id"]] = record
+                missing.discard(record["session_id"])
+                if not missing:
+                    break
+
+    backoff = poll_interval
+    while True:
+        if pending is None:
+            chunk = next_chunk()
+            if not chunk:
+                break
+            reqs = [_build_regrade_request(records[sid], tests_cache) for sid in chunk]
+            try:
+                batch_id = provider.submit(reqs)
+            except Exception as e:
+                print(f"[Regrade] submit xato: {type(e).__name__}: {e}. {backoff:.0f}s dan keyin qayta urinish...")
+                retry_queue[:0] = chunk
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 600)
+                continue
+            backoff = poll_interval
+            pending = {"batch_id": batch_id, "custom_ids": chunk, "provider": provider.name,
+                       "submitted_at": datetime.now().isoformat()}
+            ckpt["pending"] = pending
+            stats["submitted"] += len(chunk)
+            stats["batches"] += 1
+            save_checkpoint()
+            print(f"[Regrade] Batch yuborildi: {batch_id} ({len(chunk)} ta)")
+
+        try:
+            status = provider.poll(pending["batch_id"])
+        except Exception as e:
+            print(f"[Regrade] poll xato: {type(e).__name__}: {e}")
+            status = "in_progress"
+        if status == "in_progress":
+            time.sleep(poll_interval)
+            continue
+
+        results = provider.results(pending["batch_id"]) if status == "completed" else {}
+        handle_results(pending["custom_ids"], results)
+        pending = None
+        ckpt["pending"] = None
+        save_checkpoint()
+        rate = (stats["succeeded"] + stats["failed"]) / max(stats["elapsed_s"], 1e-6)
+        print(f"[Regrade] OK={stats['succeeded']} xato={stats['failed']} qayta={stats['retried']} – {rate:.1f} ta/s")
+
+    source.close()
+    save_checkpoint()
+    print(f"[Regrade] Yakunlandi: {stats}")
+    return stats
+
+
+def apply_regrades(output_path: Path = REGRADE_OUTPUT) -> int:
+    """Joriy rubric bo'yicha qayta baholash natijalarini test_history ga writing_regrade sifatida yozadi.
+
+    Asl writing_evaluation o'zgartirilmaydi.
+    """
+    latest = {}
+    if output_path.exists():
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if row.get("rubric_version") == app.WRITING_RUBRIC_VERSION:
+                    latest[row["session_id"]] = row
+    if not latest:
+        return 0
+    data = app.load_test_history_data()
+    updated = 0
+    for record in data["results"]:
+        row = latest.get(record.get("session_id"))
+        if row:
+            record["writing_regrade"] = {k: v for k, v in row.items() if k != "session_id"}
+            updated += 1
+    app.save_json(app.TEST_HISTORY_FILE, data)
+    return updated
+
+
+def _make_batch_provider(args) -> BatchEvaluationProvider:
+    if args.provider == "openai":
+        if not app.OPENAI_API_KEY:
+            raise SystemExit("OPENAI_API_KEY o'rnatilmagan.")
+        return OpenAIBatchProvider(app.OPENAI_API_KEY, model=args.model)
+    return MockBatchProvider(latency=args.mock_latency, fail_rate=args.mock_fail_rate, seed=args.seed)
+
+
+def cmd_regrade_writing(args):
+    provider = _make_batch_provider(args)
+    run_regrade(provider, batch_size=args.batch_size, max_retries=args.max_retries,
+                poll_interval=args.poll_interval, limit=args.limit)
+    if args.apply:
+        n = apply_regrades()
+        print(f"[Regrade] test_history ga yozildi: {n} ta yozuv")
+
+
+# ============ WRITING YUKLAMA TESTI ============
+
+SAMPLE_ESSAY = (
+    "Technology has changed the way people live and work. Many people believe that this change is positive "
+    "because it makes everyday life easier and faster. However, others think that it creates new problems, "
+    "such as stress, isolation and a lack of physical activity.\n"
+    "In my opinion, technology is mostly beneficial when it is used wisely. For example, online courses allow "
+    "students in small towns to study at good universities. Moreover, doctors can share information quickly.\n"
+    "On the other hand, spending too much time with phones can damage relationships. Parents should therefore "
+    "teach children to balance screen time with sport and conversation.\n"
+    "In conclusion, technology brings more advantages than disadvantages, but we must learn to control it."
+)
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+
+async def _loadtest_writing(n: int, concurrency: int) -> dict:
+    import asyncio
+
+    samples = [r["writing_responses"] for r in itertools.islice(iter_writing_submissions(), 200)]
+    if not samples:
+        samples = [{"task1": SAMPLE_ESSAY[:400], "task2": SAMPLE_ESSAY[:800], "essay": SAMPLE_ESSAY}]
+    test = app.get_writing_test_for_grading()
+    sem = asyncio.Semaphore(concurrency)
+    latencies: list = []
+    unavailable = 0
+
+    async def one(i: int):
+        nonlocal unavailable
+        resp = samples[i % len(samples)]
+        async with sem:
+            t0 = time.perf_counter()
+            ev = await app.evaluate_writing_with_ai(resp.get("task1") or "", resp.get("task2") or "", resp.get("essay") or "", test)
+            latencies.append(time.perf_counter() - t0)
+        if any(ev[k].get("ai_unavailable") for k in ("task1", "task2", "essay")):
+            unavailable += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    wall = time.perf_counter() - t0
+    return {
+        "requests": n, "concurrency": concurrency, "wall_s": round(wall, 3),
+        "throughput_rps": round(n / wall, 2) if wall else 0.0,
+        "p50_s": round(_percentile(latencies, 50), 3), "p95_s": round(_percentile(latencies, 95), 3),
+        "p99_s": round(_percentile(latencies, 99), 3), "ai_unavailable": unavailable,
+    }
+
+
+def cmd_loadtest_writing(args):
+    import asyncio
+    import contextlib
+    import io
+
+    # evaluate_writing_with_ai juda ko'p log chiqaradi – yuklama testida jim qilamiz
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = asyncio.run(_loadtest_writing(args.requests, args.concurrency))
+    print(json.dumps(result, indent=2))
+
+
+# ============ WRITING BATCH TAHLIL (NDJSON) ============
+
+def run_batch_analysis(lines, out, workers: int | None = None) -> dict:
+    """NDJSON qatorlarini process pool'da tahlil qiladi, natijani tayyor bo'lishi bilan out ga yozadi.
+
+    Bir vaqtda faqat workers*4 ta matn navbatda turadi – katta fayllar xotiraga to'liq yuklanmaydi.
+    """
+    import sys
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    workers = workers or app.BATCH_WORKERS
+    results: list = []
+    bad = 0
+    started = time.perf_counter()
+
+    def emit(obj: dict):
+        out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        out.flush()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=app._batch_worker_init) as pool:
+        pending: set = set()
+        for line_no, raw in enumerate(lines, start=1):
+            if not raw.strip():
+                continue
+            try:
+                item = app.parse_batch_line(raw, line_no)
+            except ValueError as e:
+                bad += 1
+                emit({"line": line_no, "error": str(e)})
+                continue
+            pending.add(pool.submit(app.analyze_writing_text, item))
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    results.append(fut.result())
+                    emit(results[-1])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                results.append(fut.result())
+                emit(results[-1])
+
+    summary = app.summarize_batch_analysis(results, time.perf_counter() - started, workers, bad)
+    emit({"summary": summary})
+    print(json.dumps(summary), file=sys.stderr)
+    return summary
+
+
+def cmd_analyze_writing(args):
+    import sys
+
+    src = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        run_batch_analysis(src, out, args.workers)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+# ============ WRITING SCORER MIKRO-BENCHMARK ============
+
+def _synthetic_essay(words: int, seed: int = 0) -> str:
+    """Kerakli uzunlikdagi, spam deb topilmaydigan (so'z boyligi real essaylarga yaqin) sintetik matn."""
+    rng = random.Random(seed)
+    basic = sorted(app.SPAM_STOPWORDS | set(SAMPLE_ESSAY.lower().replace(".", " ").replace(",", " ").split()))
+    rich = sorted(_read_words(app.ENGLISH_WORDS_FILE))
+    paras, sent, para = [], [], []
+    sent_len = rng.randint(8, 20)
+    for i in range(words):
+        sent.append(rng.choice(basic) if rng.random() < 0.5 else rng.choice(rich))
+        if len(sent) >= sent_len or i == words - 1:
+            para.append(" ".join(sent).capitalize() + ".")
+            sent, sent_len = [], rng.randint(8, 20)
+            if len(para) >= 4:
+                paras.append(" ".join(para))
+                para = []
+    if para:
+        paras.append(" ".join(para))
+    return "\n".join(paras)
+
+
+def _bench_scorers(text: str, shared: bool) -> None:
+    import asyncio
+
+    features = app.extract_text_features(text) if shared else None
+    app.detect_spam_advanced(text, features)
+    app.algorithmic_score(text, 150, 250, "essay", features)
+    asyncio.run(app.get_strict_ai_score(text, "essay", features))
+
+
+def bench_writing(sizes=(200, 500, 1000, 2000), repeat: int = 200) -> list:
+    rows = []
+    for size in sizes:
+        text = _synthetic_essay(size, seed=size)
+        row = {"words": size}
+        for label, shared in (("separate_ms", False), ("shared_ms", True)):
+            _bench_scorers(text, shared)  # isitish
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                _bench_scorers(text, shared)
+            row[label] = round((time.perf_counter() - t0) / repeat * 1000, 3)
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            app.extract_text_features(text)
+        row["extract_ms"] = round((time.perf_counter() - t0) / repeat * 1000, 3)
+        row["speedup"] = round(row["separate_ms"] / row["shared_ms"], 2) if row["shared_ms"] else 0.0
+        rows.append(row)
+    return rows
+
+
+def _read_words(path: Path) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [w for w in (line.strip() for line in f) if w and not w.startswith("#")]
+
+
+def bench_lexicon(lookups: int = 200_000) -> list:
+    """Har bir backend uchun: yuklash vaqti, egallagan xotira (tracemalloc) va bitta qidiruv narxi."""
+    import tracemalloc
+
+    words = _read_words(app.ENGLISH_WORDS_FILE)
+    rng = random.Random(1)
+    # yarmi lug'atdagi so'zlar, yarmi tasodifiy harflar (gibberish)
+    probes = [rng.choice(words) if i % 2 else "".join(rng.choice("asdfghjklqwert") for _ in range(rng.randint(3, 9)))
+              for i in range(1000)]
+    rows = []
+    for backend in ("set", "packed"):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        lex = app.EnglishLexicon.from_file(app.ENGLISH_WORDS_FILE, backend)
+        load_ms = (time.perf_counter() - t0) * 1000
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rounds = max(1, lookups // len(probes))
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for w in probes:
+                w in lex
+        lookup_ns = (time.perf_counter() - t0) / (rounds * len(probes)) * 1e9
+        rows.append({"backend": backend, "words": len(lex), "load_ms": round(load_ms, 1),
+                     "memory_kb": round(current / 1024), "lookup_ns": round(lookup_ns)})
+    return rows
+
+
+def cmd_bench_lexicon(args):
+    for row in bench_lexicon(args.lookups):
+        print(json.dumps(row))
+
+
+def cmd_bench_writing(args):
+    sizes = tuple(int(x) for x in args.sizes.split(","))
+    for row in bench_writing(sizes, args.repeat):
+        print(json.dumps(row))
+
+# ============ O'XSHASH ISHLAR (MinHash/LSH) BENCHMARK ============
+
+def bench_similarity(n: int = 200_000, queries: int = 50, similarity: float = 0.7, seed: int = 1) -> dict:
+    """N ta sintetik imzo bilan LSH indeksi: qurish vaqti, so'rov narxi va nomzodlar soni, to'liq skan bilan solishtirish.
+
+    Har bir so'rov uchun indeksga bitta "nusxa" qo'shiladi (imzoning similarity ulushi bir xil) – topilganlar ulushi recall.
+    """
+    rng = random.Random(seed)
+    perm = app.MINHASH_PERM
+
+    def rand_sig():
+        return app.array("Q", (rng.getrandbits(61) for _ in range(perm)))
+
+    index = app.MinHashLSH()
+    t0 = time.perf_counter()
+    for i in range(n):
+        index.add((f"s{i}", "essay"), rand_sig())
+    build_s = time.perf_counter() - t0
+
+    probes = []
+    for q in range(queries):
+        sig = rand_sig()
+        copy = app.array("Q", sig)
+        for k in rng.sample(range(perm), perm - int(perm * similarity)):
+            copy[k] = rng.getrandbits(61)
+        index.add((f"copy{q}", "essay"), copy)
+        probes.append((sig, f"copy{q}"))
+
+    found = candidates = 0
+    t0 = time.perf_counter()
+    for sig, expected in probes:
+        matches = index.query(sig)
+        found += any(m["session_id"] == expected for m in matches)
+    query_ms = (time.perf_counter() - t0) / queries * 1000
+    for sig, _ in probes:
+        seen = set()
+        for b, h in index._band_keys(sig):
+            seen.update(index.buckets[b].get(h, ()))
+        candidates += len(seen)
+
+    # to'liq skan (juftma-juft) – bir nechta so'rovda o'lchanadi
+    scan = probes[:3]
+    t0 = time.perf_counter()
+    for sig, _ in scan:
+        [k for k, other in index.signatures.items() if app.signature_similarity(sig, other) >= app.WRITING_SIMILARITY_THRESHOLD]
+    scan_ms = (time.perf_counter() - t0) / len(scan) * 1000
+    return {
+        "signatures": len(index),
+        "bands": index.bands,
+        "rows": index.rows,
+        "build_s": round(build_s, 2),
+        "query_ms": round(query_ms, 3),
+        "avg_candidates": round(candidates / queries, 1),
+        "recall": round(found / queries, 3),
+        "full_scan_ms": round(scan_ms, 1),
+    }
+
+
+def cmd_bench_similarity(args):
+    print(json.dumps(bench_similarity(args.n, args.queries, args.similarity)))
+
+# ============ JAVOB KALITI BAHOLASH BENCHMARK ============
+
+# Oldingi if/elif versiyalari (o'zgarishsiz) – natija tengligi va tezlikni solishtirish uchun
+def _legacy_reading_score(answers: dict, test_data: dict) -> dict:
+    correct = 0
+    total = 0
+    details = []
+    for part in test_data["parts"]:
+        ptype = part["type"]
+        if ptype == "matching_statements":
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = q["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype in ["multiple_choice_cloze", "multiple_choice_comprehension"]:
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = q["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype == "open_cloze":
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().lower()
+                ca = q["correct"].lower()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype == "matching_headings":
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = q["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype == "gapped_text":
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = q["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype == "part5_mixed":
+            for q in part.get("gap_fill", {}).get("questions", []):
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().lower()
+                ca = q["correct"].lower()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = q["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+    pct = (correct / total * 100) if total > 0 else 0
+    return {"correct": correct, "total": total, "percentage": round(pct, 1), "details": details}
+
+
+def _legacy_listening_score(answers: dict, test_data: dict) -> dict:
+    correct = 0
+    total = 0
+    details = []
+    for part in test_data["parts"]:
+        ptype = part["type"]
+        if ptype in ["short_conversations", "interview"]:
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = q["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype in ["sentence_completion", "note_completion"]:
+            for q in part["questions"]:
+                total += 1
+                qn = str(q["number"])
+                ua = answers.get(qn, "").strip().lower()
+                ca = q["correct"].lower()
+                ic = ua == ca or ca in ua
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype in ["multiple_matching", "speaker_matching"]:
+            for a in part["answers"]:
+                total += 1
+                qn = str(a["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = a["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+        elif ptype == "map_labeling":
+            for p in part["places"]:
+                total += 1
+                qn = str(p["number"])
+                ua = answers.get(qn, "").strip().upper()
+                ca = p["correct"].upper()
+                ic = ua == ca
+                if ic: correct += 1
+                details.append({"q": qn, "ua": ua, "ca": ca, "ok": ic, "part": part["part_number"]})
+    pct = (correct / total * 100) if total > 0 else 0
+    return {"correct": correct, "total": total, "percentage": round(pct, 1), "details": details}
+
+
+def _scoring_fixture(section: str) -> dict:
+    """data/ dagi barcha testlarning barcha partlari bitta testda (_build_test_from_all_tests kabi _source_test_id bilan)."""
+    tests = app.get_reading_tests() if section == "reading" else app.get_listening_tests()
+    parts = []
+    for test in tests:
+        for part in test.get("parts", []):
+            part = dict(part)
+            part["_source_test_id"] = test.get("id", "")
+            parts.append(part)
+    return {"id": section + "_bench", "parts": parts}
+
+
+def _random_answers(test: dict, section: str, rng: random.Random) -> dict:
+    """Kalitlarning yarmi to'g'ri (tasodifiy registr/bo'shliq bilan), qolgani noto'g'ri yoki bo'sh."""
+    answers = {}
+    for part in test["parts"]:
+        for qn, ca, _, _, _ in app.compile_part_key(section, part):
+            r = rng.random()
+            if r < 0.5:
+                answers[qn] = " " + (ca.upper() if rng.random() < 0.5 else ca.lower()) + " "
+            elif r < 0.9:
+                answers[qn] = rng.choice(["A", "B", "x", "the", "C"])
+    return answers
+
+
+def bench_scoring(submissions: int = 2000, seed: int = 1, repeat: int = 5) -> list:
+    """Har bir section uchun: oldingi va kompilyatsiya qilingan baholashning bitta submission narxi (mikrosekund)."""
+    rng = random.Random(seed)
+    rows = []
+    for section, legacy, compiled in (("reading", _legacy_reading_score, app.calculate_reading_score),
+                                      ("listening", _legacy_listening_score, app.calculate_listening_score)):
+        test = _scoring_fixture(section)
+        batch = [_random_answers(test, section, rng) for _ in range(submissions)]
+        # Ochiq javoblarda (muqobil javob, imlo, xato harf) natija ataylab farq qilishi mumkin – faqat ok soni hisoblanadi
+        ok_differs = 0
+        for answers in batch:
+            old, new = legacy(answers, test)["details"], compiled(answers, test)["details"]
+            if [(d["q"], d["ua"]) for d in old] != [(d["q"], d["ua"]) for d in new]:
+                raise AssertionError(f"{section}: savollar ro'yxati farq qiladi")
+            ok_differs += sum(1 for x, y in zip(old, new) if x["ok"] != y["ok"])
+        # Navbatma-navbat bir necha marta, har biridan eng yaxshisi (timeit kabi) – shovqinli mashinada barqarorroq
+        legacy_us = compiled_us = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for answers in batch:
+                legacy(answers, test)
+            legacy_us = min(legacy_us, (time.perf_counter() - t0) / submissions * 1e6)
+            t0 = time.perf_counter()
+            for answers in batch:
+                compiled(answers, test)
+            compiled_us = min(compiled_us, (time.perf_counter() - t0) / submissions * 1e6)
+        t0 = time.perf_counter()
+        for part in test["parts"]:
+            app.compile_part_key(section, part)
+        compile_us = (time.perf_counter() - t0) * 1e6
+        rows.append({"section": section, "questions": len(app.score_answers({}, test, section)["details"]),
+                     "legacy_us": round(legacy_us, 1), "compiled_us": round(compiled_us, 1),
+                     "speedup": round(legacy_us / compiled_us, 2) if compiled_us else None,
+                     "compile_once_us": round(compile_us, 1), "ok_differs": ok_differs})
+    return rows
+
+
+def cmd_bench_scoring(args):
+    for row in bench_scoring(args.submissions):
+        print(json.dumps(row))
+
+
+# ============ NATIJALARNI QAYTA BAHOLASH (javob kaliti o'zgarganda) ============
+
+RESCORE_CHECKPOINT = app.DATA_DIR / "rescore_checkpoint.json"
+RESCORE_DIFF = app.DATA_DIR / "rescore_diff.jsonl"
+HISTORY_CHUNK = 1 << 16
+
+
+def _history_path() -> Path:
+    return app.DATA_DIR / app.TEST_HISTORY_FILE
+
+
+def _file_stamp(path: Path) -> list | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class HistoryStream:
+    """test_history.json dagi "results" massivini yozuvma-yozuv o'qiydi (butun faylni xotiraga olmaydi).
+
+    Fayl save_json formatida ({"results": [...]}, indent=2) deb hisoblanadi. Har bir yozuv (raw, record)
+    ko'rinishida qaytadi: raw — fayldagi aynan o'sha matn, o'zgarmagan yozuvlar qayta yozishda shu matn bilan ko'chiriladi.
+    Massivdan oldingi (head) va keyingi (tail) matn ham saqlanadi.
+    """
+
+    def __init__(self, path: Path, chunk_size: int = HISTORY_CHUNK):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.head = ""
+        self.tail = ""
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            buf = ""
+            while True:
+                start = buf.find('"results"')
+                if start >= 0 and buf.find("[", start) >= 0:
+                    break
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    raise ValueError(f"{self.path}: \"results\" massivi topilmadi")
+                buf += chunk
+            pos = buf.find("[", start) + 1
+            self.head = buf[:pos]
+            eof = False
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos >= len(buf):
+                    if eof:
+                        raise ValueError(f"{self.path}: fayl kutilmaganda tugadi")
+                    buf, pos = buf[pos:] + f.read(self.chunk_size), 0
+                    eof = pos >= len(buf)
+                    continue
+                if buf[pos] == "]":
+                    self.tail = buf[pos:] + f.read()
+                    return
+                try:
+                    record, end = self._decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        raise
+                    buf, pos = buf[pos:] + chunk, 0
+                    continue
+                yield buf[pos:end], record
+                pos = end
+
+
+def _dump_history_record(record: dict) -> str:
+    """save_json (indent=2) bilan bir xil ko'rinish: yozuv "results" ichida 4 bo'sh joy chuqurlikda turadi."""
+    return json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n    ")
+
+
+def build_result_part_index(banks: dict | None = None) -> dict:
+    """test_history bo'ylab part -> natijalar indeksini qaytadan quradi va saqlaydi."""
+    banks = banks or {section: app.answer_key_bank(section) for section in app.RESULT_SECTIONS}
+    index = {"built_at": datetime.now().isoformat(), "parts": {}}
+    path = _history_path()
+    if path.exists():
+        for _raw, record in HistoryStream(path):
+            app.index_result_parts(index, record, banks)
+    app.save_json(app.RESULT_PART_INDEX_FILE, index)
+    return index
+
+
+def _rescore_target_id(stale: dict, banks: dict) -> str:
+    """Qaysi kalit o'zgarishi uchun checkpoint yozilganini aniqlaydi (kalitlar yana o'zgarsa — yangidan)."""
+    parts = sorted((key, banks[key.split("|", 1)[0]][key]["key"]) for key in stale)
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def run_rescore(apply: bool = False, batch_size: int = 1000, rebuild_index: bool = False,
+                checkpoint_path: Path = RESCORE_CHECKPOINT, diff_path: Path = RESCORE_DIFF) -> dict:
+    """Javob kaliti o'zgargan partlarni o'z ichiga olgan natijalarni qayta baholaydi.
+
+    Ta'sirlangan natijalar part indeksidan olinadi, test_history esa oqim (stream) sifatida bir marta o'qiladi:
+    boshqa yozuvlar baytma-bayt ko'chiriladi. Har bir yozuv uchun diff `diff_path` ga yoziladi.
+    `apply=False` bo'lsa faqat diff hisoblanadi. Checkpoint har `batch_size` yozuvdan keyin saqlanadi —
+    to'xtatilgan ish shu joydan davom etadi. Qayta baholangan natija joriy kalit izini oladi, shuning uchun
+    ikkinchi ishga tushirish hech narsani o'zgartirmaydi.
+    """
+    started = time.monotonic()
+    path = _history_path()
+    banks = {section: app.answer_key_bank(section) for section in app.RESULT_SECTIONS}
+    index = None if rebuild_index else app.load_result_part_index()
+    if index is None:
+        index = build_result_part_index(banks)
+        print(f"[Rescore] Part indeksi qurildi: {len(index['parts'])} ta part ({time.monotonic() - started:.2f}s)")
+    stale = app.stale_result_sessions(index, banks)
+    targets = set().union(*stale.values()) if stale else set()
+    stats = {"parts": len(stale), "targets": len(targets), "scanned": 0, "rescored": 0,
+             "questions_changed": 0, "level_changed": 0, "applied": False, "elapsed_s": 0.0}
+    if not targets or not path.exists():
+        checkpoint_path.unlink(missing_ok=True)
+        print("[Rescore] Kaliti o'zgargan natija yo'q.")
+        return stats
+    for key in sorted(stale):
+        print(f"[Rescore] {key}: {len(stale[key])} ta natija")
+
+    target_id = _rescore_target_id(stale, banks)
+    source_stamp = _file_stamp(path)
+    tmp_path = path.with_suffix(path.suffix + ".rescore")
+    ckpt = _read_json(checkpoint_path, {})
+    resume = (ckpt.get("target") == target_id and ckpt.get("source") == source_stamp
+              and ckpt.get("apply") == apply and (not apply or tmp_path.exists()))
+    if resume:
+        stats.update(ckpt["stats"])
+        print(f"[Rescore] Checkpointdan davom etilmoqda: {ckpt['records']} ta yozuv o'tilgan")
+    else:
+        ckpt = {"target": target_id, "source": source_stamp, "apply": apply,
+                "records": 0, "tmp_bytes": 0, "diff_bytes": 0, "stats": stats}
+    elapsed_before = stats["elapsed_s"]
+    run_started = time.monotonic()
+    skip = ckpt["records"]
+
+    diff_out = open(diff_path, "r+b" if resume and diff_path.exists() else "wb")
+    diff_out.truncate(ckpt["diff_bytes"])
+    diff_out.seek(ckpt["diff_bytes"])
+    tmp_out = None
+    if apply:
+        tmp_out = open(tmp_path, "r+b" if resume else "wb")
+        tmp_out.truncate(ckpt["tmp_bytes"])
+        tmp_out.seek(ckpt["tmp_bytes"])
+
+    def save_checkpoint(records: int):
+        diff_out.flush()
+        ckpt["diff_bytes"] = diff_out.tell()
+        if tmp_out is not None:
+            tmp_out.flush()
+            ckpt["tmp_bytes"] = tmp_out.tell()
+        ckpt["records"] = records
+        stats["elapsed_s"] = round(elapsed_before + time.monotonic() - run_started, 2)
+        ckpt["stats"] = stats
+        _atomic_write_json(checkpoint_path, ckpt)
+
+    stream = HistoryStream(path)
+    n = 0
+    try:
+        for raw, record in stream:
+            n += 1
+            if n <= skip:
+                continue
+            text = raw
+            if record.get("session_id") in targets:
+                old_level = record.get("cefr_level")
+                diff = app.rescore_record(record, banks)
+                if diff is not None:
+                    text = _dump_history_record(record)
+                    stats["rescored"] += 1
+                    stats["questions_changed"] += sum(len(s["questions"]) for s in diff["sections"].values())
+                    if record.get("cefr_level") != old_level:
+                        stats["level_changed"] += 1
+                    diff_out.write((json.dumps(diff, ensure_ascii=False) + "\n").encode("utf-8"))
+            stats["scanned"] += 1
+            if tmp_out is not None:
+                if n == 1:
+                    tmp_out.write((stream.head + "\n    ").encode("utf-8"))
+                else:
+                    tmp_out.write(b",\n    ")
+                tmp_out.write(text.encode("utf-8"))
+            if n % batch_size == 0:
+                save_checkpoint(n)
+                print(f"[Rescore] {n} ta yozuv, qayta baholangan: {stats['rescored']}")
+        if tmp_out is not None:
+            tmp_out.write((("\n  " if n else stream.head) + stream.tail).encode("utf-8"))
+        save_checkpoint(n)
+    finally:
+        diff_out.close()
+        if tmp_out is not None:
+            tmp_out.close()
+
+    if apply:
+        if _file_stamp(path) != source_stamp:
+            # Ish davomida server yangi natija yozgan: eski nusxa bilan ustidan yozmaymiz
+            tmp_path.unlink(missing_ok=True)
+            checkpoint_path.unlink(missing_ok=True)
+            raise SystemExit("[Rescore] test_history.json ish davomida o'zgardi — qayta ishga tushiring.")
+        os.replace(tmp_path, path)
+        build_result_part_index(banks)
+        rebuild_item_stats(banks)
+        stats["applied"] = True
+    checkpoint_path.unlink(missing_ok=True)
+    stats["elapsed_s"] = round(elapsed_before + time.monotonic() - run_started, 2)
+    print(f"[Rescore] Yakunlandi: {stats} (diff: {diff_path})")
+    return stats
+
+
+def cmd_rescore_results(args):
+    run_rescore(apply=args.apply, batch_size=args.batch_size, rebuild_index=args.rebuild_index)
+
+
+# ============ ITEM STATISTIKASINI QAYTA QURISH (backfill) ============
+
+def rebuild_item_stats(banks: dict | None = None) -> dict:
+    """test_history dan item statistikasini NumPy bilan qaytadan hisoblaydi (save_test_result dagi yig'indilar bilan bir xil).
+
+    Tarix bir marta oqim sifatida o'qiladi, javoblar massivlarga yig'iladi va yig'indilar np.bincount bilan olinadi.
+    Javob variantlari ham xuddi incremental yo'ldagidek birinchi uchragan tartibda ITEM_MAX_OPTIONS tagacha sanaladi.
+    """
+    import numpy as np
+
+    started = time.monotonic()
+    banks = banks or {section: app.answer_key_bank(section) for section in app.RESULT_SECTIONS}
+    item_ids: dict = {}
+    answer_ids: dict = {}
+    ca_by_item: dict = {}
+    items, xs, rests, answers = array("l"), array("b"), array("d"), array("l")
+    results = 0
+    path = _history_path()
+    if path.exists():
+        for _raw, record in HistoryStream(path):
+            seen = False
+            for key, x, rest, ua, ca in app.result_item_rows(record, banks):
+                seen = True
+                i = item_ids.setdefault(key, len(item_ids))
+                ca_by_item[i] = ca
+                items.append(i)
+                xs.append(x)
+                rests.append(rest)
+                answers.append(answer_ids.setdefault(ua, len(answer_ids)))
+            results += seen
+    parsed = time.monotonic()
+
+    m = len(item_ids)
+    it = np.asarray(items, dtype=np.int64)
+    x = np.asarray(xs, dtype=np.float64)
+    r = np.asarray(rests, dtype=np.float64)
+    n = np.bincount(it, minlength=m)
+    correct = np.bincount(it, weights=x, minlength=m)
+    sum_r = np.bincount(it, weights=r, minlength=m)
+    sum_rr = np.bincount(it, weights=r * r, minlength=m)
+    sum_xr = np.bincount(it, weights=x * r, minlength=m)
+
+    # (item, javob) juftliklari: birinchi uchragan joyi bo'yicha tartiblab, har item ichida tartib raqami (rank) olinadi
+    options: dict = {i: {} for i in range(m)}
+    if len(it):
+        width = len(answer_ids)
+        codes = it * width + np.asarray(answers, dtype=np.int64)
+        uniq, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        order = np.lexsort((first, uniq // width))
+        pair_item = (uniq // width)[order]
+        pair_answer = (uniq % width)[order]
+        pair_count = counts[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(pair_item)) + 1]
+        rank = np.arange(len(pair_item)) - np.repeat(starts, np.diff(np.r_[starts, len(pair_item)]))
+        names = list(answer_ids)
+        for i, a, c, k in zip(pair_item.tolist(), pair_answer.tolist(), pair_count.tolist(), rank.tolist()):
+            opts = options[i]
+            name = names[a] if k < app.ITEM_MAX_OPTIONS else app.ITEM_OTHER_OPTION
+            opts[name] = opts.get(name, 0) + c
+
+    stats = {"items": {}, "results": results, "responses": len(it), "updated_at": datetime.now().isoformat()}
+    for key, i in item_ids.items():
+        stats["items"][key] = {
+            "ca": ca_by_item[i], "n": int(n[i]), "correct": int(correct[i]),
+            "sum_r": float(sum_r[i]), "sum_rr": float(sum_rr[i]), "sum_xr": float(sum_xr[i]),
+            "options": options[i],
+        }
+    app.save_json(app.ITEM_STATS_FILE, stats)
+    print(f"[ItemStats] {results} ta natija, {len(it)} ta javob, {m} ta savol — "
+          f"o'qish {parsed - started:.2f}s, hisob {time.monotonic() - parsed:.2f}s")
+    return stats
+
+
+def cmd_rebuild_item_stats(args):
+    rebuild_item_stats()
+
+
+# ============ IRT KALIBRATSIYASI (Rasch / 2PL) ============
+
+IRT_THETA_BOUND = 6.0  # hamma savolga to'g'ri/noto'g'ri javob bergan shaxslar uchun chegara (logit)
+IRT_A_BOUNDS = (0.2, 4.0)
+
+
+def build_response_matrix(banks: dict | None = None) -> dict:
+    """test_history dan siyrak (COO) shaxs × savol javob matritsasi: person, item, x massivlari.
+
+    Shaxs — bitta natija (sessiya). Savol kaliti app.item_key bilan bir xil (bo'lim|manba|part|raqam).
+    """
+    import numpy as np
+
+    banks = banks or {section: app.answer_key_bank(section) for section in app.RESULT_SECTIONS}
+    item_ids: dict = {}
+    persons, items, xs = array("l"), array("l"), array("b")
+    levels = []
+    path = _history_path()
+    if path.exists():
+        for _raw, record in HistoryStream(path):
+            p = len(levels)
+            seen = False
+            for key, x, _rest, _ua, _ca in app.result_item_rows(record, banks):
+                seen = True
+                persons.append(p)
+                items.append(item_ids.setdefault(key, len(item_ids)))
+                xs.append(x)
+            if seen:
+                levels.append(record.get("cefr_level"))
+    return {
+        "person": np.asarray(persons, dtype=np.int64), "item": np.asarray(items, dtype=np.int64),
+        "x": np.asarray(xs, dtype=np.float64), "items": list(item_ids), "levels": levels,
+    }
+
+
+def synthetic_response_matrix(persons: int, items: int = 120, per_person: int = 35, seed: int = 1) -> dict:
+    """Benchmark uchun: ma'lum theta/a/b bilan 2PL modelidan siyrak javoblar (har shaxs tasodifiy `per_person` savol)."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    theta = rng.normal(0, 1, persons)
+    b = rng.normal(0, 1, items)
+    a = np.exp(rng.normal(0, 0.3, items))
+    per_person = min(per_person, items)
+    person = np.repeat(np.arange(persons), per_person)
+    item = np.argsort(rng.random((persons, items)), axis=1)[:, :per_person].ravel()
+    p = 1 / (1 + np.exp(-a[item] * (theta[person] - b[item])))
+    x = (rng.random(len(p)) < p).astype(np.float64)
+    return {"person": person, "item": item, "x": x, "items": [f"synthetic|s|1|{i}" for i in range(items)],
+            "levels": [None] * persons, "true": {"theta": theta, "a": a, "b": b}}
+
+
+def fit_irt(person, item, x, n_persons: int, n_items: int, model: str = "rasch",
+            max_iter: int = 200, tol: float = 1e-3) -> dict:
+    """Rasch yoki 2PL ni joint maximum likelihood bilan moslaydi.
+
+    Har iteratsiyada theta, b (va 2PL da a) uchun bitta Newton qadami; gradient va informatsiya faqat
+    kuzatilgan javoblar bo'yicha np.bincount bilan yig'iladi (to'liq matritsa qurilmaydi).
+    Shkala: Rasch — o'rtacha b = 0; 2PL — theta o'rtachasi 0, standart og'ishi 1.
+    `tol` (logit) — savollar standart xatosidan ancha kichik; 2PL da shkala har iteratsiyada qayta
+    normallashgani uchun o'zgarish ~1e-4 atrofida to'xtaydi.
+    """
+    import numpy as np
+
+    def logit(p):
+        return np.log(p / (1 - p))
+
+    n_i = np.bincount(item, minlength=n_items).astype(np.float64)
+    n_p = np.bincount(person, minlength=n_persons).astype(np.float64)
+    b = -logit((np.bincount(item, weights=x, minlength=n_items) + 0.5) / (n_i + 1))
+    score = np.bincount(person, weights=x, minlength=n_persons)
+    theta = logit((score + 0.5) / (n_p + 1))
+    # Hamma javobi to'g'ri/noto'g'ri shaxslarning theta si chegaraga intiladi: yaqinlashish va shkala ularsiz olinadi
+    free = (score > 0) & (score < n_p)
+    if not free.any():
+        free[:] = True
+    b -= b.mean()
+    a = np.ones(n_items)
+    iterations = 0
+    converged = False
+    for iterations in range(1, max_iter + 1):
+        ai = a[item]
+        prob = 1 / (1 + np.exp(-ai * (theta[person] - b[item])))
+        resid = x - prob
+        info = prob * (1 - prob)
+        step_t = np.bincount(person, weights=ai * resid, minlength=n_persons) / np.maximum(
+            np.bincount(person, weights=ai * ai * info, minlength=n_persons), 1e-9)
+        new_theta = np.clip(theta + np.clip(step_t, -1, 1), -IRT_THETA_BOUND, IRT_THETA_BOUND)
+        # Yaqinlashish qadam emas, haqiqiy o'zgarish bo'yicha o'lchanadi (chegarada qadam nolga aylanadi)
+        delta = np.abs(new_theta - theta)[free].max(initial=0)
+        theta = new_theta
+
+        d = theta[person] - b[item]
+        prob = 1 / (1 + np.exp(-ai * d))
+        resid = x - prob
+        info = prob * (1 - prob)
+        step_b = -np.bincount(item, weights=ai * resid, minlength=n_items) / np.maximum(
+            np.bincount(item, weights=ai * ai * info, minlength=n_items), 1e-9)
+        new_b = np.clip(b + np.clip(step_b, -1, 1), -IRT_THETA_BOUND, IRT_THETA_BOUND)
+        delta = max(delta, np.abs(new_b - b).max(initial=0))
+        b = new_b
+
+        if model == "2pl":
+            step_a = np.bincount(item, weights=resid * d, minlength=n_items) / np.maximum(
+                np.bincount(item, weights=info * d * d, minlength=n_items), 1e-9)
+            new_a = np.clip(a + np.clip(step_a, -0.5, 0.5), *IRT_A_BOUNDS)
+            delta = max(delta, np.abs(new_a - a).max(initial=0))
+            a = new_a
+            mean, sd = theta[free].mean(), theta[free].std() or 1.0
+            theta = np.clip((theta - mean) / sd, -IRT_THETA_BOUND, IRT_THETA_BOUND)
+            b = (b - mean) / sd
+            a = np.clip(a * sd, *IRT_A_BOUNDS)
+        else:
+            shift = b.mean()
+            b -= shift
+            theta -= shift
+        if delta < tol:
+            converged = True
+            break
+
+    ai = a[item]
+    prob = np.clip(1 / (1 + np.exp(-ai * (theta[person] - b[item]))), 1e-12, 1 - 1e-12)
+    info_b = np.bincount(item, weights=ai * ai * prob * (1 - prob), minlength=n_items)
+    if model == "rasch":
+        # JML b ni kam sonli savolda (1 - 1/L) barobar cho'zadi (Wright); L — shaxs boshiga o'rtacha savollar
+        length = len(x) / max(n_persons, 1)
+        if length > 1:
+            b *= (length - 1) / length
+    loglik = float(np.sum(x * np.log(prob) + (1 - x) * np.log(1 - prob)))
+    return {
+        "model": model, "theta": theta, "a": a, "b": b,
+        "se_b": 1 / np.sqrt(np.maximum(info_b, 1e-12)), "n": n_i.astype(np.int64),
+        "iterations": iterations, "converged": converged, "loglik": round(loglik, 2),
+    }
+
+
+def write_item_parameters(matrix: dict, fit: dict, min_responses: int = 30) -> int:
+    """Savol parametrlarini test bankiga yozadi: har test uchun test["irt"]["items"]["part|raqam"] = {a, b, se_b, n}.
+    Test darajasidagi maydon admin paneldagi part tahririda saqlanib qoladi."""
+    by_test: dict = {}
+    for i, key in enumerate(matrix["items"]):
+        section, source, part, q = key.split("|", 3)
+        if fit["n"][i] < min_responses:
+            continue
+        by_test.setdefault((section, source), {})[f"{part}|{q}"] = {
+            "a": round(float(fit["a"][i]), 4), "b": round(float(fit["b"][i]), 4),
+            "se_b": round(float(fit["se_b"][i]), 4), "n": int(fit["n"][i]),
+        }
+    written = 0
+    for section in app.RESULT_SECTIONS:
+        filename = f"{section}_tests.json"
+        data = app.load_json(filename)
+        changed = False
+        for test in data.get("tests", []):
+            params = by_test.get((section, test.get("id", "")))
+            if not params:
+                continue
+            test["irt"] = {"model": fit["model"], "calibrated_at": datetime.now().isoformat(),
+                           "iterations": fit["iterations"], "items": params}
+            written += len(params)
+            changed = True
+        if changed:
+            app.save_json(filename, data)
+    return written
+
+
+def _level_thetas(levels: list, theta) -> dict:
+    """Saqlangan CEFR darajasi bo'yicha theta o'rtachasi — calc_final chegaralarini solishtirish uchun."""
+    import numpy as np
+
+    out = {}
+    levels_arr = np.asarray([lv or "—" for lv in levels])
+    for lv in list(app.CEFR_LEVELS)[::-1] + ["—"]:
+        mask = levels_arr == lv
+        if mask.any():
+            out[lv] = {"n": int(mask.sum()), "theta_mean": round(float(theta[mask].mean()), 3),
+                       "theta_p10": round(float(np.percentile(theta[mask], 10)), 3),
+                       "theta_p90": round(float(np.percentile(theta[mask], 90)), 3)}
+    return out
+
+
+def run_calibration(model: str = "rasch", apply: bool = False, synthetic: int = 0, max_iter: int = 200,
+                    min_responses: int = 30, seed: int = 1) -> dict:
+    import numpy as np
+
+    t0 = time.monotonic()
+    matrix = synthetic_response_matrix(synthetic, seed=seed) if synthetic else build_response_matrix()
+    t1 = time.monotonic()
+    n_persons, n_items = len(matrix["levels"]), len(matrix["items"])
+    report = {"model": model, "persons": n_persons, "items": n_items, "responses": int(len(matrix["x"])),
+              "density": round(len(matrix["x"]) / max(n_persons * n_items, 1), 4)}
+    if not len(matrix["x"]):
+        print("[IRT] Javoblar yo'q.")
+        return report
+    fit = fit_irt(matrix["person"], matrix["item"], matrix["x"], n_persons, n_items, model=model, max_iter=max_iter)
+    t2 = time.monotonic()
+    report.update({"iterations": fit["iterations"], "converged": fit["converged"], "loglik": fit["loglik"],
+                   "matrix_s": round(t1 - t0, 3), "fit_s": round(t2 - t1, 3),
+                   "ms_per_iteration": round((t2 - t1) * 1000 / max(fit["iterations"], 1), 2)})
+    if synthetic:
+        true = matrix["true"]
+        report["recovery"] = {
+            "b_corr": round(float(np.corrcoef(fit["b"], true["b"])[0, 1]), 4),
+            "theta_corr": round(float(np.corrcoef(fit["theta"], true["theta"])[0, 1]), 4),
+        }
+        if model == "2pl":
+            report["recovery"]["a_corr"] = round(float(np.corrcoef(fit["a"], true["a"])[0, 1]), 4)
+    else:
+        report["levels"] = _level_thetas(matrix["levels"], fit["theta"])
+        if apply:
+            report["written"] = write_item_parameters(matrix, fit, min_responses)
+    report["elapsed_s"] = round(time.monotonic() - t0, 3)
+    print(f"[IRT] {report['responses']} ta javob, {n_persons} shaxs × {n_items} savol — "
+          f"matritsa {report['matrix_s']}s, moslash {report['fit_s']}s ({fit['iterations']} iteratsiya)")
+    return report
+
+
+def cmd_calibrate_irt(args):
+    print(json.dumps(run_calibration(model=args.model, apply=args.apply, synthetic=args.synthetic,
+                                     max_iter=args.max_iter, min_responses=args.min_responses), ensure_ascii=False))
+
+
+# ============ ADAPTIV TEST SIMULYATSIYASI ============
+
+def _synthetic_bank(section: str, parts_per_slot: int, items_per_part: int, rng: random.Random) -> tuple:
+    """Kalibrlangan sintetik bank: har slotda `parts_per_slot` ta part, qiyinligi part bo'yicha har xil."""
+    bank, params = {}, {}
+    for slot in range(1, app.SECTION_SLOTS[section] + 1):
+        for i in range(parts_per_slot):
+            source = f"syn_{slot}_{i}"
+            centre = rng.gauss(0, 1.2)
+            part = {"part_number": slot, "type": app.READING_SLOT_TYPES.get(slot), "_source_test_id": source}
+            items = []
+            for j in range(items_per_part):
+                qn = str(slot * 100 + j)
+                items.append((qn, "A", str.upper, None, slot))
+                params[app.item_key(section, source, slot, qn)] = (math.exp(rng.gauss(0.2, 0.25)), rng.gauss(centre, 0.6))
+            bank[app.part_index_key(section, source, slot)] = {"part": part, "items": tuple(items), "key": ""}
+    return bank, params
+
+
+def bench_adaptive(candidates: int = 500, parts_per_slot: int = 30, items_per_part: int = 8,
+                   section: str = "listening", seed: int = 1) -> dict:
+    """Adaptiv va oddiy (har slotdan tasodifiy part) rejimni simulyatsiya qilib solishtiradi:
+    berilgan savollar soni, theta xatosi (RMSE) va posterior SD."""
+    rng = random.Random(seed)
+    bank, params = _synthetic_bank(section, parts_per_slot, items_per_part, rng)
+    started = time.perf_counter()
+    index = app.ItemInformationIndex(section, -1, bank=bank, params=params)
+    build_ms = (time.perf_counter() - started) * 1000
+    by_slot: dict = {}
+    for key, entry in index.parts.items():
+        by_slot.setdefault(entry["slot"], []).append(key)
+
+    def answer(key: str, theta: float) -> list:
+        details = []
+        source = index.parts[key]["part"]["_source_test_id"]
+        for qn, *_rest in bank[key]["items"]:
+            a, b = params[app.item_key(section, source, index.parts[key]["slot"], qn)]
+            details.append({"q": qn, "ok": rng.random() < 1 / (1 + math.exp(-a * (theta - b)))})
+        return details
+
+    rows = {"fixed": [], "adaptive": []}
+    select_us = []
+    for _ in range(candidates):
+        theta = rng.gauss(0, 1.2)
+        loglik = None
+        for slot in sorted(by_slot):
+            key = rng.choice(by_slot[slot])
+            loglik = app.adaptive_loglik(index, key, answer(key, theta), loglik)
+        est, se = app.estimate_theta(loglik)
+        rows["fixed"].append((len(by_slot) * items_per_part, est - theta, se))
+
+        loglik, administered, used, est, se = None, [], set(), 0.0, 1.0
+        while True:
+            t0 = time.perf_counter()
+            key = index.best(est, administered, used)
+            select_us.append((time.perf_counter() - t0) * 1e6)
+            if key is None:
+                break
+            administered.append(key)
+            used.add(index.parts[key]["slot"])
+            loglik = app.adaptive_loglik(index, key, answer(key, theta), loglik)
+            est, se = app.estimate_theta(loglik)
+            if (se <= app.ADAPTIVE_TARGET_SE and len(administered) >= app.ADAPTIVE_MIN_PARTS) or len(used) >= len(by_slot):
+                break
+        rows["adaptive"].append((len(administered) * items_per_part, est - theta, se))
+
+    report = {"candidates": candidates, "parts": len(index.parts), "target_se": app.ADAPTIVE_TARGET_SE,
+              "index_build_ms": round(build_ms, 1), "select_us": round(sum(select_us) / max(len(select_us), 1), 1)}
+    for mode, vals in rows.items():
+        report[mode] = {
+            "items_mean": round(sum(v[0] for v in vals) / len(vals), 1),
+            "rmse": round(math.sqrt(sum(v[1] ** 2 for v in vals) / len(vals)), 3),
+            "se_mean": round(sum(v[2] for v in vals) / len(vals), 3),
+        }
+    return report
+
+
+def cmd_bench_adaptive(args):
+    print(json.dumps(bench_adaptive(args.candidates, args.parts_per_slot, args.items_per_part)))
+
+
+# ============ PART TANLASH BENCHMARKI ============
+
+def _legacy_pick(candidates: list, pnum: int, seen_ids: list, rng=random) -> tuple:
+    """Oldingi usul: har tanlovda nomzodlar ro'yxatini ko'rilgan/ko'rilmaganga ajratish + random.choice."""
+    unseen, seen = [], []
+    for part_dict, test_id in candidates:
+        (seen if test_id + "_" + str(pnum) in seen_ids else unseen).append((part_dict, test_id))
+    return rng.choice(unseen or seen or candidates)
+
+
+def bench_part_selection(parts: int = 5000, draws: int = 20000, seen: int = 200, seed: int = 1) -> dict:
+    """Bitta slotda `parts` ta nomzod: tanlov narxi (oldingi ro'yxat skani va alias jadval) hamda
+    ko'rsatilishlar qanchalik tekis taqsimlanishi (eng ko'p / o'rtacha)."""
+    # Lokal generator va vaqtinchalik exposure: global random holati va jarayondagi hisoblagichlar o'zgarmaydi
+    rng = random.Random(seed)
+    saved_exposure = app._part_exposure
+    app._part_exposure = {"listening": {}}
+    try:
+        tests = [{"id": f"bench_{i}", "parts": [{"part_number": 1, "type": "short_conversations"}]} for i in range(parts)]
+        # Boshlang'ich notekislik: bir nechta "mashhur" partlar ko'p ko'rsatilgan
+        for i in range(20):
+            app._part_exposure["listening"][f"bench_{i}_1"] = 500
+        seen_ids = {f"bench_{i}_1" for i in rng.sample(range(parts), seen)}
+        seen_list = list(seen_ids)
+        sampler = app.PartSampler("listening", tests, version=None)
+        candidates = sampler.slots[1]["candidates"]
+
+        started = time.perf_counter()
+        for _ in range(min(draws, 2000)):
+            _legacy_pick(candidates, 1, seen_list, rng)
+        legacy_us = (time.perf_counter() - started) * 1e6 / min(draws, 2000)
+
+        counts = app._part_exposure["listening"]
+        started = time.perf_counter()
+        rebuilds = 0
+        for _ in range(draws):
+            part, test_id = sampler.draw(1, seen_ids, rng=rng)
+            pid = test_id + "_1"
+            counts[pid] = counts.get(pid, 0) + 1
+            before = sampler.slots[1]["table"]
+            sampler.served(1)
+            rebuilds += sampler.slots[1]["table"] is not before
+        alias_us = (time.perf_counter() - started) * 1e6 / draws
+        served = [counts.get(pid, 0) for pid in sampler.slots[1]["pids"]]
+        mean = sum(served) / len(served)
+    finally:
+        app._part_exposure = saved_exposure
+    return {"parts": parts, "draws": draws, "seen": seen, "legacy_draw_us": round(legacy_us, 2),
+            "alias_draw_us": round(alias_us, 2), "table_rebuilds": rebuilds,
+            "exposure_max_over_mean": round(max(served) / mean, 2),
+            # Oldindan 500 martadan ko'rsatilgan 20 ta partga yangi tortishlarning ulushi (bir tekis tanlovda 20 / parts)
+            "popular_draw_pct": round(100 * (sum(served[:20]) - 20 * 500) / draws, 3),
+            "uniform_draw_pct": round(100 * 20 / parts, 3)}
+
+
+def cmd_bench_part_selection(args):
+    print(json.dumps(bench_part_selection(args.parts, args.draws, args.seen)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CEFR Level offline ishlar")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("regrade-writing", help="Saqlangan writing javoblarini batch provider orqali qayta baholash")
+    p.add_argument("--provider", choices=("mock", "openai"), default="mock")
+    p.add_argument("--model", default="gpt-4o-mini")
+    p.add_argument("--batch-size", type=int, default=500)
+    p.add_argument("--max-retries", type=int, default=3)
+    p.add_argument("--poll-interval", type=float, default=10.0)
+    p.add_argument("--limit", type=int, default=None)
+    p.add_argument("--apply", action="store_true", help="Natijalarni test_history.json ga yozish")
+    p.add_argument("--mock-latency", type=float, default=0.0)
+    p.add_argument("--mock-fail-rate", type=float, default=0.0)
+    p.add_argument("--seed", type=int, default=None)
+    p.set_defaults(func=cmd_regrade_writing)
+
+    p = sub.add_parser("loadtest-writing", help="evaluate_writing_with_ai ni parallel chaqirib latency o'lchash (mock_ai_server bilan)")
+    p.add_argument("--requests", type=int, default=100)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.set_defaults(func=cmd_loadtest_writing)
+
+    p = sub.add_parser("analyze-writing", help="Ko'p matnni (NDJSON) process pool'da algoritmik tahlil qilish")
+    p.add_argument("input", nargs="?", default="-", help="NDJSON fayl ({\"id\", \"text\", \"task_type\"} har qatorda), - = stdin")
+    p.add_argument("-o", "--output", default="-", help="Natija NDJSON fayli, - = stdout")
+    p.add_argument("--workers", type=int, default=None, help="Process soni (standart: CPU yadrolari)")
+    p.set_defaults(func=cmd_analyze_writing)
+
+    p = sub.add_parser("bench-writing", help="Writing scorerlarini alohida va umumiy xususiyatlar bilan solishtirish")
+    p.add_argument("--sizes", default="200,500,1000,2000", help="So'zlar soni, vergul bilan")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=cmd_bench_writing)
+
+    p = sub.add_parser("bench-lexicon", help="Ingliz lug'ati backendlari: yuklash vaqti, xotira va qidiruv narxi")
+    p.add_argument("--lookups", type=int, default=200_000)
+    p.set_defaults(func=cmd_bench_lexicon)
+
+    p = sub.add_parser("bench-similarity", help="MinHash/LSH indeksi: qurish, so'rov narxi va recall (to'liq skanga nisbatan)")
+    p.add_argument("--n", type=int, default=200_000, help="Indeksdagi sintetik imzolar soni")
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--similarity", type=float, default=0.7, help="Qo'shilgan nusxalarning o'xshashligi")
+    p.set_defaults(func=cmd_bench_similarity)
+
+    p = sub.add_parser("bench-scoring", help="Reading/listening baholash: kompilyatsiya qilingan kalitlar va oldingi if/elif versiyasi")
+    p.add_argument("--submissions", type=int, default=2000)
+    p.set_defaults(func=cmd_bench_scoring)
+
+    p = sub.add_parser("rescore-results", help="Javob kaliti o'zgargan partlar bo'yicha saqlangan reading/listening natijalarini qayta baholash")
+    p.add_argument("--apply", action="store_true", help="Natijalarni test_history.json ga yozish (aks holda faqat diff)")
+    p.add_argument("--batch-size", type=int, default=1000, help="Checkpoint oralig'i (yozuvlar)")
+    p.add_argument("--rebuild-index", action="store_true", help="Part -> natijalar indeksini qaytadan qurish")
+    p.set_defaults(func=cmd_rescore_results)
+
+    p = sub.add_parser("rebuild-item-stats", help="Savollar statistikasini (facility, point-biserial, distraktorlar) tarixdan qayta hisoblash")
+    p.set_defaults(func=cmd_rebuild_item_stats)
+
+    p = sub.add_parser("calibrate-irt", help="Saqlangan javoblardan Rasch/2PL savol parametrlarini hisoblash")
+    p.add_argument("--model", choices=("rasch", "2pl"), default="rasch")
+    p.add_argument("--apply", action="store_true", help="Parametrlarni test bankiga (test[\"irt\"]) yozish")
+    p.add_argument("--synthetic", type=int, default=0, help="Tarix o'rniga shuncha sintetik shaxs (benchmark, parametrlarni tiklash)")
+    p.add_argument("--max-iter", type=int, default=200)
+    p.add_argument("--min-responses", type=int, default=30, help="Bundan kam javobli savollar yozilmaydi")
+    p.set_defaults(func=cmd_calibrate_irt)
+
+    p = sub.add_parser("bench-adaptive", help="Adaptiv va oddiy test rejimini sintetik kalibrlangan bankda solishtirish")
+    p.add_argument("--candidates", type=int, default=500)
+    p.add_argument("--parts-per-slot", type=int, default=30)
+    p.add_argument("--items-per-part", type=int, default=8)
+    p.set_defaults(func=cmd_bench_adaptive)
+
+    p = sub.add_parser("bench-part-selection", help="Ekspozitsiya nazorati: alias jadval bilan part tanlash narxi va taqsimoti")
+    p.add_argument("--parts", type=int, default=5000, help="Bitta slotdagi nomzod partlar")
+    p.add_argument("--draws", type=int, default=20000)
+    p.add_argument("--seen", type=int, default=200, help="Foydalanuvchi ko'rgan partlar soni")
+    p.set_defaults(func=cmd_bench_part_selection)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""Lokal AI provider mock server (OpenAI chat-completions va Anthropic messages formatlari).
+
+Writing baholash yo'lini (try_ai_evaluation) haqiqiy API kalitlarisiz sinash va
+yuklama testidan o'tkazish uchun. Ilovani mock ga yo'naltirish:
+
+    OPENAI_API_KEY=mock OPENAI_BASE_URL=http://127.0.0.1:8100/v1 \\
+    ANTHROPIC_API_KEY=mock ANTHROPIC_BASE_URL=http://127.0.0.1:8100/v1 python app.py
+
+Mock ni ishga tushirish:
+
+    python mock_ai_server.py --latency lognormal:0.8,0.5 --rate-429 0.05 --malformed-rate 0.1
+    python mock_ai_server.py --record cassettes/writing.jsonl     # haqiqiy API ga proxy + yozib olish
+    python mock_ai_server.py --replay cassettes/writing.jsonl     # yozib olinganlarni qaytarish
+
+Sozlamalarni ishlayotgan serverda o'zgartirish: POST /_mock/config, statistika: GET /_mock/stats.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+UPSTREAM = {
+    "openai": "https://api.openai.com/v1",
+    "anthropic": "https://api.anthropic.com/v1",
+}
+
+config = {
+    "latency": "fixed:0",       # fixed:S | uniform:A,B | normal:MU,SIGMA | lognormal:MU,SIGMA (soniya, lognormal – mediana va sigma)
+    "rate_429": 0.0,
+    "rate_404": 0.0,
+    "missing_models": [],       # shu modellar uchun doim 404
+    "timeout_rate": 0.0,
+    "timeout_sleep": 180.0,     # klient timeoutidan uzunroq bo'lishi kerak
+    "malformed_rate": 0.0,      # model javobi buzilgan JSON (qirqilgan / matn)
+    "fenced_rate": 0.0,         # ```json ... ``` va trailing vergul (tuzatsa bo'ladigan)
+    "honor_structured": True,   # response_format / tool_choice kelsa javobni buzmaslik (haqiqiy API kabi)
+    "mode": "synthetic",        # synthetic | record | replay
+    "cassette": None,
+    "replay_strict": False,     # replay da topilmasa 500 qaytarish (aks holda synthetic)
+    "seed": None,
+}
+stats = {"requests": 0, "ok": 0, "429": 0, "404": 0, "timeouts": 0, "malformed": 0, "fenced": 0,
+         "replay_hits": 0, "replay_misses": 0, "recorded": 0}
+
+_rng = random.Random()
+_cassette: dict = {}
+_seen_prefixes: set = set()  # prompt cache simulyatsiyasi: ko'rilgan system prefikslar hash lari
+
+
+# Provider prompt cache minimumi (token): bundan qisqa prefiks umuman keshlanmaydi (cache write ham yo'q)
+CACHE_MIN_TOKENS = {"openai": 1024, "claude-3-haiku": 2048, "claude-3-5-haiku": 2048, "anthropic": 1024}
+
+
+def cache_min_tokens(provider: str, model: str) -> int:
+    for prefix, n in CACHE_MIN_TOKENS.items():
+        if (model or "").startswith(prefix):
+            return n
+    return CACHE_MIN_TOKENS.get(provider, 1024)
+
+
+def _prefix_cached(prefix: str, min_tokens: int) -> bool | None:
+    """Prefiks keshlanadigan uzunlikda bo'lmasa None; avval ko'rilgan bo'lsa True (cache hit), aks holda uni eslab qoladi."""
+    if len(prefix) // 4 < min_tokens:
+        return None
+    key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+    if key in _seen_prefixes:
+        return True
+    _seen_prefixes.add(key)
+    return False
+
+app = FastAPI(title="CEFR mock AI provider")
+
+
+# ============ SINTETIK BAHOLASH ============
+
+_SECTION_RE = re.compile(r"=== CANDIDATE (TASK 1|TASK 2|ESSAY) \(\d+ words\) ===\n(.*?)(?=\n\n=== CANDIDATE |\n\nIMPORTANT:|\Z)", re.S)
+
+
+def parse_candidate_texts(prompt: str) -> dict:
+    """build_writing_prompt() natijasidan nomzod matnlarini ajratib oladi."""
+    out = {"task1": "", "task2": "", "essay": ""}
+    names = {"TASK 1": "task1", "TASK 2": "task2", "ESSAY": "essay"}
+    for m in _SECTION_RE.finditer(prompt or ""):
+        out[names[m.group(1)]] = m.group(2).strip()
+    return out
+
+
+def fake_evaluation_json(task1: str, task2: str, essay: str) -> str:
+    """algorithmic_score asosida try_ai_evaluation kutgan shakldagi JSON."""
+    from app import algorithmic_score
+
+    def part(txt: str, min_w: int, max_w: int, task_type: str) -> tuple:
+        r = algorithmic_score(txt or "", min_w, max_w, task_type)
+        return r["score"], r["feedback"] or "Evaluated."
+
+    s1, f1 = part(task1, 50, 80, "email")
+    s2, f2 = part(task2, 120, 150, "letter")
+    se, fe = part(essay, 180, 200, "essay")
+    return json.dumps({
+        "task1": {"score": s1, "content": f1, "organization": "", "language": "", "accuracy": ""},
+        "task2": {"score": s2, "content": f2, "organization": "", "language": "", "accuracy": ""},
+        "essay": {"score": se, "task_achievement": fe, "coherence_cohesion": "", "lexical_resource": "", "grammatical_range": ""},
+        "general_feedback": "Mock baholash.",
+    })
+
+
+def _mangle(content: str) -> str:
+    """Model javobini konfiguratsiyaga ko'ra buzadi (malformed / fenced)."""
+    roll = _rng.random()
+    if roll < config["malformed_rate"]:
+        stats["malformed"] += 1
+        variant = _rng.choice(("truncated", "prose"))
+        if variant == "truncated":
+            return content[: max(1, len(content) // 2)]
+        return "I'm sorry, I evaluated the writing: the candidate did reasonably well overall."
+    if roll < config["malformed_rate"] + config["fenced_rate"]:
+        stats["fenced"] += 1
+        return "Here is the evaluation:\n```json\n" + content.replace("}", ",}") + "\n```"
+    return content
+
+
+# ============ LATENCY / XATOLAR ============
+
+def sample_latency(spec: str) -> float:
+    kind, _, params = (spec or "fixed:0").partition(":")
+    vals = [float(v) for v in params.split(",") if v.strip()] or [0.0]
+    if kind == "uniform":
+        return _rng.uniform(vals[0], vals[1] if len(vals) > 1 else vals[0])
+    if kind == "normal":
+        return max(0.0, _rng.gauss(vals[0], vals[1] if len(vals) > 1 else 0.0))
+    if kind == "lognormal":
+        import math
+        return _rng.lognormvariate(math.log(max(vals[0], 1e-6)), vals[1] if len(vals) > 1 else 0.0)
+    return vals[0]
+
+
+async def _inject_errors(model: str, provider: str):
+    """Xato kiritish: 429, 404, timeout. None – davom etish, aks holda tayyor javob."""
+    if model in config["missing_models"] or _rng.random() < config["rate_404"]:
+        stats["404"] += 1
+        return JSONResponse(_error_body(provider, "not_found_error", f"The model `{model}` does not exist"), status_code=404)
+    if _rng.random() < config["rate_429"]:
+        stats["429"] += 1
+        return JSONResponse(_error_body(provider, "rate_limit_error", "Rate limit reached"), status_code=429,
+                            headers={"retry-after": "1"})
+    if _rng.random() < config["timeout_rate"]:
+        stats["timeouts"] += 1
+        await asyncio.sleep(config["timeout_sleep"])
+        return JSONResponse(_error_body(provider, "timeout", "Request timed out"), status_code=504)
+    return None
+
+
+def _error_body(provider: str, kind: str, message: str) -> dict:
+    if provider == "anthropic":
+        return {"type": "error", "error": {"type": kind, "message": message}}
+    return {"error": {"message": message, "type": kind, "code": kind}}
+
+
+# ============ RECORD / REPLAY ============
+
+def _cassette_key(path: str, body: dict) -> str:
+    canonical = json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(f"{path}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def load_cassette(path: str):
+    _cassette.clear()
+    p = Path(path)
+    if not p.exists():
+        return
+    with open(p, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                _cassette[row["key"]] = row
+
+
+def _append_cassette(row: dict):
+    p = Path(config["cassette"])
+    p.parent.mkdir(parents=True, exist_ok=True)
+    with open(p, "a", encoding="utf-8") as f:
+        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    _cassette[row["key"]] = row
+    stats["recorded"] += 1
+
+
+async def _record(provider: str, path: str, request: Request, body: dict) -> Response:
+    headers = {k: v for k, v in request.headers.items()
+               if k.lower() in ("authorization", "x-api-key", "anthropic-version", "content-type")}
+    async with httpx.AsyncClient(timeout=180.0) as client:
+        r = await client.post(f"{UPSTREAM[provider]}{path}", headers=headers, json=body)
+    row = {"key": _cassette_key(path, body), "path": path, "request": body, "status": r.status_code,
+           "content_type": r.headers.get("content-type", "application/json")}
+    if row["content_type"].startswith("application/json"):
+        row["response"] = r.json()
+    else:
+        row["response_hex"] = r.content.hex()
+    _append_cassette(row)
+    return Response(content=r.content, status_code=r.status_code, media_type=row["content_type"])
+
+
+def _replay(path: str, body: dict) -> Response | None:
+    row = _cassette.get(_cassette_key(path, body))
+    if row is None:
+        stats["replay_misses"] += 1
+        if config["replay_strict"]:
+            return JSONResponse({"error": {"message": "cassette miss", "type": "replay_miss"}}, status_code=500)
+        return None
+    stats["replay_hits"] += 1
+    if "response_hex" in row:
+        return Response(content=bytes.fromhex(row["response_hex"]), status_code=row["status"], media_type=row["content_type"])
+    return JSONResponse(row["response"], status_code=row["status"])
+
+
+async def _handle(provider: str, path: str, request: Request, synth):
+    body = await request.json()
+    stats["requests"] += 1
+    if config["mode"] == "record":
+        return await _record(provider, path, request, body)
+    await asyncio.sleep(sample_latency(config["latency"]))
+    if config["mode"] == "replay":
+        resp = _replay(path, body)
+        if resp is not None:
+            return resp
+    err = await _inject_errors(body.get("model", ""), provider)
+    if err is not None:
+        return err
+    stats["ok"] += 1
+    return synth(body)
+
+
+# ============ ENDPOINTLAR ============
+
+def _synth_chat(body: dict) -> Response:
+    prompt = "\n".join(m.get("content") or "" for m in body.get("messages", []) if m.get("role") == "user")
+    system = "\n".join(m.get("content") or "" for m in body.get("messages", []) if m.get("role") == "system")
+    # tools / response_format ham keshlanadigan prefiksning bir qismi
+    prefix = json.dumps([body.get("tools"), body.get("response_format")], sort_keys=True) + system
+    hit = _prefix_cached(prefix, cache_min_tokens("openai", body.get("model", "")))
+    cached = len(prefix) // 4 if hit else 0
+    content = fake_evaluation_json(**parse_candidate_texts(prompt))
+    if not (config["honor_structured"] and body.get("response_format")):
+        content = _mangle(content)
+    return JSONResponse({
+        "id": f"chatcmpl-mock-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": (len(prefix) + len(prompt)) // 4, "completion_tokens": len(content) // 4,
+                  "total_tokens": (len(prefix) + len(prompt) + len(content)) // 4,
+                  "prompt_tokens_details": {"cached_tokens": cached}},
+    })
+
+
+def _synth_messages(body: dict) -> Response:
+    parts = []
+    for m in body.get("messages", []):
+        c = m.get("content")
+        if isinstance(c, str):
+            parts.append(c)
+        elif isinstance(c, list):
+            parts.extend(b.get("text", "") for b in c if isinstance(b, dict))
+    prompt = "\n".join(parts)
+    system = body.get("system") or ""
+    if isinstance(system, list):
+        system = "\n".join(b.get("text", "") for b in system if isinstance(b, dict))
+    # Anthropic kesh tartibi: tools -> system
+    prefix = json.dumps(body.get("tools"), sort_keys=True) + system
+    prefix_tokens = len(prefix) // 4
+    hit = _prefix_cached(prefix, cache_min_tokens("anthropic", body.get("model", "")))
+    content = fake_evaluation_json(**parse_candidate_texts(prompt))
+    tool_choice = body.get("tool_choice") or {}
+    if config["honor_structured"] and tool_choice.get("type") == "tool":
+        blocks = [{"type": "tool_use", "id": f"toolu_mock_{uuid.uuid4().hex[:12]}",
+                   "name": tool_choice.get("name"), "input": json.loads(content)}]
+    else:
+        content = _mangle(content)
+        blocks = [{"type": "text", "text": content}]
+    return JSONResponse({
+        "id": f"msg_mock_{uuid.uuid4().hex[:12]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "mock"),
+        "content": blocks,
+        "stop_reason": "tool_use" if blocks[0]["type"] == "tool_use" else "end_turn",
+        "usage": {"input_tokens": len(prompt) // 4 + (prefix_tokens if hit is None else 0),
+                  "output_tokens": len(content) // 4,
+                  "cache_read_input_tokens": prefix_tokens if hit else 0,
+                  "cache_creation_input_tokens": prefix_tokens if hit is False else 0},
+    })
+
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, bitta jim frame (417 bayt, ~26 ms)
+_SILENT_MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)
+
+
+def _synth_speech(body: dict) -> Response:
+    # Matn uzunligiga qarab taxminiy davomiylik: ~15 belgi/soniya
+    seconds = max(1.0, len(body.get("input") or "") / 15)
+    frames = int(seconds / 0.026)
+    return Response(content=_SILENT_MP3_FRAME * frames, media_type="audio/mpeg")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    return await _handle("openai", "/chat/completions", request, _synth_chat)
+
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    return await _handle("anthropic", "/messages", request, _synth_messages)
+
+
+@app.post("/v1/audio/speech")
+async def audio_speech(request: Request):
+    return await _handle("openai", "/audio/speech", request, _synth_speech)
+
+
+@app.get("/_mock/stats")
+async def mock_stats():
+    return {"config": config, "stats": stats, "cassette_size": len(_cassette)}
+
+
+@app.post("/_mock/config")
+async def mock_config(request: Request):
+    body = await request.json()
+    unknown = [k for k in body if k not in config]
+    if unknown:
+        return JSONResponse({"error": f"Noma'lum kalitlar: {unknown}"}, status_code=400)
+    config.update(body)
+    if "seed" in body:
+        _rng.seed(body["seed"])
+    if "cassette" in body and config["cassette"]:
+        load_cassette(config["cassette"])
+    return {"config": config}
+
+
+@app.post("/_mock/reset")
+async def mock_reset():
+    for k in stats:
+        stats[k] = 0
+    return PlainTextResponse("ok")
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="CEFR mock AI provider server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", default="fixed:0")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-404", type=float, default=0.0)
+    parser.add_argument("--missing-model", action="append", default=[])
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-sleep", type=float, default=180.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--fenced-rate", type=float, default=0.0)
+    parser.add_argument("--ignore-structured", action="store_true", help="response_format / tool_choice bo'lsa ham javobni buzish")
+    parser.add_argument("--record", metavar="CASSETTE")
+    parser.add_argument("--replay", metavar="CASSETTE")
+    parser.add_argument("--replay-strict", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    config.update({
+        "latency": args.latency, "rate_429": args.rate_429, "rate_404": args.rate_404,
+        "missing_models": args.missing_model, "timeout_rate": args.timeout_rate,
+        "timeout_sleep": args.timeout_sleep, "malformed_rate": args.malformed_rate,
+        "fenced_rate": args.fenced_rate, "honor_structured": not args.ignore_structured, "replay_strict": args.replay_strict, "seed": args.seed,
+    })
+    _rng.seed(args.seed)
+    if args.record:
+        config.update({"mode": "record", "cassette": args.record})
+        load_cassette(args.record)
+    elif args.replay:
+        config.update({"mode": "replay", "cassette": args.replay})
+        load_cassette(args.replay)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()